@@ -2,26 +2,41 @@
 """
 Advanced Stores for behavior outside normal access patterns
 """
+import heapq
+import io
 import os
+import queue
+import threading
 import hvac
 import json
-import zlib
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from datetime import datetime
-from itertools import groupby
-
-from pydash import get, set_
-from maggma.stores import Store, MongoStore, StoreError, Mongolike
-from maggma.utils import lazy_substitute, substitute
+from functools import cmp_to_key
+from itertools import chain, islice, zip_longest
+
+from pydash import get, has, set_, unset
+from maggma.stores import (
+    Store, MongoStore, StoreError, Mongolike, bson_compare_key, bson_sort_key, _covered, _project
+)
+from maggma.utils import lazy_substitute, substitute, threaded_imap, is_mongo_backed, share_database
+from maggma.cache import DiskCache
+from maggma.compression import get_codec, decompress
+from maggma.serialization import get_serializer
+from maggma.partition import ConsistentHashPartition
 from mongogrant import Client
 from mongogrant.client import check
 from mongogrant.config import Config
-from monty.json import jsanitize
+from bson import json_util
 from monty.functools import lru_cache
 from pymongo import MongoClient
+from pymongo.collection import Collection
 
 try:
     import boto3
     import botocore
+    import botocore.config
+    from boto3.s3.transfer import TransferConfig
 
     boto_import = True
 except ImportError:
@@ -330,12 +345,34 @@ class AmazonS3Store(Store):
     Assumes Amazon AWS key and secret key are set in environment or default config file
     """
 
-    def __init__(self, index, bucket, **kwargs):
+    def __init__(self, index, bucket, compression=False, compression_level=None,
+                 compression_dict=None, serialization="json", num_workers=1,
+                 multipart_threshold=8 * 1024 ** 2, searchable_fields=None,
+                 cache_path=None, cache_size=2 ** 30, **kwargs):
         """
         Initializes an S3 Store
         Args:
             index (Store): a store to use to index the S3 Bucket
             bucket (str) : name of the bucket
+            compression (bool or str): default codec to compress objects
+                with, True for zlib. See maggma.compression for the codecs,
+                objects stored with any of them can be read
+            compression_level (int): compression level of the codec
+            compression_dict (bytes): trained dictionary for zstd
+            serialization (str): format of the stored objects, "json",
+                "bson" or "msgpack". See maggma.serialization for the
+                formats, objects stored in any of them can be read
+            num_workers (int): number of objects uploaded or downloaded
+                concurrently, all sharing the connection pool of the store
+            multipart_threshold (int): size in bytes above which objects
+                are uploaded in concurrent parts
+            searchable_fields (list): small fields also stored in the
+                index, so queries projecting only these fields are
+                answered without downloading the objects
+            cache_path (str): directory of a local cache of the
+                downloaded objects, which can be shared between processes.
+                See maggma.cache.DiskCache
+            cache_size (int): size in bytes of the local cache
         """
         if not boto_import:
             raise ValueError(
@@ -343,6 +380,19 @@ class AmazonS3Store(Store):
             )
         self.index = index
         self.bucket = bucket
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_dict = compression_dict
+        self._codec_name, self._codec = get_codec(compression, compression_level, compression_dict)
+        self._codecs = {self._codec_name: self._codec} if self._codec_name else {}
+        self.serialization = serialization
+        self._serializer = get_serializer(serialization)
+        self.num_workers = num_workers
+        self.multipart_threshold = multipart_threshold
+        self.searchable_fields = searchable_fields or []
+        self.cache_path = cache_path
+        self.cache_size = cache_size
+        self._cache = DiskCache(cache_path, cache_size) if cache_path else None
         self.s3 = None
         self.s3_bucket = None
         # Force the key to be the same as the index
@@ -352,7 +402,10 @@ class AmazonS3Store(Store):
     def connect(self, force_reset=False):
         self.index.connect(force_reset=force_reset)
         if not self.s3:
-            self.s3 = boto3.resource("s3")
+            # A single resource, and so a single client and connection pool,
+            # is shared by all the transfer threads
+            config = botocore.config.Config(max_pool_connections=max(10, 2 * self.num_workers))
+            self.s3 = boto3.resource("s3", config=config)
             # TODO: Provide configuration variable to create bucket if not present
             if self.bucket not in self.s3.list_buckets():
                 raise Exception("Bucket not present on AWS: {}".format(self.bucket))
@@ -368,63 +421,89 @@ class AmazonS3Store(Store):
 
     def query(self, criteria=None, properties=None, **kwargs):
         """
-        Function that gets data from Amazon S3. This store ignores all
-        property projections as its designed for whole document access
+        Function that gets data from Amazon S3. Projections of the key,
+        the last updated field and the searchable fields are answered from
+        the index for objects written with those searchable fields, other
+        projections are applied to the downloaded documents
 
         Args:
-            properties (list or dict): This will be ignored by the S3
-                Store
+            properties (list or dict): properties to return in the
+                documents
             criteria (dict): filter for query, matches documents
                 against key-value pairs
+            num_workers (int): number of objects to download and decode
+                concurrently, defaults to AmazonS3Store.num_workers
             **kwargs (kwargs): further kwargs to Collection.find
         """
-        for f in self.index.query(criteria=criteria, **kwargs):
-            try:
-                data = self.s3_bucket.Object(f[self.key]).get()
-            except botocore.exceptions.ClientError as e:
-                # If a client error is thrown, then check that it was a 404 error.
-                # If it was a 404 error, then the object does not exist.
-                error_code = int(e.response["Error"]["Code"])
-                if error_code == 404:
-                    self.logger.error("Could not find S3 object {}".format(f[self.key]))
-                    break
+        num_workers = kwargs.pop("num_workers", self.num_workers)
+        covered = _covered(properties, {self.key, self.lu_field} | set(self.searchable_fields))
 
-            if f.get("compression", "") is "zlib":
-                data = zlib.decompress(data)
+        def read(index_doc):
+            # Objects written before a field was searchable aren't covered
+            fields = {self.key, self.lu_field} | set(index_doc.get("searchable_fields", []))
+            if covered and _covered(properties, fields):
+                return index_doc
+            return self._read(index_doc)
 
-            yield json.loads(data)
+        index_docs = self.index.query(criteria=criteria, **kwargs)
+
+        # Download ahead while earlier documents are consumed, keeping the order
+        for doc in threaded_imap(read, index_docs, num_workers):
+            if doc is not None:
+                yield _project(doc, properties) if properties else doc
 
     def query_one(self, criteria=None, properties=None, **kwargs):
         """
-        Function that gets a single document from Amazon S3. This store
-        ignores all property projections as its designed for whole
-        document access
+        Function that gets a single document from Amazon S3, projected
+        as in AmazonS3Store.query
 
         Args:
-            properties (list or dict): This will be ignored by the S3
-                Store
+            properties (list or dict): properties to return in the
+                document
             criteria (dict): filter for query, matches documents
                 against key-value pairs
             **kwargs (kwargs): further kwargs to Collection.find
         """
-        f = self.index.query_one(criteria=criteria, **kwargs)
-        if f:
-            try:
-                data = self.s3_bucket.Object(f[self.key]).get()
-            except botocore.exceptions.ClientError as e:
-                # If a client error is thrown, then check that it was a 404 error.
-                # If it was a 404 error, then the object does not exist.
-                error_code = int(e.response["Error"]["Code"])
-                if error_code == 404:
-                    self.logger.error("Could not find S3 object {}".format(f[self.key]))
-                    return None
-
-            if f.get("compression", "") is "zlib":
-                data = zlib.decompress(data)
-
-            return json.loads(data)
-        else:
-            return None
+        kwargs["num_workers"] = 1
+        return next(self.query(criteria=criteria, properties=properties, **kwargs), None)
+
+    def _read(self, f):
+        """
+        Downloads and decodes the object of an index document, through
+        the local cache if there is one. None if the object does not exist
+        """
+        # Objects indexed without their ETag, e.g. by older versions, can't
+        # be told apart from their other versions and aren't cached
+        cache = self._cache if f.get("etag") else None
+        version = (f.get("etag"), f.get("compression"), f.get("serialization"))
+        data = cache.get(f[self.key], version) if cache else None
+        if data is None:
+            data = self._download(f)
+            if data is None:
+                return None
+            if cache:
+                cache.put(f[self.key], version, data)
+
+        data = decompress(data, f.get("compression"), self._codecs)
+
+        return get_serializer(f.get("serialization")).loads(data)
+
+    def _download(self, f):
+        """
+        Downloads the object of an index document, None if the object
+        does not exist
+        """
+        try:
+            response = self.s3_bucket.Object(f[self.key]).get()
+        except botocore.exceptions.ClientError as e:
+            # If a client error is thrown, then check that it was a 404 error.
+            # If it was a 404 error, then the object does not exist.
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                self.logger.error("Could not find S3 object {}".format(f[self.key]))
+                return None
+            raise
+
+        return response["Body"].read()
 
     def distinct(self, key, criteria=None, all_exist=False, **kwargs):
         """
@@ -469,18 +548,26 @@ class AmazonS3Store(Store):
         """
         return self.index.ensure_index(key, unique=unique, background=True)
 
-    def update(self, docs, update_lu=True, key=None, compress=False):
+    def update(self, docs, update_lu=True, key=None, compress=None, batch_size=1000):
         """
         Function to update associated MongoStore collection.
 
         Args:
             docs ([dict]): list of documents
             key ([str] or str): keys to use to build search doc
-            compress (bool): compress the document or not
+            compress (bool or str): codec to compress the documents with,
+                True for zlib, defaults to AmazonS3Store.compression
+            batch_size (int): number of documents uploaded before their
+                index documents are written
         """
-        now = datetime.now()
-        search_docs = []
-        for d in docs:
+        if compress is None:
+            codec_name, codec = self._codec_name, self._codec
+        else:
+            codec_name, codec = get_codec(compress, self.compression_level, self.compression_dict)
+
+        now = datetime.utcnow()
+
+        def write(d):
             if isinstance(key, list):
                 search_doc = {k: d[k] for k in key}
             elif key:
@@ -491,27 +578,68 @@ class AmazonS3Store(Store):
             # Always include our main key
             search_doc[self.key] = d[self.key]
 
+            # Promote the searchable fields into the index, recording them
+            # so that projections on fields added later read the object
+            for field in self.searchable_fields:
+                if has(d, field):
+                    set_(search_doc, field, get(d, field))
+            search_doc["searchable_fields"] = list(self.searchable_fields)
+
             # Remove MongoDB _id from search
             if "_id" in search_doc:
                 del search_doc["_id"]
 
-            # Add a timestamp
+            # Add a timestamp, or index the one of the document
             if update_lu:
-                search_doc[self.lu_field] = now
                 d[self.lu_field] = now
+            if self.lu_field in d:
+                search_doc[self.lu_field] = d[self.lu_field]
 
-            data = json.dumps(jsanitize(d)).encode()
+            data = self._serializer.dumps(d, self.sanitize)
+            search_doc["serialization"] = self.serialization
 
-            # Compress with zlib if chosen
-            if compress:
-                search_doc["compression"] = "zlib"
-                data = zlib.compress(data)
+            # Compress with the chosen codec
+            if codec_name:
+                search_doc["compression"] = codec_name
+                data = codec.compress(data)
 
-            self.s3_bucket.put_object(Key=d[self.key], Body=data, Metadata=search_doc)
-            search_docs.append(search_doc)
+            search_doc["etag"] = self._write(d[self.key], data, search_doc)
+            return search_doc
 
-        # Use store's update to remove key clashes
-        self.index.update(search_docs)
+        # Upload concurrently, indexing each batch once its objects are stored
+        docs = iter(docs)
+        for batch in iter(lambda: list(islice(docs, batch_size)), []):
+            search_docs = list(threaded_imap(write, batch, self.num_workers))
+            # Use store's update to remove key clashes, keeping the timestamps of the objects
+            self.index.update(search_docs, update_lu=False)
+
+    def _write(self, key, data, metadata):
+        """
+        Uploads an object, in concurrent parts if larger than the
+        multipart threshold
+
+        Returns:
+            ETag of the uploaded object
+        """
+        metadata = {k: _encode_metadata(v) for k, v in metadata.items()}
+        if len(data) > self.multipart_threshold:
+            config = TransferConfig(
+                multipart_threshold=self.multipart_threshold,
+                max_concurrency=max(1, self.num_workers),
+            )
+            self.s3_bucket.upload_fileobj(
+                io.BytesIO(data), key, ExtraArgs={"Metadata": metadata}, Config=config
+            )
+            # Multipart uploads don't return the ETag of the object
+            return self.s3_bucket.Object(key).e_tag
+        return self.s3_bucket.Object(key).put(Body=data, Metadata=metadata)["ETag"]
+
+    @property
+    def cache_stats(self):
+        """
+        Hits, misses and size of the local cache, None without one
+        """
+        return self._cache.stats if self._cache else None
 
     @property
     def last_updated(self):
@@ -532,17 +660,99 @@ class AmazonS3Store(Store):
     def __hash__(self):
         return hash((self.index.__hash__, self.bucket))
 
-    def rebuild_index_from_s3_data(self):
+    def rebuild_index_from_s3_data(self, prefixes=None, num_workers=None,
+                                   page_size=1000, checkpoint_path=None):
         """
         Rebuilds the index Store from the data in S3
-        Relies on the index document being stores as the metadata for the file
+        Relies on the index document being stored as the metadata for the file
+
+        The key space is split into shards by prefix, which are listed one
+        page at a time, round-robin. The metadata of the objects of each
+        page is fetched by a pool of workers, and each page is written to
+        the index as soon as it is complete.
+
+        Args:
+            prefixes ([str]): non-overlapping key prefixes covering the
+                objects to index, all objects by default
+            num_workers (int): number of pages fetched concurrently,
+                defaults to AmazonS3Store.num_workers
+            page_size (int): number of objects listed and indexed at a time
+            checkpoint_path (str): file recording the last indexed key of
+                each prefix, so an interrupted rebuild resumes from there.
+                Removed once the rebuild completes
         """
-        index_docs = []
-        for file in self.s3_bucket.objects.all():
-            # TODO: Transform the data back from strings and remove AWS S3 specific keys
-            index_docs.append(file.metadata)
+        num_workers = num_workers or self.num_workers
+        prefixes = prefixes or [""]
+
+        checkpoint = {}
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+
+        def list_pages(prefix):
+            objects = self.s3_bucket.objects.filter(Prefix=prefix, Marker=checkpoint.get(prefix, ""))
+            for page in objects.page_size(page_size).pages():
+                keys = [obj.key for obj in page]
+                if keys:
+                    yield prefix, keys
+
+        def fetch_page(page):
+            prefix, keys = page
+            docs = []
+            for k in keys:
+                obj = self.s3_bucket.Object(k)
+                doc = _decode_metadata(obj.metadata)
+                if self.key in doc:
+                    doc["etag"] = obj.e_tag
+                    docs.append(doc)
+            return prefix, keys[-1], docs
+
+        # Interleave the pages of the shards, so the workers spread across them
+        shards = zip_longest(*[list_pages(prefix) for prefix in prefixes])
+        pages = (page for page in chain.from_iterable(shards) if page is not None)
+
+        for prefix, last_key, docs in threaded_imap(fetch_page, pages, num_workers):
+            if docs:
+                self.index.update(docs, update_lu=False)
+            if checkpoint_path:
+                checkpoint[prefix] = last_key
+                tmp_path = checkpoint_path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(checkpoint, f)
+                os.replace(tmp_path, checkpoint_path)
+
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+
+def _encode_metadata(value):
+    """
+    Encodes an index document value as an S3 metadata string. Plain
+    ASCII strings are kept as they are, other values are stored as
+    extended JSON
+    """
+    if isinstance(value, str) and all(ord(c) < 128 for c in value):
+        try:
+            json.loads(value)
+        except ValueError:
+            return value
+    return json_util.dumps(value)
+
+
+def _decode_metadata(metadata):
+    """
+    Converts S3 metadata strings back to an index document
+    """
+    doc = {}
+    for k, v in metadata.items():
+        try:
+            doc[k] = json_util.loads(v, json_options=_METADATA_JSON_OPTIONS)
+        except ValueError:
+            doc[k] = v
+    return doc
+
 
-        self.index.update(index_docs)
+_METADATA_JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
 
 
 class JointStore(Store):
@@ -738,12 +948,23 @@ class JointStore(Store):
 class ConcatStore(Store):
     """Store concatting multiple stores"""
 
-    def __init__(self, *stores, **kwargs):
+    def __init__(self, *stores, num_workers=1, partition=None, **kwargs):
         """
         Initialize a ConcatStore that concatenates multiple stores together
         to appear as one store
+
+        Args:
+            stores (Store): stores to concatenate
+            num_workers (int): number of stores queried or updated
+                concurrently, 1 accesses them one after the other
+            partition (Partition): assignment of the documents to the
+                stores, by index, to route updates and to only query the
+                stores that can hold matching documents. See
+                maggma.partition for the partitions
         """
         self.stores = stores
+        self.num_workers = num_workers
+        self.partition = partition
         super(ConcatStore, self).__init__(**kwargs)
 
     def connect(self, force_reset=False):
@@ -776,15 +997,56 @@ class ConcatStore(Store):
         since it could very easily over-estimate the last_updated based on what stores
         are used
         """
-        lus = []
-        for store in self.stores:
-            lu = store.last_updated
-            lus.append(lu)
-        return max(lus)
+        return max(threaded_imap(lambda store: store.last_updated, self.stores, self.num_workers))
 
-    # TODO: implement update?
-    def update(self, docs, update_lu=True, key=None, **kwargs):
-        raise NotImplementedError("No update method for JointStore")
+    def update(self, docs, update_lu=True, key=None, batch_size=1000, **kwargs):
+        """
+        Updates the stores with documents routed by the partition. The
+        documents of each batch are written to their stores concurrently
+
+        Args:
+            docs ([dict]): documents to update
+            update_lu (bool): whether to update the last_updated field
+            key (str or [str]): keys of the documents to replace, which
+                must include the partition key so that a document is
+                never in two stores
+            batch_size (int): number of documents routed at a time
+            num_workers (int): number of stores updated concurrently,
+                defaults to ConcatStore.num_workers
+        """
+        if self.partition is None:
+            raise NotImplementedError("ConcatStore needs a partition to route updates")
+        keys = key if isinstance(key, list) else [key or self.key]
+        if self.partition.key not in keys:
+            raise StoreError(
+                "Partition key {} is not a key of the updated documents {}".format(
+                    self.partition.key, keys
+                )
+            )
+        num_workers = kwargs.pop("num_workers", self.num_workers)
+
+        def update_store(shard):
+            index, shard_docs = shard
+            self.stores[index].update(shard_docs, update_lu=update_lu, key=key, **kwargs)
+
+        docs = iter(docs)
+        for batch in iter(lambda: list(islice(docs, batch_size)), []):
+            shards = {}
+            for d in batch:
+                shards.setdefault(self.partition.shard(d, len(self.stores)), []).append(d)
+            for _ in threaded_imap(update_store, sorted(shards.items()), num_workers):
+                pass
+
+    def _shard_stores(self, criteria):
+        """
+        The stores that can hold documents matching criteria
+        """
+        if self.partition is None:
+            return self.stores
+        shards = self.partition.shards(criteria, len(self.stores))
+        if shards is None:
+            return self.stores
+        return [self.stores[i] for i in shards]
 
     def distinct(self, key, criteria=None, all_exist=True, **kwargs):
         """
@@ -794,11 +1056,19 @@ class ConcatStore(Store):
             key (str): key to find distinct values
             criteria (dict): criteria dictionary to reduce the documents to search on
             all_exist (bool): ensure the key exists in the doc or not
+            num_workers (int): number of stores queried concurrently,
+                defaults to ConcatStore.num_workers
         """
-        distincts = []
-        for store in self.stores:
-            distincts.extend(store.distinct(key, criteria, all_exist, **kwargs))
-        return list(set(distincts))
+        num_workers = kwargs.pop("num_workers", self.num_workers)
+
+        def store_distinct(store):
+            return store.distinct(key, deepcopy(criteria), all_exist, **kwargs)
+
+        # Values in the order of the stores, without duplicates
+        distincts = {}
+        for values in threaded_imap(store_distinct, self._shard_stores(criteria), num_workers):
+            distincts.update(dict.fromkeys(values))
+        return list(distincts)
 
     def ensure_index(self, key, unique=False, **kwargs):
         """
@@ -809,46 +1079,384 @@ class ConcatStore(Store):
         """
         return all([store.ensure_index(key, unique, **kwargs) for store in self.stores])
 
-    def query(self, criteria=None, properties=None, **kwargs):
+    def query(self, criteria=None, properties=None, sort=None, skip=0, limit=0, **kwargs):
         """
-        Queries across all the stores.
+        Queries across all the stores. With several workers, the documents
+        of the stores are yielded in the order they arrive, and sorted
+        queries read all the stores at once. The sorted documents of the
+        stores are merged, so a sorted query returns them in global order
 
         Args:
             criteria (dict): mongo style query to reduce the docs to group
             properties (str or [str]): properties to project
+            sort ([(str, int)]): keys and directions to sort the documents
+                of all the stores by
+            skip (int): number of documents to skip across all the stores
+            limit (int): maximum number of documents to return, 0 for all
+            num_workers (int): number of stores queried concurrently,
+                defaults to ConcatStore.num_workers
         """
-        for store in self.stores:
-            for d in store.query(criteria=criteria, properties=properties, **kwargs):
+        num_workers = kwargs.pop("num_workers", self.num_workers)
+        if limit:
+            # Each store may hold all of the first documents
+            kwargs["limit"] = skip + limit
+
+        # The documents are merged by the sort keys, so they must be returned
+        sort_only = []
+        if sort:
+            kwargs["sort"] = sort
+            if isinstance(properties, list):
+                sort_only = [k for k, _ in sort if k not in properties]
+                properties = properties + sort_only
+            elif isinstance(properties, dict) and any(properties.values()):
+                sort_only = [k for k, _ in sort if not properties.get(k)]
+                properties = dict(properties, **{k: 1 for k in sort_only})
+
+        def store_query(store):
+            return lambda: store.query(criteria=deepcopy(criteria), properties=properties, **kwargs)
+
+        queries = [store_query(store) for store in self._shard_stores(criteria)]
+        if sort and num_workers > 1:
+            docs = _merge_sorted(queries, _sort_key(sort), num_workers)
+        elif sort:
+            docs = heapq.merge(*[query() for query in queries], key=_sort_key(sort))
+        elif num_workers > 1:
+            docs = _interleave(queries, num_workers)
+        else:
+            docs = chain.from_iterable(query() for query in queries)
+
+        try:
+            for d in islice(docs, skip, skip + limit if limit else None):
+                for k in sort_only:
+                    unset(d, k)
                 yield d
+        finally:
+            # Stops the threads reading from the stores
+            if hasattr(docs, "close"):
+                docs.close()
 
     def query_one(self, criteria=None, properties=None, **kwargs):
-        return next(self.query(criteria=criteria, properties=properties, **kwargs))
+        return next(self.query(criteria=criteria, properties=properties, limit=1, **kwargs), None)
 
     def groupby(self, keys, criteria=None, properties=None, **kwargs):
         """
-        Group documents by a key. This version is highly inefficient since it performs
-        post-grouping in python across all of its stores
+        Group documents by keys across all the stores. When all the stores
+        are Mongo collections in the same database, on a server supporting
+        $unionWith, the documents are grouped by a single aggregation.
+        Otherwise the groups of each store are sorted by keys and merged
+        as they are read, holding one group per store in memory
 
         Args:
             keys (str or [str]): single key or list of keys to group by
             criteria (dict): mongo style query to reduce the docs to group
-            properties (str or [str]): properties to project
+            properties (str, [str] or dict): properties to project, or
+                a projection as in Collection.find
+
+        Returns:
+            iterator of grouped documents, with the structure:
+            {'_id': {"KEY_1": value_1, "KEY_2": value_2 ...,
+             'docs': [list_of_documents corresponding to key values]}
         """
         if isinstance(keys, str):
             keys = [keys]
+        if isinstance(properties, str):
+            properties = [properties]
+
+        stores = self._shard_stores(criteria)
+        if not stores:
+            return iter([])
+        if self._can_union(stores):
+            return self._union_groupby(stores, keys, criteria, properties, **kwargs)
+        return self._merge_groupby(stores, keys, criteria, properties, **kwargs)
+
+    @staticmethod
+    def _can_union(stores):
+        """
+        Whether the stores can be aggregated together with $unionWith
+        """
+        if not all(isinstance(store, Mongolike) and is_mongo_backed(store) for store in stores):
+            return False
+        first = stores[0]
+        # mongomock doesn't support $unionWith
+        if not isinstance(first.collection, Collection):
+            return False
+        if not all(share_database(first, store) for store in stores[1:]):
+            return False
+        version = first.collection.database.client.server_info()["version"]
+        return tuple(int(v) for v in version.split(".")[:2]) >= (4, 4)
+
+    @staticmethod
+    def _union_groupby(stores, keys, criteria, properties, allow_disk_use=True, **kwargs):
+        stages = _group_stages(criteria, properties)
+        pipeline = list(stages)
+        for store in stores[1:]:
+            pipeline.append({"$unionWith": {"coll": store.collection.name, "pipeline": stages}})
+        pipeline.append(_group_stage(keys))
+        return stores[0].collection.aggregate(pipeline, allowDiskUse=allow_disk_use)
+
+    def _merge_groupby(self, stores, keys, criteria, properties, **kwargs):
+        def sort_key(group):
+            return tuple(bson_sort_key(get(group["_id"], k)) for k in keys)
+
+        def sorted_groups(store):
+            if isinstance(store, Mongolike) and is_mongo_backed(store):
+                # Sorted on the server, where it may use the disk
+                pipeline = _group_stages(criteria, properties)
+                pipeline.append(_group_stage(keys))
+                pipeline.append({"$sort": {"_id.{}".format(k): 1 for k in keys}})
+                return store.collection.aggregate(pipeline, allowDiskUse=True)
+            groups = store.groupby(keys, criteria=criteria, properties=properties, **kwargs)
+            return iter(sorted(groups, key=sort_key))
+
+        num_workers = kwargs.pop("num_workers", self.num_workers)
+        if num_workers > 1:
+            groups = _merge_sorted(
+                [lambda store=store: sorted_groups(store) for store in stores], sort_key, num_workers
+            )
+        else:
+            groups = heapq.merge(*[sorted_groups(store) for store in stores], key=sort_key)
+
+        # Array values sort by their smallest element, so different groups
+        # can sort equal. The groups of a run of equal sort keys are merged
+        # by their whole ids
+        merged, merged_key = {}, None
+        for group in groups:
+            group_key = sort_key(group)
+            if group_key != merged_key:
+                for merged_group in merged.values():
+                    yield merged_group
+                merged, merged_key = {}, group_key
+            id_key = bson_compare_key(group["_id"])
+            if id_key in merged:
+                merged[id_key]["docs"].extend(group["docs"])
+            else:
+                merged[id_key] = {"_id": group["_id"], "docs": list(group["docs"])}
+        for merged_group in merged.values():
+            yield merged_group
 
-        docs = []
-        for store in self.stores:
-            temp_docs = list(
-                store.groupby(keys, criteria=criteria, properties=properties, **kwargs)
+
+class ShardedStore(ConcatStore):
+    """
+    Store partitioning documents over several stores, the shards, by a
+    consistent hash of Store.key
+    """
+
+    def __init__(self, shards, vnodes=256, num_workers=None, **kwargs):
+        """
+        Args:
+            shards ([Store]): stores holding the documents, all with the
+                same key as this store
+            vnodes (int): number of points of each shard on the hash ring
+            num_workers (int): number of shards queried or updated
+                concurrently, defaults to all of them
+        """
+        self.shards = list(shards)
+        self.vnodes = vnodes
+        super(ShardedStore, self).__init__(
+            *shards, num_workers=num_workers or len(shards), **kwargs
+        )
+        self.partition = ConsistentHashPartition(self.key, vnodes)
+
+    def add_shards(self, shards, rebalance=True, batch_size=1000):
+        """
+        Adds shards to this store. Documents are only moved from the
+        existing shards to the new ones
+
+        Args:
+            shards ([Store]): new shards, connected
+            rebalance (bool): whether to move the documents now assigned
+                to the new shards, see ShardedStore.rebalance
+            batch_size (int): number of documents moved at a time
+        """
+        self.shards.extend(shards)
+        self.stores = tuple(self.shards)
+        if rebalance:
+            return self.rebalance(batch_size=batch_size)
+
+    def rebalance(self, batch_size=1000):
+        """
+        Moves the documents that are not in the shard they are assigned to,
+        after adding shards. Documents are written to their new shard
+        before being removed from the former one, so rerunning an
+        interrupted rebalance completes it. Requires Mongo-backed shards
+
+        While a batch is moved, or after an interrupted rebalance, its
+        documents are in both shards and queries reading both return
+        them twice. Queries pinned to the partition key only read the
+        new shard, which has them from the start of the move
+
+        Args:
+            batch_size (int): number of documents moved at a time
+
+        Returns:
+            (int): number of documents moved
+        """
+        num_shards = len(self.stores)
+        moved = 0
+        for index, store in enumerate(self.stores):
+            # Keys are streamed, documents already read are only removed behind the cursor
+            misplaced = (
+                d[self.key]
+                for d in store.query(properties=[self.key])
+                if self.partition.shard_of(d[self.key], num_shards) != index
             )
-            for group in temp_docs:
-                docs.extend(group["docs"])
+            num_moved = 0
+            for keys in iter(lambda: list(islice(misplaced, batch_size)), []):
+                if not is_mongo_backed(store):
+                    raise StoreError("Can't remove documents from {}".format(store))
+                docs = list(store.query(criteria={self.key: {"$in": keys}}))
+                for d in docs:
+                    d.pop("_id", None)
+                # Keeps the last updated values of the moved documents
+                self.update(docs, update_lu=False, batch_size=batch_size)
+                store.collection.delete_many({self.key: {"$in": keys}})
+                num_moved += len(docs)
+            if num_moved:
+                self.logger.info("Moved {} documents from shard {}".format(num_moved, index))
+            moved += num_moved
+        return moved
+
+
+def _sort_key(sort):
+    """
+    Key function ordering documents like a mongo sort specification
+    """
+
+    def compare(d1, d2):
+        for key, direction in sort:
+            v1 = bson_sort_key(get(d1, key), reverse=direction < 0)
+            v2 = bson_sort_key(get(d2, key), reverse=direction < 0)
+            if v1 != v2:
+                return (-1 if v1 < v2 else 1) * (1 if direction > 0 else -1)
+        return 0
+
+    return cmp_to_key(compare)
+
+
+# Marks the end of the items produced by a thread
+_DONE = object()
 
-        def key_set(d):
-            "index function based on passed in keys"
-            test_d = tuple(d.get(k, "") for k in keys)
-            return test_d
 
-        for k, group in groupby(docs, key=key_set):
-            yield list(group)
+def _produce(func, items, stop):
+    """
+    Puts the items of the iterable returned by func on the items queue,
+    followed by _DONE or the exception raised, until stop is set
+    """
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for item in func():
+            if not put((item, None)):
+                return
+        put((_DONE, None))
+    except Exception as e:
+        put((_DONE, e))
+
+
+def _interleave(funcs, num_workers, buffer_size=1000):
+    """
+    Yields the items of the iterables returned by funcs, called on a pool
+    of num_workers threads, in the order they are produced
+    """
+    items = queue.Queue(buffer_size)
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(num_workers)
+    futures = []
+    try:
+        for func in funcs:
+            futures.append(executor.submit(_produce, func, items, stop))
+        remaining = len(funcs)
+        while remaining:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                remaining -= 1
+            else:
+                yield item
+    finally:
+        stop.set()
+        # Funcs that didn't start yet aren't called at all
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _merge_sorted(funcs, key, num_workers, buffer_size=1000):
+    """
+    Merges the sorted iterables returned by funcs into one sorted iterator.
+    A pool of num_workers threads reads them ahead in chunks of buffer_size
+    items, at most one chunk per iterable at a time, so the threads never
+    wait for the merge to consume items
+    """
+    executor = ThreadPoolExecutor(num_workers)
+    pending = set()
+
+    def chunks(func):
+        items = []
+
+        def next_chunk():
+            if not items:
+                items.append(iter(func()))
+            return list(islice(items[0], buffer_size))
+
+        return next_chunk
+
+    def submit(next_chunk):
+        future = executor.submit(next_chunk)
+        pending.add(future)
+        return future
+
+    def read_ahead(next_chunk, future):
+        while future is not None:
+            chunk = future.result()
+            pending.discard(future)
+            # A short chunk is the last one
+            future = submit(next_chunk) if len(chunk) == buffer_size else None
+            for item in chunk:
+                yield item
+
+    try:
+        # The first chunks of all the iterables are read at once
+        streams = [chunks(func) for func in funcs]
+        streams = [read_ahead(next_chunk, submit(next_chunk)) for next_chunk in streams]
+        for item in heapq.merge(*streams, key=key):
+            yield item
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _group_stages(criteria, properties):
+    """
+    Aggregation stages matching and projecting documents to group
+    """
+    stages = []
+    if criteria:
+        stages.append({"$match": criteria})
+    if isinstance(properties, str):
+        properties = [properties]
+    if isinstance(properties, list):
+        properties = {p: 1 for p in properties}
+    if properties:
+        stages.append({"$project": properties})
+    return stages
+
+
+def _group_stage(keys):
+    """
+    Aggregation stage grouping documents by keys, as in MongoStore.groupby
+    """
+    group_id = {}
+    for key in keys:
+        set_(group_id, key, "${}".format(key))
+    return {"$group": {"_id": group_id, "docs": {"$push": "$$ROOT"}}}
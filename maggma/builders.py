@@ -3,12 +3,29 @@
 Base Builder class to define how builders need to be defined
 """
 from abc import ABCMeta, abstractmethod
+import hashlib
+import json
 import logging
 import traceback
+from copy import copy
+from itertools import islice
 from datetime import datetime
 from monty.json import MSONable, MontyDecoder
-from maggma.utils import source_keys_updated, grouper, Timeout
-from time import time
+from maggma.utils import (
+    source_keys_updated,
+    server_side_keys_updated,
+    is_mongo_backed,
+    grouper,
+    Timeout,
+)
+from time import time, sleep
+
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+
+# Most keys updated at the watermark recorded in a checkpoint, beyond which
+# the documents updated at the watermark are all built again
+MAX_WATERMARK_KEYS = 10000
 
 
 class Builder(MSONable, metaclass=ABCMeta):
@@ -90,7 +107,7 @@ class Builder(MSONable, metaclass=ABCMeta):
         for store in self.sources + self.targets:
             try:
                 store.collection.database.client.close()
-            except AttributeError:
+            except (AttributeError, NotImplementedError):
                 continue
         # Runner will pass iterable yielded by `self.get_items` as `cursor`. If
         # this is a Mongo cursor with `no_cursor_timeout=True` (not the
@@ -150,6 +167,10 @@ class MapBuilder(Builder, metaclass=ABCMeta):
         delete_orphans=False,
         timeout=None,
         store_process_time=True,
+        server_side_diff=False,
+        checkpoint=None,
+        sanitize_items=False,
+        shard=None,
         **kwargs
     ):
         """
@@ -174,6 +195,25 @@ class MapBuilder(Builder, metaclass=ABCMeta):
             timeout (int): maximum running time per item in seconds
             store_process_time (bool): If True, add "_process_time" key to
             document for profiling purposes
+            server_side_diff (bool): Whether to find updated source documents
+                on the database server for Mongo-backed stores rather than
+                loading all target keys into memory. Keys are then streamed
+                to get_items as they are found. See
+                maggma.utils.server_side_keys_updated
+            checkpoint (Store): optional store to record the most recent
+                source lu_field seen by a completed run of this builder.
+                Incremental runs then only process source documents updated
+                after this watermark instead of diffing source and target.
+                Remove the builder's checkpoint document to force a full diff.
+            sanitize_items (bool): Whether to sanitize items with the target's
+                sanitizer in process_item, i.e. in the worker processes of a
+                parallel Runner, rather than all on the thread calling
+                target.update. Sanitizing again in update is then cheap, as
+                already safe documents are not copied.
+            shard (int): index of the only shard to build, for a source
+                partitioned over several stores, e.g. a ShardedStore, so
+                that builders running side by side each read and write
+                one shard. See MapBuilder.shard_builders
         """
         self.source = source
         self.target = target
@@ -186,8 +226,114 @@ class MapBuilder(Builder, metaclass=ABCMeta):
         self.total = None
         self.timeout = timeout
         self.store_process_time = store_process_time
+        self.server_side_diff = server_side_diff
+        self.checkpoint = checkpoint
+        self.sanitize_items = sanitize_items
+        self.shard = shard
+        self._watermark = None
+        self._watermark_keys = None
         super().__init__(sources=[source], targets=[target], **kwargs)
 
+    def connect(self):
+        super().connect()
+        if self.checkpoint:
+            self.checkpoint.connect()
+
+    @property
+    def checkpoint_id(self):
+        """
+        Identifier for this builder in the checkpoint store, based on
+        the builder class, source, target, query and shard
+        """
+        spec = [
+            self.__class__.__name__,
+            self.source.as_dict(),
+            self.target.as_dict(),
+            self.query,
+        ]
+        if self.shard is not None:
+            spec.append(self.shard)
+        spec = json.dumps(spec, sort_keys=True, default=str)
+        return hashlib.sha1(spec.encode()).hexdigest()
+
+    def get_checkpoint(self):
+        """
+        Returns the checkpoint document for this builder, e.g.
+        {"builder_id": ..., "watermark": datetime, "resume_token": ...},
+        or an empty dict if there is no checkpoint yet
+        """
+        if not self.checkpoint:
+            return {}
+        doc = self.checkpoint.query_one(
+            criteria={"builder_id": self.checkpoint_id},
+            sort=[(self.checkpoint.lu_field, -1)],
+        )
+        return doc or {}
+
+    def set_checkpoint(self, **fields):
+        """
+        Updates fields of the checkpoint document for this builder,
+        e.g. watermark or resume_token
+        """
+        doc = self.get_checkpoint()
+        doc.pop("_id", None)
+        doc.update(fields)
+        doc["builder_id"] = self.checkpoint_id
+        self.checkpoint.update([doc], key="builder_id")
+
+    @property
+    def streams_keys(self):
+        """
+        Whether get_items streams updated keys from the database server,
+        in which case the total number of items is not known in advance.
+        """
+        return all(
+            self.server_side_diff and is_mongo_backed(source) and is_mongo_backed(target)
+            for source, target in self.shard_pairs()
+        )
+
+    def shard_pairs(self):
+        """
+        Pairs of source and target stores to build from and into. For a
+        source partitioned over several stores, like a ShardedStore, built
+        into a target partitioned the same way, or when building a single
+        shard, one pair for each shard built. Otherwise the source and
+        target themselves
+        """
+        source, target = self.source, self.target
+        if getattr(source, "partition", None) is None:
+            if self.shard is not None:
+                raise ValueError(
+                    "Can't build shard {} of a source without a partition".format(self.shard)
+                )
+            return [(source, target)]
+
+        aligned = (
+            getattr(target, "partition", None) is not None
+            and len(target.stores) == len(source.stores)
+            and target.partition.as_dict() == source.partition.as_dict()
+        )
+        if self.shard is not None:
+            return [(source.stores[self.shard], target.stores[self.shard] if aligned else target)]
+        if aligned:
+            return list(zip(source.stores, target.stores))
+        return [(source, target)]
+
+    def shard_builders(self):
+        """
+        Returns ([MapBuilder]): one copy of this builder for each shard of
+            its partitioned source, to run side by side, e.g. in separate
+            processes or jobs
+        """
+        if getattr(self.source, "partition", None) is None:
+            raise ValueError("Can't build the shards of a source without a partition")
+        builders = []
+        for shard in range(len(self.source.stores)):
+            builder = copy(self)
+            builder.shard = shard
+            builders.append(builder)
+        return builders
+
     def ensure_indexes(self):
 
         index_checks = [
@@ -212,32 +358,237 @@ class MapBuilder(Builder, metaclass=ABCMeta):
 
         self.ensure_indexes()
 
-        if self.incremental:
-            keys = source_keys_updated(
-                source=self.source, target=self.target, query=self.query
+        checkpoint = self.get_checkpoint()
+        watermark = checkpoint.get("watermark")
+        if self.checkpoint:
+            # Recorded in finalize, once every item of this run is built
+            self._watermark = self.source.last_updated
+            self._watermark_keys = self._keys_updated_at(self._watermark)
+
+        # Each chunk of items comes from a single shard of the source
+        shard_keys = [
+            (
+                source,
+                self._keys_to_build(
+                    source, target, watermark, checkpoint.get("watermark_keys")
+                ),
             )
-        else:
-            keys = self.source.distinct(self.source.key, self.query)
+            for source, target in self.shard_pairs()
+        ]
+        if not (self.incremental and not watermark and self.streams_keys):
+            self.total = sum(len(keys) for _, keys in shard_keys)
+
+        for source, keys in shard_keys:
+            for chunked_keys in grouper(keys, self.chunk_size, None):
+                chunked_keys = list(filter(None.__ne__, chunked_keys))
+                for doc in list(self._query_keys(chunked_keys, source)):
+                    yield doc
 
-        self.logger.info("Processing {} items".format(len(keys)))
+    def _keys_to_build(self, source, target, watermark, built=None):
+        """
+        Keys of the source documents to build into target, from the
+        checkpoint watermark and the keys already built at it if given
+        """
+        if self.incremental and watermark:
+            keys = source.distinct(source.key, self._updated_since(watermark, built))
+            self.logger.info(
+                "Processing {} items updated since {}".format(len(keys), watermark)
+            )
+        elif self.incremental and self.streams_keys:
+            # Fetch documents for keys while the diff is still running
+            keys = server_side_keys_updated(
+                source=source, target=target, query=self.query
+            )
+            self.logger.info("Processing items as updated keys are found")
+        else:
+            if self.incremental:
+                keys = source_keys_updated(
+                    source=source, target=target, query=self.query
+                )
+            else:
+                keys = source.distinct(source.key, self.query)
+            self.logger.info("Processing {} items".format(len(keys)))
+        return keys
 
+    def _query_keys(self, keys, source=None):
+        """
+        Queries the source, or one of its shards, for documents with the
+        given keys, using the projection of this builder
+        """
+        source = source or self.source
         if self.projection:
             projection = list(
-                set(self.projection + [self.source.key, self.source.lu_field])
+                set(self.projection + [source.key, source.lu_field])
             )
         else:
             projection = None
 
-        self.total = len(keys)
-        for chunked_keys in grouper(keys, self.chunk_size, None):
-            chunked_keys = list(filter(None.__ne__, chunked_keys))
-            for doc in list(
-                self.source.query(
-                    criteria={self.source.key: {"$in": chunked_keys}},
-                    properties=projection,
+        return source.query(
+            criteria={source.key: {"$in": keys}}, properties=projection
+        )
+
+    def _updated_since(self, watermark, built=None):
+        """
+        Source criteria for documents in the query updated at or after
+        watermark, except the documents updated at watermark with a key in
+        built. Documents can be written after the watermark was read with
+        the same lu_field, so only the keys known to be built are skipped
+        """
+        source = self.source
+        lu = source.lu_func[1](watermark)
+        lu_filter = {source.lu_field: {"$gte": lu}}
+        if built:
+            lu_filter = {
+                "$or": [
+                    {source.lu_field: {"$gt": lu}},
+                    {source.lu_field: lu, source.key: {"$nin": list(built)}},
+                ]
+            }
+        return {"$and": [self.query, lu_filter]} if self.query else lu_filter
+
+    def _keys_updated_at(self, watermark):
+        """
+        Keys of the source documents in the query updated at watermark, None
+        if there are more than MAX_WATERMARK_KEYS of them
+        """
+        source = self.source
+        criteria = {source.lu_field: source.lu_func[1](watermark)}
+        if self.query:
+            criteria = {"$and": [self.query, criteria]}
+        docs = source.query(criteria=criteria, properties=[source.key])
+        keys = [d[source.key] for d in islice(docs, MAX_WATERMARK_KEYS + 1)]
+        return keys if len(keys) <= MAX_WATERMARK_KEYS else None
+
+    def watch(self, poll_interval=1, max_batches=None):
+        """
+        Continuously build source documents as they are inserted or updated,
+        instead of running periodic incremental builds. Tails a MongoDB change
+        stream on the source if it supports one (replica sets only) and
+        otherwise polls the source for documents with a newer lu_field,
+        starting from the checkpoint watermark or target.last_updated.
+
+        Changed keys are micro-batched, up to chunk_size at a time, into
+        process_item and update_targets. With a checkpoint store, the change
+        stream resume token or the polling watermark is recorded after each
+        batch so that watching resumes where it left off.
+
+        Args:
+            poll_interval (float): seconds to wait for changes before building
+                a partial batch or polling the source again
+            max_batches (int): number of batches to build before returning,
+                runs until interrupted if None
+        """
+        self.connect()
+        self.ensure_indexes()
+
+        try:
+            batches = self._change_stream_batches(poll_interval)
+        except (NotImplementedError, OperationFailure) as e:
+            self.logger.info(
+                "No change stream on source ({}), polling every {} s".format(
+                    e, poll_interval
+                )
+            )
+            batches = self._polled_batches(poll_interval)
+
+        try:
+            for n, (keys, checkpoint_fields) in enumerate(batches, 1):
+                self.logger.info(
+                    "Processing batch of {} changed items".format(len(keys))
                 )
-            ):
-                yield doc
+                items = [self.process_item(item) for item in self._query_keys(keys)]
+                self.update_targets(items)
+                if self.checkpoint and checkpoint_fields:
+                    self.set_checkpoint(**checkpoint_fields)
+                if max_batches and n >= max_batches:
+                    break
+        finally:
+            batches.close()
+
+    def _change_stream_batches(self, poll_interval):
+        """
+        Opens a change stream on the source and returns a generator of
+        (keys, checkpoint fields) batches from it. Raises NotImplementedError
+        if the source is not a pymongo collection.
+        """
+        if not isinstance(self.source.collection, Collection):
+            raise NotImplementedError("source is not a MongoDB collection")
+
+        key = self.source.key
+        pipeline = [
+            {"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}},
+            {"$project": {"fullDocument.{}".format(key): 1}},
+        ]
+        stream = self.source.collection.watch(
+            pipeline,
+            full_document="updateLookup",
+            resume_after=self.get_checkpoint().get("resume_token"),
+            max_await_time_ms=int(poll_interval * 1000),
+        )
+
+        def batches():
+            with stream:
+                keys = set()
+                while stream.alive:
+                    change = stream.try_next()
+                    if change is not None:
+                        # fullDocument is None if the doc was deleted since
+                        doc = change.get("fullDocument") or {}
+                        if key in doc:
+                            keys.add(doc[key])
+                    if keys and (change is None or len(keys) >= self.chunk_size):
+                        yield list(keys), {"resume_token": stream.resume_token}
+                        keys = set()
+
+        return batches()
+
+    def _polled_batches(self, poll_interval):
+        """
+        Generator of (keys, checkpoint fields) batches from polling the
+        source for documents updated at or after the last seen lu_field.
+        Documents are read in lu_field order, so that every batch advances
+        the watermark
+        """
+        source = self.source
+        checkpoint = self.get_checkpoint()
+        watermark = checkpoint.get("watermark") or self.target.last_updated
+        # Documents can be written later with the same lu_field as the
+        # watermark, so polls include it and skip the keys already built at it
+        built = set(checkpoint.get("watermark_keys") or [])
+        while True:
+            docs = source.query(
+                criteria=self._updated_since(watermark),
+                properties=[source.key, source.lu_field],
+                sort=[(source.lu_field, 1)],
+            )
+            keys, found = [], False
+            for d in docs:
+                lu = source.lu_func[0](d[source.lu_field])
+                if lu == watermark and d[source.key] in built:
+                    continue
+                if lu != watermark:
+                    watermark, built = lu, set()
+                built.add(d[source.key])
+                keys.append(d[source.key])
+                found = True
+                if len(keys) >= self.chunk_size:
+                    yield keys, self._watermark_fields(watermark, built)
+                    keys = []
+            if keys:
+                yield keys, self._watermark_fields(watermark, built)
+            if not found:
+                sleep(poll_interval)
+
+    @staticmethod
+    def _watermark_fields(watermark, built):
+        """
+        Checkpoint fields of a watermark and the keys built at it, which
+        aren't recorded if there are more than MAX_WATERMARK_KEYS of them
+        """
+        return {
+            "watermark": watermark,
+            "watermark_keys": list(built) if len(built) <= MAX_WATERMARK_KEYS else None,
+        }
 
     def process_item(self, item):
 
@@ -264,6 +615,8 @@ class MapBuilder(Builder, metaclass=ABCMeta):
             out["_process_time"] = time_end - time_start
 
         out.update(processed)
+        if self.sanitize_items:
+            out = self.target.sanitize(out, allow_bson=True)
         return out
 
     def update_targets(self, items):
@@ -298,6 +651,12 @@ class MapBuilder(Builder, metaclass=ABCMeta):
                 self.target.collection.delete_many(
                     {self.target.key: {"$in": to_delete}}
                 )
+        if self.checkpoint:
+            if self._watermark and self._watermark > datetime.min:
+                self.set_checkpoint(
+                    watermark=self._watermark, watermark_keys=self._watermark_keys
+                )
+            self.checkpoint.close()
         super().finalize(cursor)
 
 
@@ -325,8 +684,22 @@ class GroupBuilder(MapBuilder, metaclass=ABCMeta):
         super().__init__(source, target, query=query, **kwargs)
         self.total = None
 
+    def watch(self, poll_interval=1, max_batches=None):
+        """
+        Not supported, changes are built one document at a time while a
+        GroupBuilder processes groups. Run incremental builds instead
+        """
+        raise NotImplementedError(
+            "{} builds groups and can't watch the source".format(self.__class__.__name__)
+        )
+
     def get_items(self):
-        criteria = source_keys_updated(self.source, self.target, query=self.query)
+        criteria = source_keys_updated(
+            self.source,
+            self.target,
+            query=self.query,
+            server_side=self.server_side_diff,
+        )
         if all(isinstance(entry, str) for entry in self.grouping_properties()):
             properties = {entry: 1 for entry in self.grouping_properties()}
             if "_id" not in properties:
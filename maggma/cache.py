@@ -0,0 +1,156 @@
+# coding: utf-8
+"""
+A local disk cache for Stores that keep documents as blobs on a remote
+backend, such as GridFSStore and AmazonS3Store. Blobs are cached as
+stored, keyed by the document key and a version that changes whenever
+the blob does, such as the upload date of a GridFS file or the ETag of
+an S3 object, so a new version of a document never reads a stale blob.
+
+Entries are written atomically and evicted by least recent use, so the
+same cache directory can be shared by several processes, e.g. the
+workers of a MultiprocProcessor or several builders of a Runner.
+"""
+
+import hashlib
+import os
+import tempfile
+
+
+class DiskCache:
+    """
+    Size-bounded least recently used cache of blobs in a local directory
+    """
+
+    def __init__(self, path, max_size=2 ** 30):
+        """
+        Args:
+            path (str): directory of the cache, created if needed
+            max_size (int): size in bytes above which the least recently
+                used blobs are evicted
+        """
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Size of the cache at the last scan, and bytes put since then.
+        # Other processes put blobs too, so the cache is rescanned after
+        # every tenth of max_size put by this one
+        self._size = None
+        self._added = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _path(self, key, version):
+        digest = hashlib.blake2b(repr((key, version)).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def get(self, key, version):
+        """
+        Returns (bytes): the cached blob of a document version, None if
+            not cached
+
+        Args:
+            key: value of the document key
+            version: value identifying the version of the blob
+        """
+        path = self._path(key, version)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        # The modification time orders the blobs for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key, version, data):
+        """
+        Caches the blob of a document version, evicting the least recently
+        used blobs if the cache grows over max_size
+
+        Args:
+            key: value of the document key
+            version: value identifying the version of the blob
+            data (bytes): blob to cache
+        """
+        if len(data) > self.max_size:
+            return
+
+        path = self._path(key, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=self.path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        self._added += len(data)
+        if (
+            self._size is None
+            or self._size + self._added > self.max_size
+            or self._added > 0.1 * self.max_size
+        ):
+            self.evict()
+
+    def evict(self, target_size=None):
+        """
+        Removes the least recently used blobs if the cache is larger than
+        target_size, until it is within target_size
+
+        Args:
+            target_size (int): size in bytes to evict down to, by default
+                the cache is evicted down to 90% of max_size once larger
+                than max_size, so evictions don't happen on every put
+        """
+        entries = self._scan()
+        size = sum(entry[1] for entry in entries)
+        if size > (self.max_size if target_size is None else target_size):
+            target_size = 0.9 * self.max_size if target_size is None else target_size
+            for _, entry_size, path in sorted(entries):
+                # Another process may have evicted it already
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= entry_size
+                if size <= target_size:
+                    break
+        self._size, self._added = size, 0
+
+    def _scan(self):
+        """
+        Returns ([(float, int, str)]): modification time, size and path
+            of each cached blob
+        """
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.startswith(".tmp-"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def clear(self):
+        """
+        Removes all the cached blobs
+        """
+        self.evict(0)
+
+    @property
+    def stats(self):
+        """
+        Hits and misses of this process, and the size of the cache in
+        bytes as last seen by this process
+        """
+        if self._size is None:
+            self._size = sum(entry[1] for entry in self._scan())
+        return {"hits": self.hits, "misses": self.misses, "size": self._size + self._added}
@@ -0,0 +1,178 @@
+# coding: utf-8
+"""
+Compression codecs for Stores that keep documents as blobs, such as
+GridFSStore and AmazonS3Store. The codec name is recorded in the
+"compression" metadata of each blob, so data compressed with any
+registered codec can be read back regardless of the Store's setting.
+"""
+
+from abc import ABC, abstractmethod
+import zlib
+
+try:
+    import zstandard
+
+    zstd_import = True
+except ImportError:
+    zstd_import = False
+
+try:
+    import lz4.frame
+
+    lz4_import = True
+except ImportError:
+    lz4_import = False
+
+
+class Codec(ABC):
+    """
+    A compression codec, compressing and decompressing bytes
+    """
+
+    def __init__(self, level=None, dictionary=None):
+        """
+        Args:
+            level (int): compression level, None for the codec default
+            dictionary (bytes): trained compression dictionary, for
+                codecs that support one
+        """
+        self.level = level
+        self.dictionary = dictionary
+
+    @abstractmethod
+    def compress(self, data):
+        """
+        Returns (bytes): compressed data
+        """
+        return NotImplementedError
+
+    @abstractmethod
+    def decompress(self, data):
+        """
+        Returns (bytes): decompressed data
+        """
+        return NotImplementedError
+
+
+class NoCodec(Codec):
+    """
+    Leaves data uncompressed
+    """
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+
+class ZlibCodec(Codec):
+    """
+    zlib compression, readable without any optional dependency
+    """
+
+    def compress(self, data):
+        return zlib.compress(data, -1 if self.level is None else self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class ZstdCodec(Codec):
+    """
+    Zstandard compression, optionally with a trained dictionary which
+    must then also be given to read the data back
+    """
+
+    def __init__(self, level=None, dictionary=None):
+        if not zstd_import:
+            raise ValueError("zstandard not available, please install zstandard to use zstd compression")
+        super(ZstdCodec, self).__init__(level=level, dictionary=dictionary)
+        self._dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+
+    # zstandard compressors can't be shared between threads, so
+    # stores reading or writing concurrently need one per call
+    def compress(self, data):
+        level = 3 if self.level is None else self.level
+        return zstandard.ZstdCompressor(level=level, dict_data=self._dict_data).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor(dict_data=self._dict_data).decompress(data)
+
+
+class LZ4Codec(Codec):
+    """
+    LZ4 frame compression, fast at the cost of compression ratio
+    """
+
+    def __init__(self, level=None, dictionary=None):
+        if not lz4_import:
+            raise ValueError("lz4 not available, please install lz4 to use lz4 compression")
+        super(LZ4Codec, self).__init__(level=level, dictionary=dictionary)
+
+    def compress(self, data):
+        return lz4.frame.compress(data, compression_level=self.level or 0)
+
+    def decompress(self, data):
+        return lz4.frame.decompress(data)
+
+
+CODECS = {"none": NoCodec, "zlib": ZlibCodec, "zstd": ZstdCodec, "lz4": LZ4Codec}
+
+
+def register_codec(name, codec_class):
+    """
+    Registers a Codec subclass under a name to use in Store compression
+    settings and metadata
+
+    Args:
+        name (str): name recorded in the compression metadata
+        codec_class (type): Codec subclass
+    """
+    CODECS[name] = codec_class
+
+
+def get_codec(compression, level=None, dictionary=None):
+    """
+    Gets a codec from a Store compression setting
+
+    Args:
+        compression (str or bool): codec name, True for zlib and
+            False or None for no compression
+        level (int): compression level
+        dictionary (bytes): trained compression dictionary
+
+    Returns:
+        (name, Codec): name to record in metadata, None when
+            uncompressed, and the codec
+    """
+    if compression is True:
+        compression = "zlib"
+    if not compression or compression == "none":
+        return None, NoCodec()
+    if compression not in CODECS:
+        raise ValueError(
+            "Unknown compression {}, available codecs are {}".format(
+                compression, ", ".join(sorted(CODECS))
+            )
+        )
+    return compression, CODECS[compression](level=level, dictionary=dictionary)
+
+
+def decompress(data, compression, codecs=None):
+    """
+    Decompresses data according to its compression metadata
+
+    Args:
+        data (bytes): compressed data
+        compression (str): codec name recorded with the data, None
+            or "none" if uncompressed
+        codecs (dict): cache of codecs by name, also used to provide
+            codecs configured with a dictionary
+    """
+    if not compression or compression == "none":
+        return data
+    codecs = {} if codecs is None else codecs
+    if compression not in codecs:
+        codecs[compression] = get_codec(compression)[1]
+    return codecs[compression].decompress(data)
@@ -0,0 +1,242 @@
+# coding: utf-8
+"""
+Partitions assigning documents to the member stores of a partitioned
+store, such as ConcatStore, by the value of a partition key. They are
+used to route updates, and to only query the stores that can hold the
+documents matching some criteria.
+"""
+
+import hashlib
+from abc import ABCMeta, abstractmethod
+from bisect import bisect_left, bisect_right
+
+from monty.json import MSONable
+from pydash import get, has
+
+from maggma.stores import StoreError
+from maggma.utils import is_regex
+
+
+class Partition(MSONable, metaclass=ABCMeta):
+    """
+    Assigns documents to one of a number of shards by the value of a key
+    """
+
+    def __init__(self, key):
+        """
+        Args:
+            key (str): partition key, can be a dotted key
+        """
+        self.key = key
+
+    @abstractmethod
+    def shard_of(self, value, num_shards):
+        """
+        Returns (int): index of the shard holding documents with a
+            partition key value
+
+        Args:
+            value: partition key value
+            num_shards (int): number of shards
+        """
+        return NotImplementedError
+
+    def shard(self, doc, num_shards):
+        """
+        Returns (int): index of the shard holding a document
+
+        Args:
+            doc (dict): document, which must have the partition key
+            num_shards (int): number of shards
+        """
+        if not has(doc, self.key):
+            raise StoreError("Document is missing the partition key {}".format(self.key))
+        value = get(doc, self.key)
+        # Queries match arrays by their elements, which can be in any shard
+        if isinstance(value, (dict, list)):
+            raise StoreError(
+                "Partition key {} can't be an array or a document: {}".format(self.key, value)
+            )
+        return self.shard_of(value, num_shards)
+
+    def shards(self, criteria, num_shards):
+        """
+        Returns ([int]): indexes of the shards that may hold documents
+            matching criteria, None if the criteria don't pin the
+            partition key
+
+        Args:
+            criteria (dict): mongo style query
+            num_shards (int): number of shards
+        """
+        values = self.pinned_values(criteria)
+        if values is None:
+            return None
+        return sorted(set(self.shard_of(value, num_shards) for value in values))
+
+    def pinned_values(self, criteria):
+        """
+        Returns (list): the partition key values that documents matching
+            criteria can have, None if any value can match
+
+        Args:
+            criteria (dict): mongo style query
+        """
+        criteria = criteria or {}
+        if self.key not in criteria:
+            return None
+        condition = criteria[self.key]
+        if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+            if "$eq" in condition:
+                values = [condition["$eq"]]
+            elif "$in" in condition:
+                values = list(condition["$in"])
+            else:
+                return None
+        else:
+            values = [condition]
+        # Regular expressions, documents and arrays don't pin a single value
+        if any(isinstance(v, (dict, list)) or is_regex(v) for v in values):
+            return None
+        return values
+
+
+class HashPartition(Partition):
+    """
+    Spreads documents evenly over the shards by a hash of the partition
+    key, stable between processes
+    """
+
+    def shard_of(self, value, num_shards):
+        return stable_hash(value) % num_shards
+
+
+class ConsistentHashPartition(Partition):
+    """
+    Assigns documents to the shards by a hash of the partition key on a
+    ring of virtual nodes, so that adding a shard only moves documents
+    to the new shard, about 1 / num_shards of them
+    """
+
+    def __init__(self, key, vnodes=256):
+        """
+        Args:
+            key (str): partition key, can be a dotted key
+            vnodes (int): number of points of each shard on the ring,
+                more points spread the documents more evenly
+        """
+        self.vnodes = vnodes
+        self._rings = {}
+        super(ConsistentHashPartition, self).__init__(key)
+
+    def _ring(self, num_shards):
+        """
+        Sorted hashes of the ring points and their shards
+        """
+        if num_shards not in self._rings:
+            points = sorted(
+                (stable_hash("{}:{}".format(shard, vnode)), shard)
+                for shard in range(num_shards)
+                for vnode in range(self.vnodes)
+            )
+            self._rings[num_shards] = ([p[0] for p in points], [p[1] for p in points])
+        return self._rings[num_shards]
+
+    def shard_of(self, value, num_shards):
+        hashes, shards = self._ring(num_shards)
+        return shards[bisect_right(hashes, stable_hash(value)) % len(hashes)]
+
+
+class RangePartition(Partition):
+    """
+    Assigns contiguous ranges of partition key values to the shards
+    """
+
+    def __init__(self, key, bounds):
+        """
+        Args:
+            key (str): partition key, can be a dotted key
+            bounds (list): sorted lower bounds of the shards after the
+                first, one fewer than the number of shards
+        """
+        self.bounds = bounds
+        super(RangePartition, self).__init__(key)
+
+    def _check_bounds(self, num_shards):
+        if len(self.bounds) != num_shards - 1:
+            raise StoreError(
+                "RangePartition has {} bounds for {} shards".format(len(self.bounds), num_shards)
+            )
+
+    def shard_of(self, value, num_shards):
+        self._check_bounds(num_shards)
+        try:
+            return bisect_right(self.bounds, value)
+        except TypeError:
+            raise StoreError(
+                "{} value {} can't be compared to the RangePartition bounds".format(self.key, value)
+            )
+
+    def shards(self, criteria, num_shards):
+        self._check_bounds(num_shards)
+        values = self.pinned_values(criteria)
+        condition = (criteria or {}).get(self.key)
+        try:
+            if values is not None:
+                return sorted(set(bisect_right(self.bounds, value) for value in values))
+            if not isinstance(condition, dict):
+                return None
+
+            # Range conditions select a contiguous range of shards
+            first, last = 0, num_shards - 1
+            for op, value in condition.items():
+                if op in ("$gt", "$gte"):
+                    first = max(first, bisect_right(self.bounds, value))
+                elif op == "$lt":
+                    last = min(last, bisect_left(self.bounds, value))
+                elif op == "$lte":
+                    last = min(last, bisect_right(self.bounds, value))
+        except TypeError:
+            # Values that can't be compared to the bounds don't narrow the shards
+            return None
+        if (first, last) == (0, num_shards - 1):
+            return None
+        return list(range(first, last + 1))
+
+
+class FieldPartition(Partition):
+    """
+    Assigns documents to the shards by the value of a categorical field
+    """
+
+    def __init__(self, key, values):
+        """
+        Args:
+            key (str): partition key, can be a dotted key
+            values (dict): shard index of each partition key value
+        """
+        self.values = values
+        super(FieldPartition, self).__init__(key)
+
+    def shard_of(self, value, num_shards):
+        if value not in self.values:
+            raise StoreError("No shard for {} value {}".format(self.key, value))
+        return self.values[value]
+
+    def shards(self, criteria, num_shards):
+        values = self.pinned_values(criteria)
+        if values is None:
+            return None
+        # Values without a shard match no document
+        return sorted(set(self.values[value] for value in values if value in self.values))
+
+
+def stable_hash(value):
+    """
+    Returns (int): 64-bit hash of a value, the same in every process
+        unlike the built-in hash. Numbers that compare equal hash equal
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    digest = hashlib.blake2b(repr(value).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
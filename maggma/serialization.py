@@ -0,0 +1,219 @@
+# coding: utf-8
+"""
+Serialization formats for Stores that keep documents as blobs, such as
+GridFSStore and AmazonS3Store. The format name is recorded in the
+"serialization" metadata of each blob, blobs without it are JSON.
+
+The binary formats keep numeric NumPy arrays as contiguous buffers
+instead of converting them to lists, and keep datetimes, bytes and
+ObjectIds as such.
+"""
+
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+import json
+
+from bson import BSON
+from bson.objectid import ObjectId
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import msgpack
+
+    msgpack_import = True
+except ImportError:
+    msgpack_import = False
+
+
+class Serializer(ABC):
+    """
+    Converts documents to bytes and back
+    """
+
+    @abstractmethod
+    def dumps(self, doc, sanitize):
+        """
+        Args:
+            doc (dict): document to serialize
+            sanitize (callable): function making objects that the format
+                can't represent safe, called as sanitize(obj, allow_bson=...)
+
+        Returns (bytes): serialized document
+        """
+        return NotImplementedError
+
+    @abstractmethod
+    def loads(self, data):
+        """
+        Returns (dict): document deserialized from data
+        """
+        return NotImplementedError
+
+
+class JSONSerializer(Serializer):
+    """
+    JSON, with arrays converted to lists by the sanitizer
+    """
+
+    def dumps(self, doc, sanitize):
+        return json.dumps(sanitize(doc)).encode("UTF-8")
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class BSONSerializer(Serializer):
+    """
+    BSON, with numeric arrays stored as binary data
+    """
+
+    def dumps(self, doc, sanitize):
+        return BSON.encode(_prepare(doc, sanitize, _array_to_dict))
+
+    def loads(self, data):
+        return _restore(BSON(data).decode())
+
+
+class MsgpackSerializer(Serializer):
+    """
+    msgpack, with numeric arrays, datetimes and ObjectIds as ext types
+    """
+
+    def __init__(self):
+        if not msgpack_import:
+            raise ValueError("msgpack not available, please install msgpack to use msgpack serialization")
+
+    def dumps(self, doc, sanitize):
+        return msgpack.packb(
+            _prepare(doc, sanitize, _array_to_ext), default=_to_ext, use_bin_type=True
+        )
+
+    def loads(self, data):
+        return msgpack.unpackb(data, ext_hook=_from_ext, raw=False)
+
+
+SERIALIZERS = {"json": JSONSerializer, "bson": BSONSerializer, "msgpack": MsgpackSerializer}
+
+
+def register_serializer(name, serializer_class):
+    """
+    Registers a Serializer subclass under a name to use in Store
+    serialization settings and metadata
+
+    Args:
+        name (str): name recorded in the serialization metadata
+        serializer_class (type): Serializer subclass
+    """
+    SERIALIZERS[name] = serializer_class
+
+
+def get_serializer(serialization=None):
+    """
+    Gets a serializer by name
+
+    Args:
+        serialization (str): serializer name, None for JSON
+    """
+    serialization = serialization or "json"
+    if serialization not in SERIALIZERS:
+        raise ValueError(
+            "Unknown serialization {}, available formats are {}".format(
+                serialization, ", ".join(sorted(SERIALIZERS))
+            )
+        )
+    return SERIALIZERS[serialization]()
+
+
+# Types the binary formats represent directly
+_NATIVE_TYPES = (str, int, float, bool, type(None), bytes, datetime, ObjectId)
+
+_EXT_NDARRAY = 1
+_EXT_DATETIME = 2
+_EXT_OBJECTID = 3
+
+
+def _prepare(obj, sanitize, encode_array):
+    """
+    Copy of obj with numeric arrays encoded by encode_array, and other
+    objects outside of the native types passed through sanitize
+    """
+    if isinstance(obj, dict):
+        return {
+            k if isinstance(k, str) else str(k): _prepare(v, sanitize, encode_array)
+            for k, v in obj.items()
+        }
+    if isinstance(obj, (list, tuple)):
+        return [_prepare(v, sanitize, encode_array) for v in obj]
+    if isinstance(obj, _NATIVE_TYPES):
+        return obj
+    if np is not None and isinstance(obj, np.ndarray):
+        if obj.dtype.kind in "biufc":
+            return encode_array(np.ascontiguousarray(obj))
+        return _prepare(obj.tolist(), sanitize, encode_array)
+    if np is not None and isinstance(obj, np.generic):
+        return _prepare(obj.item(), sanitize, encode_array)
+    return _prepare(sanitize(obj, allow_bson=True), sanitize, encode_array)
+
+
+def _array_to_dict(a):
+    return {"@ndarray": {"dtype": a.dtype.str, "shape": list(a.shape), "data": a.tobytes()}}
+
+
+def _restore(obj):
+    """Converts the array dicts of a decoded BSON document back to arrays"""
+    if isinstance(obj, dict):
+        if "@ndarray" in obj and len(obj) == 1:
+            a = obj["@ndarray"]
+            return np.frombuffer(a["data"], dtype=a["dtype"]).reshape(a["shape"]).copy()
+        return {k: _restore(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_restore(v) for v in obj]
+    return obj
+
+
+def _array_to_ext(a):
+    header = msgpack.packb([a.dtype.str, list(a.shape)])
+    return msgpack.ExtType(_EXT_NDARRAY, header + a.tobytes())
+
+
+def _to_ext(obj):
+    if isinstance(obj, datetime):
+        # Timezone aware datetimes are stored in UTC and read back naive, as in BSON
+        if obj.utcoffset() is not None:
+            obj = (obj - obj.utcoffset()).replace(tzinfo=None)
+        return msgpack.ExtType(_EXT_DATETIME, obj.isoformat().encode())
+    if isinstance(obj, ObjectId):
+        return msgpack.ExtType(_EXT_OBJECTID, obj.binary)
+    raise TypeError("Can't serialize {} with msgpack".format(type(obj)))
+
+
+def _from_ext(code, data):
+    if code == _EXT_NDARRAY:
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(data)
+        dtype, shape = next(unpacker)
+        buffer = data[unpacker.tell():]
+        return np.frombuffer(buffer, dtype=dtype).reshape(shape).copy()
+    if code == _EXT_DATETIME:
+        return _parse_datetime(data.decode())
+    if code == _EXT_OBJECTID:
+        return ObjectId(data)
+    return msgpack.ExtType(code, data)
+
+
+def _parse_datetime(text):
+    """
+    Naive UTC datetime of an isoformat string, with or without a UTC offset
+    as written for timezone aware datetimes by earlier versions
+    """
+    offset = timedelta(0)
+    if len(text) > 19 and text[-6] in "+-":
+        sign = -1 if text[-6] == "-" else 1
+        offset = sign * timedelta(hours=int(text[-5:-3]), minutes=int(text[-2:]))
+        text = text[:-6]
+    dt = datetime.strptime(text, "%Y-%m-%dT%H:%M:%S.%f" if "." in text else "%Y-%m-%dT%H:%M:%S")
+    return dt - offset
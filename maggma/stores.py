@@ -8,23 +8,57 @@ from abc import ABCMeta, abstractmethod
 import copy
 from datetime import datetime
 import json
-import zlib
+import time
 import logging
+import operator
+import os
+import mmap
+import struct
+import hashlib
+import heapq
 
 import mongomock
 import pymongo
 import gridfs
-from itertools import groupby
+from itertools import groupby, islice
 from operator import itemgetter
+from bisect import bisect_left, bisect_right
+from copy import deepcopy
 from pymongo import MongoClient
-from pydash import identity, set_
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pydash import identity, set_, get, has, unset
+from mongomock.filtering import filter_applies
 
 from pymongo import ReplaceOne
+from pymongo.results import BulkWriteResult
+from bson import BSON, json_util
+from bson.objectid import ObjectId
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from monty.json import MSONable, jsanitize, MontyDecoder
+from monty.json import MSONable, MontyDecoder
 from monty.io import zopen
 from monty.serialization import loadfn
-from maggma.utils import LU_KEY_ISOFORMAT, confirm_field_index, source_keys_updated
+from tqdm import tqdm
+try:
+    import numpy as np
+
+    numpy_import = True
+except ImportError:
+    numpy_import = False
+
+from maggma.cache import DiskCache
+from maggma.compression import get_codec, decompress
+from maggma.serialization import get_serializer
+from maggma.utils import (
+    LU_KEY_ISOFORMAT,
+    confirm_field_index,
+    source_keys_updated,
+    fast_jsanitize,
+    is_regex,
+    iter_json,
+    threaded_imap,
+)
 
 
 class Store(MSONable, metaclass=ABCMeta):
@@ -34,13 +68,22 @@ class Store(MSONable, metaclass=ABCMeta):
     """
 
     def __init__(
-        self, key="task_id", lu_field="last_updated", lu_type="datetime", validator=None
+        self,
+        key="task_id",
+        lu_field="last_updated",
+        lu_type="datetime",
+        validator=None,
+        sanitizer=None,
     ):
         """
         Args:
             key (str): master key to index on
             lu_field (str): 'last updated' field name
             lu_type (tuple): the date/time format for the lu_field. Can be "datetime" or "isoformat"
+            validator (Validator): optional document-level validator
+            sanitizer (function): function called as sanitizer(doc, allow_bson=...)
+                to make documents safe to write in update. Defaults to
+                maggma.utils.fast_jsanitize
         """
         self.key = key
         self.lu_field = lu_field
@@ -49,6 +92,7 @@ class Store(MSONable, metaclass=ABCMeta):
             LU_KEY_ISOFORMAT if lu_type == "isoformat" else (identity, identity)
         )
         self.validator = validator
+        self.sanitizer = sanitizer
         self.logger = logging.getLogger(type(self).__name__)
         self.logger.addHandler(logging.NullHandler())
 
@@ -174,7 +218,7 @@ class Store(MSONable, metaclass=ABCMeta):
         lu_list = [t.last_updated for t in targets]
         return {self.lu_field: {"$gt": self.lu_func[1](max(lu_list))}}
 
-    def updated_keys(self, target, criteria=None):
+    def updated_keys(self, target, criteria=None, server_side=False):
         """
         Returns keys for docs that are newer in the target store in comparison
         with this store when comparing the last updated field (lu_field)
@@ -182,6 +226,8 @@ class Store(MSONable, metaclass=ABCMeta):
         Args:
             target (Store): store to look for updated documents
             criteria (dict): mongo query to limit scope
+            server_side (bool): compute the keys on the database server
+                for Mongo-backed stores, see source_keys_updated
 
         Returns:
             list of keys that have been updated in target store
@@ -189,7 +235,45 @@ class Store(MSONable, metaclass=ABCMeta):
         self.ensure_index(self.key)
         self.ensure_index(self.lu_field)
 
-        return source_keys_updated(target, self, query=criteria)
+        return source_keys_updated(
+            target, self, query=criteria, server_side=server_side
+        )
+
+    def sanitize(self, doc, allow_bson=False):
+        """
+        Makes a document safe to write to this Store using its sanitizer
+
+        Args:
+            doc (dict): document to sanitize
+            allow_bson (bool): whether to keep BSON types such as datetime
+        """
+        sanitizer = self.sanitizer or fast_jsanitize
+        return sanitizer(doc, allow_bson=allow_bson)
+
+    def _validate_docs(self, docs):
+        """
+        Validates documents with the validator of this Store, if any.
+        Invalid documents raise a ValueError with a strict validator and
+        are logged and skipped otherwise.
+
+        Args:
+            docs ([dict]): documents to validate
+
+        Returns:
+            list of valid documents
+        """
+        if not self.validator:
+            return docs
+
+        valid_docs = []
+        for d, errors in zip(docs, self.validator.validate_many(docs)):
+            if not errors:
+                valid_docs.append(d)
+            elif self.validator.strict:
+                raise ValueError(errors)
+            else:
+                self.logger.error(errors)
+        return valid_docs
 
     def __eq__(self, other):
         return hash(self) == hash(other)
@@ -271,32 +355,99 @@ class Mongolike(object):
             except:
                 return False
 
-    def update(self, docs, update_lu=True, key=None, ordered=True, **kwargs):
+    def update(
+        self,
+        docs,
+        update_lu=True,
+        key=None,
+        ordered=True,
+        batch_size=1000,
+        batch_bytes=16 * 1024 ** 2,
+        num_writers=1,
+        **kwargs
+    ):
         """
         Function to update associated MongoStore collection.
 
+        Documents are upserted in bulk writes of at most batch_size documents
+        and batch_bytes of BSON, so that large updates don't have to be held
+        in memory as a single request. For unordered updates, batches are
+        written concurrently by num_writers threads while the next ones are
+        being prepared.
+
         Args:
             docs: list of documents
+            update_lu (bool): update the last_updated field or not
+            key (list or str): list or str of important parameters
+            ordered (bool): whether to write documents in order, stopping at
+                the first error. Unordered updates write all the batches and
+                raise the errors of all of them at the end
+            batch_size (int): maximum number of documents per bulk write
+            batch_bytes (int): approximate maximum BSON size in bytes per bulk
+                write, estimated from a sample of the documents
+            num_writers (int): number of threads writing unordered batches
+
+        Returns:
+            BulkWriteResult with the combined counts of all bulk writes
+
+        Raises:
+            BulkWriteError with the combined details of all bulk writes, if
+            any of them failed
         """
+        batches = self._update_batches(docs, update_lu, key, batch_size, batch_bytes)
 
-        requests = []
+        if ordered or num_writers <= 1:
+            results = []
+            for offset, requests in batches:
+                results.append((offset, self._bulk_write(requests, ordered)))
+                if ordered and results[-1][1]["writeErrors"]:
+                    break
+        else:
+            results = []
+            with ThreadPoolExecutor(max_workers=num_writers) as executor:
+                pending = {}
+                for offset, requests in batches:
+                    # Bound the number of prepared batches held in memory
+                    if len(pending) >= 2 * num_writers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        results.extend((pending.pop(f), f.result()) for f in done)
+                    future = executor.submit(self._bulk_write, requests, False)
+                    pending[future] = offset
+                results.extend((offset, f.result()) for f, offset in pending.items())
+
+        result = merge_bulk_write_results(results)
+        details = result.bulk_api_result
+        if details["writeErrors"] or details["writeConcernErrors"]:
+            raise BulkWriteError(details)
+        return result
+
+    def _bulk_write(self, requests, ordered):
+        """
+        Returns (dict): the bulk API result of a bulk write, with the write
+            errors instead of raising them
+        """
+        try:
+            return self.collection.bulk_write(requests, ordered=ordered).bulk_api_result
+        except BulkWriteError as e:
+            return e.details
 
-        for d in docs:
+    def _update_batches(self, docs, update_lu, key, batch_size, batch_bytes):
+        """
+        Sanitizes and validates docs, yielding (offset, requests) batches of
+        ReplaceOne upserts within the batch_size and batch_bytes limits
+        """
+        requests, nbytes, offset = [], 0, 0
+        key = key if key else self.key
+        docs = iter(docs)
 
-            d = jsanitize(d, allow_bson=True)
+        # Validate a batch worth of docs at a time
+        for chunk in iter(lambda: list(islice(docs, batch_size)), []):
 
-            # document-level validation is optional
-            validates = True
-            if self.validator:
-                validates = self.validator.is_valid(d)
-                if not validates:
-                    if self.validator.strict:
-                        raise ValueError(self.validator.validation_errors(d))
-                    else:
-                        self.logger.error(self.validator.validation_errors(d))
+            chunk = self._validate_docs(
+                [self.sanitize(d, allow_bson=True) for d in chunk]
+            )
 
-            if validates:
-                key = key if key else self.key
+            for d in chunk:
                 if isinstance(key, list):
                     search_doc = {k: d[k] for k in key}
                 else:
@@ -304,9 +455,19 @@ class Mongolike(object):
                 if update_lu:
                     d[self.lu_field] = datetime.utcnow()
 
+                size = len(BSON.encode(d))
+                if requests and (
+                    len(requests) >= batch_size or nbytes + size > batch_bytes
+                ):
+                    yield offset, requests
+                    offset += len(requests)
+                    requests, nbytes = [], 0
+
                 requests.append(ReplaceOne(search_doc, d, upsert=True))
+                nbytes += size
 
-        self.collection.bulk_write(requests, ordered=ordered)
+        if requests:
+            yield offset, requests
 
     def distinct(self, key, criteria=None, all_exist=False, **kwargs):
         """
@@ -505,38 +666,1452 @@ class MemoryStore(Mongolike, Store):
                 temp_dict = {"_id": {keys[0]: key}, "docs": list(grp)}
                 yield temp_dict
 
+
+class IndexedMemoryStore(Store):
+    """
+    An in-memory Store that does not rely on mongomock. Documents are kept
+    in a dict, with hash indexes on Store.key and on any field passed to
+    ensure_index. Indexes narrow down the documents a query has to check
+    for equality, $in and range criteria on indexed fields.
+    """
+
+    def __init__(self, name="memory_db", **kwargs):
+        """
+        Args:
+            name (str): name of the store
+        """
+        self.name = name
+        self._docs = None
+        self._indexes = {}
+        self._next_id = 0
+        self.kwargs = kwargs
+        super(IndexedMemoryStore, self).__init__(**kwargs)
+
+    def connect(self, force_reset=False):
+        if self._docs is None or force_reset:
+            self._docs = {}
+            self._indexes = {}
+            self.ensure_index(self.key)
+
+    def close(self):
+        pass
+
+    @property
+    def collection(self):
+        # AttributeError so that code looking for a Mongo collection skips this store
+        raise AttributeError("IndexedMemoryStore is not backed by a collection")
+
+    def __hash__(self):
+        return hash((self.name, self.lu_field))
+
+    def _find_ids(self, criteria=None):
+        """
+        Returns the ids of documents matching criteria in insertion order
+        """
+        return self._index_find_ids(criteria)
+
+    def _index_find_ids(self, criteria=None):
+        """
+        Returns the ids of documents matching criteria in insertion order,
+        using only the hash indexes to narrow down candidates
+        """
+        if self._docs is None:
+            raise StoreError("Must connect IndexedMemoryStore before attemping to use it")
+        if not criteria:
+            return list(self._docs)
+        candidates = self._candidate_ids(criteria)
+        candidates = self._docs if candidates is None else sorted(candidates)
+        return [i for i in candidates if filter_applies(criteria, self._docs[i])]
+
+    def _candidate_ids(self, criteria):
+        """
+        Returns the ids of documents that may match criteria according to
+        the indexes, or None if no index applies
+        """
+        ids = None
+        for field, condition in criteria.items():
+            if field == "$and":
+                matched = None
+                for clause in condition:
+                    clause_ids = self._candidate_ids(clause)
+                    if clause_ids is not None:
+                        matched = clause_ids if matched is None else matched & clause_ids
+            elif field in self._indexes:
+                matched = self._indexes[field].find(condition)
+            else:
+                continue
+            if matched is not None:
+                ids = matched if ids is None else ids & matched
+        return ids
+
+    def query(self, criteria=None, properties=None, **kwargs):
+        """
+        Queries the store for documents with property focus.
+
+        Args:
+            criteria (dict): filter for query, matches documents
+                against key-value pairs
+            properties (list or dict): list of properties to return
+                or dictionary with {"property": 1} type structure
+                from standard mongo Collection.find syntax
+            **kwargs (kwargs): sort, skip and limit as for Collection.find
+
+        Returns:
+            MemoryCursor over copies of the matching documents
+        """
+        cursor = MemoryCursor(
+            [self._docs[i] for i in self._find_ids(criteria)], properties
+        )
+        if kwargs.get("sort"):
+            cursor.sort(kwargs["sort"])
+        return cursor.skip(kwargs.get("skip", 0)).limit(kwargs.get("limit", 0))
+
+    def query_one(self, criteria=None, properties=None, **kwargs):
+        """
+        Gets a single document from the store with property focus.
+        Returns None if nothing matches
+
+        Args:
+            criteria (dict): filter for query, matches documents
+                against key-value pairs
+            properties (list or dict): list of properties to return
+                or dictionary with {"property": 1} type structure
+                from standard mongo Collection.find syntax
+            **kwargs (kwargs): sort as for Collection.find_one
+        """
+        kwargs["limit"] = 1
+        return next(self.query(criteria=criteria, properties=properties, **kwargs), None)
+
+    def distinct(self, key, criteria=None, all_exist=False, **kwargs):
+        """
+        Gets all distinct values of a key or, for a list of keys,
+        all distinct sets of values
+
+        Args:
+            key (mongolike key or list of mongolike keys): key or keys
+                for which to find distinct values or sets of values.
+            criteria (filter criteria): criteria for filter
+            all_exist (bool): whether to ensure all keys in list exist
+                in each document, defaults to False
+        """
+        if isinstance(key, list):
+            criteria = criteria if criteria else {}
+            if all_exist:
+                criteria.update(
+                    {k: {"$exists": True} for k in key if k not in criteria}
+                )
+            return [d["_id"] for d in self.groupby(key, properties=key, criteria=criteria)]
+
+        if not criteria and key in self._indexes:
+            index = self._indexes[key]
+            values = [b[1] for b in index.values if b is not _MISSING]
+            docs = (self._docs[i] for i in sorted(index.unindexed))
+        else:
+            values = []
+            docs = (self._docs[i] for i in self._find_ids(criteria))
+
+        return _distinct_values(docs, key, values)
+
+    def groupby(self, keys, criteria=None, properties=None, **kwargs):
+        """
+        Simple grouping function that will group documents
+        by keys.
+
+        Args:
+            keys (list or string): fields to group documents
+            criteria (dict): filter for documents to group
+            properties (list): properties to return in grouped documents
+
+        Returns:
+            generator of grouped documents with the structure:
+            {'_id': {"KEY_1": value_1, "KEY_2": value_2 ...,
+             'docs': [list_of_documents corresponding to key values]}
+        """
+        docs = (self._docs[i] for i in self._find_ids(criteria))
+        for group in _group_docs(docs, keys, properties):
+            yield group
+
     def update(self, docs, update_lu=True, key=None, **kwargs):
         """
-        Function to update associated MongoStore collection.
+        Upserts documents, replacing any existing document with the same key
 
         Args:
-            docs: list of documents
+            docs ([dict]): list of documents
+            update_lu (bool): update the last_updated field or not
+            key (list or str): field or fields identifying a document,
+                defaults to Store.key
         """
+        key = key if key else self.key
+        docs = self._validate_docs([self.sanitize(d, allow_bson=True) for d in docs])
 
         for d in docs:
+            if isinstance(key, list):
+                search_doc = {k: d[k] for k in key}
+            else:
+                search_doc = {key: d[key]}
+            if update_lu:
+                d[self.lu_field] = datetime.utcnow()
 
-            d = jsanitize(d, allow_bson=True)
+            # Snapshot the doc, sanitizing may share subdocuments with the caller
+            d = deepcopy(d)
+            matches = self._index_find_ids(search_doc)
+            if matches:
+                doc_id = matches[0]
+                old_doc = self._docs[doc_id]
+                for index in self._indexes.values():
+                    index.remove(doc_id, old_doc)
+            else:
+                doc_id, old_doc = self._next_id, None
+                self._next_id += 1
 
-            # document-level validation is optional
-            validates = True
-            if self.validator:
-                validates = self.validator.is_valid(d)
-                if not validates:
-                    if self.validator.strict:
-                        raise ValueError(self.validator.validation_errors(d))
-                    else:
-                        self.logger.error(self.validator.validation_errors(d))
+            try:
+                for index in self._indexes.values():
+                    index.check_unique(doc_id, d)
+            except DuplicateKeyError:
+                if old_doc is not None:
+                    for index in self._indexes.values():
+                        index.add(doc_id, old_doc)
+                raise
+
+            self._write(doc_id, d)
+
+    def _write(self, doc_id, doc):
+        """Stores a document under doc_id and indexes it"""
+        self._docs[doc_id] = doc
+        for index in self._indexes.values():
+            index.add(doc_id, doc)
 
-            if validates:
-                if isinstance(key, list):
-                    search_doc = {k: d[k] for k in key}
-                elif key:
-                    search_doc = {key: d[key]}
+    def ensure_index(self, key, unique=False, **kwargs):
+        """
+        Creates a hash index on a field, which also serves range
+        queries through a sorted view built when first needed
+
+        Args:
+            key (str): single field to index
+            unique (bool): whether values of the field must be unique
+
+        Returns:
+            bool indicating if the index exists/was created
+        """
+        if self._docs is None or not isinstance(key, str):
+            return False
+        if key in self._indexes:
+            index = self._indexes[key]
+            if unique and not index.unique:
+                if index.unindexed or any(len(ids) > 1 for ids in index.values.values()):
+                    return False
+                index.unique = True
+            return True
+
+        index = MemoryIndex(key, unique=unique)
+        try:
+            for doc_id, doc in self._docs.items():
+                index.check_unique(doc_id, doc)
+                index.add(doc_id, doc)
+        except DuplicateKeyError:
+            return False
+        self._indexes[key] = index
+        return True
+
+
+class MemoryIndex(object):
+    """
+    Hash index on a field of the documents in an IndexedMemoryStore, with
+    a sorted view for range queries that is rebuilt lazily after changes
+    """
+
+    def __init__(self, field, unique=False):
+        """
+        Args:
+            field (str): mongolike field to index
+            unique (bool): whether values of the field must be unique
+        """
+        self.field = field
+        self.unique = unique
+        # (type rank, value) -> set of doc ids, so that e.g. True and 1
+        # don't share a bucket, missing fields are stored under _MISSING
+        self.values = {}
+        # ids of docs whose value is a list, dict or otherwise unhashable,
+        # these are candidates for any query
+        self.unindexed = set()
+        self._sorted = None
+
+    def value(self, doc):
+        """Value of the field in doc, _MISSING or _UNINDEXED"""
+        return _index_value(doc, self.field)
+
+    def add(self, doc_id, doc):
+        value = self.value(doc)
+        if value is _UNINDEXED:
+            self.unindexed.add(doc_id)
+        else:
+            self.values.setdefault(_bucket(value), set()).add(doc_id)
+        self._sorted = None
+
+    def remove(self, doc_id, doc):
+        value = self.value(doc)
+        if value is _UNINDEXED:
+            self.unindexed.discard(doc_id)
+        else:
+            ids = self.values.get(_bucket(value), set())
+            ids.discard(doc_id)
+            if not ids:
+                self.values.pop(_bucket(value), None)
+        self._sorted = None
+
+    def check_unique(self, doc_id, doc):
+        """Raises DuplicateKeyError if doc would break a unique index"""
+        if not self.unique:
+            return
+        value = self.value(doc)
+        if value is not _UNINDEXED and self.values.get(_bucket(value), set()) - {doc_id}:
+            raise DuplicateKeyError(
+                "Duplicate value {} for unique index on {}".format(value, self.field)
+            )
+
+    def lookup(self, value):
+        """Ids of docs that may have the field equal to value"""
+        ids = set(self.values.get(_bucket(value), ()))
+        if value is None:
+            ids |= self.values.get(_MISSING, set())
+        return ids | self.unindexed
+
+    def find(self, condition):
+        """
+        Ids of docs that may match a query condition on the field,
+        or None if the index can't be used for this condition
+        """
+        if not isinstance(condition, dict):
+            # Regular expressions match values rather than equal them
+            if isinstance(condition, list) or is_regex(condition):
+                return None
+            try:
+                return self.lookup(condition)
+            except TypeError:
+                return None
+
+        operators = set(condition)
+        if operators == {"$eq"}:
+            return self.find(condition["$eq"])
+        if operators == {"$in"}:
+            ids = set()
+            for value in condition["$in"]:
+                matched = self.find(value)
+                if matched is None:
+                    return None
+                ids |= matched
+            return ids
+        if operators and operators <= {"$gt", "$gte", "$lt", "$lte"}:
+            return self.range(condition)
+        return None
+
+    def range(self, condition):
+        """Ids of docs that may match range operators on the field"""
+        if self._sorted is None:
+            items = sorted(
+                (bson_sort_key(bucket[1]), i)
+                for bucket, ids in self.values.items()
+                if bucket is not _MISSING
+                for i in ids
+            )
+            self._sorted = ([k for k, _ in items], [i for _, i in items])
+        keys, ids = self._sorted
+
+        lo, hi = 0, len(keys)
+        for op, bound in condition.items():
+            bound = bson_sort_key(bound)
+            if op == "$gt":
+                lo = max(lo, bisect_right(keys, bound))
+            elif op == "$gte":
+                lo = max(lo, bisect_left(keys, bound))
+            elif op == "$lt":
+                hi = min(hi, bisect_left(keys, bound))
+            elif op == "$lte":
+                hi = min(hi, bisect_right(keys, bound))
+        return set(ids[lo:hi]) | self.unindexed
+
+
+class ColumnarMemoryStore(IndexedMemoryStore):
+    """
+    An IndexedMemoryStore that also keeps selected scalar fields as
+    categorical NumPy columns. distinct, groupby, count and filters on
+    those fields are evaluated once per distinct value and then
+    vectorized over all documents, while full documents are still
+    served from the row storage.
+    """
+
+    def __init__(self, name="memory_db", columns=None, **kwargs):
+        """
+        Args:
+            name (str): name of the store
+            columns ([str]): fields to keep in columns, lookups on
+                Store.key and other indexed fields use the hash indexes
+        """
+        if not numpy_import:
+            raise ValueError("numpy not available, please install numpy to use ColumnarMemoryStore")
+        self.columns = list(columns) if columns else []
+        self._columns = {}
+        self._rows = []
+        self._row_of = {}
+        super(ColumnarMemoryStore, self).__init__(name=name, **kwargs)
+        self.kwargs = kwargs
+
+    def connect(self, force_reset=False):
+        if self._docs is None or force_reset:
+            self._columns = {field: MemoryColumn(field) for field in self.columns}
+            self._rows = []
+            self._row_of = {}
+        super(ColumnarMemoryStore, self).connect(force_reset=force_reset)
+
+    def _write(self, doc_id, doc):
+        super(ColumnarMemoryStore, self)._write(doc_id, doc)
+        if doc_id not in self._row_of:
+            self._row_of[doc_id] = len(self._rows)
+            self._rows.append(doc_id)
+        for column in self._columns.values():
+            column.set(self._row_of[doc_id], doc)
+
+    def _column_mask(self, criteria):
+        """
+        Evaluates the parts of criteria on columns
+
+        Returns:
+            (mask, exact, uncertain): boolean row mask, or None if no
+                column applies, whether criteria only involves columns and
+                a row mask of documents with unindexed column values,
+                which must be checked against the full criteria
+        """
+        mask = np.ones(len(self._rows), dtype=bool)
+        uncertain = np.zeros(len(self._rows), dtype=bool)
+        exact, used = True, False
+        for field, condition in criteria.items():
+            if field == "$and":
+                for clause in condition:
+                    clause_mask, clause_exact, clause_uncertain = self._column_mask(clause)
+                    if clause_mask is None:
+                        exact = False
+                        continue
+                    mask &= clause_mask
+                    uncertain |= clause_uncertain
+                    exact &= clause_exact
+                    used = True
+            elif field in self._columns:
+                column = self._columns[field]
+                mask &= column.mask(condition)
+                uncertain |= column.codes == _UNINDEXED_CODE
+                used = True
+            else:
+                exact = False
+        return (mask, exact, uncertain) if used else (None, False, None)
+
+    def _find_rows(self, criteria=None):
+        """Row numbers of the documents matching criteria"""
+        if self._docs is None:
+            raise StoreError("Must connect ColumnarMemoryStore before attemping to use it")
+        if not criteria:
+            return np.arange(len(self._rows))
+
+        # Equality on an indexed field, e.g. Store.key, picks out a few rows
+        # through the hash index instead of a mask over all of them
+        candidates = self._candidate_ids({
+            field: condition
+            for field, condition in criteria.items()
+            if field in self._indexes and _is_equality(condition)
+        })
+        if candidates is not None:
+            return np.array(sorted(
+                self._row_of[i] for i in candidates
+                if filter_applies(criteria, self._docs[i])
+            ), dtype=int)
+
+        mask, exact, uncertain = self._column_mask(criteria)
+        if mask is None:
+            return np.array(
+                [self._row_of[i] for i in self._index_find_ids(criteria)],
+                dtype=int,
+            )
+        if not exact:
+            uncertain = mask
+        for row in np.flatnonzero(mask & uncertain):
+            mask[row] = filter_applies(criteria, self._docs[self._rows[row]])
+        return np.flatnonzero(mask)
+
+    def _find_ids(self, criteria=None):
+        return [self._rows[row] for row in self._find_rows(criteria)]
+
+    def count(self, criteria=None):
+        """
+        Counts the documents matching criteria
+
+        Args:
+            criteria (dict): filter for documents to count
+        """
+        return len(self._find_rows(criteria))
+
+    def distinct(self, key, criteria=None, all_exist=False, **kwargs):
+        """
+        Gets all distinct values of a key or, for a list of keys,
+        all distinct sets of values
+
+        Args:
+            key (mongolike key or list of mongolike keys): key or keys
+                for which to find distinct values or sets of values.
+            criteria (filter criteria): criteria for filter
+            all_exist (bool): whether to ensure all keys in list exist
+                in each document, defaults to False
+        """
+        if isinstance(key, list) or key not in self._columns:
+            return super(ColumnarMemoryStore, self).distinct(
+                key, criteria=criteria, all_exist=all_exist, **kwargs
+            )
+
+        column = self._columns[key]
+        rows = self._find_rows(criteria)
+        codes = column.codes[rows]
+        values = [column.categories[c] for c in np.unique(codes[codes >= 0])]
+
+        # Lists and other unindexed values come from the documents
+        seen = set(_freeze(v) for v in values)
+        for row in rows[codes == _UNINDEXED_CODE]:
+            value = _get_field(self._docs[self._rows[row]], key)
+            for v in value if isinstance(value, list) else [value]:
+                if _freeze(v) not in seen:
+                    seen.add(_freeze(v))
+                    values.append(deepcopy(v))
+        return values
+
+    def groupby(self, keys, criteria=None, properties=None, **kwargs):
+        """
+        Simple grouping function that will group documents
+        by keys.
+
+        Args:
+            keys (list or string): fields to group documents
+            criteria (dict): filter for documents to group
+            properties (list): properties to return in grouped documents
+
+        Returns:
+            generator of grouped documents with the structure:
+            {'_id': {"KEY_1": value_1, "KEY_2": value_2 ...,
+             'docs': [list_of_documents corresponding to key values]}
+        """
+        keys = keys if isinstance(keys, list) else [keys]
+        rows = self._find_rows(criteria)
+        if len(rows) == 0:
+            return
+        codes = np.array(
+            [self._columns[k].codes[rows] for k in keys if k in self._columns], dtype=int
+        ).reshape(-1, len(rows))
+
+        if len(codes) < len(keys) or (codes == _UNINDEXED_CODE).any():
+            for group in super(ColumnarMemoryStore, self).groupby(
+                keys, criteria=criteria, properties=properties, **kwargs
+            ):
+                yield group
+            return
+
+        group_codes, inverse = np.unique(codes.T, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(group_codes)))[:-1]
+
+        for group_code, group_rows in zip(group_codes, np.split(rows[order], bounds)):
+            group_id = {}
+            for key, code in zip(keys, group_code):
+                if code != _MISSING_CODE:
+                    _set_field(group_id, key, self._columns[key].categories[code])
+            yield {
+                "_id": group_id,
+                "docs": [_project(self._docs[self._rows[r]], properties) for r in group_rows],
+            }
+
+
+class MemoryColumn(object):
+    """
+    Categorical column of a field in a ColumnarMemoryStore, each row holds
+    the code of its value in categories, _MISSING_CODE or _UNINDEXED_CODE
+    """
+
+    def __init__(self, field):
+        """
+        Args:
+            field (str): mongolike field of the column
+        """
+        self.field = field
+        self.categories = []
+        self._category_codes = {}
+        self._codes = []
+        self._array = None
+        # float values of numeric categories, NaN for the others
+        self._numeric = []
+        # number of rows with each category
+        self._counts = []
+
+    @property
+    def codes(self):
+        """NumPy array of the row codes"""
+        if self._array is None:
+            # Rebuilding the array after writes is linear anyway, so
+            # that is when categories no row has anymore are dropped
+            if self._counts.count(0) > len(self.categories) // 2:
+                self._compact()
+            self._array = np.array(self._codes, dtype=int)
+        return self._array
+
+    def _compact(self):
+        """Drops the categories no row has and renumbers the others"""
+        used = [c for c, n in enumerate(self._counts) if n]
+        new_codes = {c: i for i, c in enumerate(used)}
+        self._codes = [new_codes.get(c, c) for c in self._codes]
+        self.categories = [self.categories[c] for c in used]
+        self._numeric = [self._numeric[c] for c in used]
+        self._counts = [self._counts[c] for c in used]
+        self._category_codes = {_bucket(v): i for i, v in enumerate(self.categories)}
+
+    def set(self, row, doc):
+        """Sets the value of a row from doc"""
+        value = _index_value(doc, self.field)
+        if value is _MISSING:
+            code = _MISSING_CODE
+        elif value is _UNINDEXED:
+            code = _UNINDEXED_CODE
+        else:
+            # bools are kept apart from the equal ints 0 and 1
+            category = _bucket(value)
+            if category not in self._category_codes:
+                self._category_codes[category] = len(self.categories)
+                self.categories.append(value)
+                numeric = isinstance(value, (int, float)) and not isinstance(value, bool)
+                self._numeric.append(float(value) if numeric else np.nan)
+                self._counts.append(0)
+            code = self._category_codes[category]
+            self._counts[code] += 1
+
+        if row == len(self._codes):
+            self._codes.append(code)
+        else:
+            if self._codes[row] >= 0:
+                self._counts[self._codes[row]] -= 1
+            self._codes[row] = code
+        self._array = None
+
+    def mask(self, condition):
+        """
+        Row mask of a query condition on the field, rows with
+        unindexed values are always included
+        """
+        # Before the categories, which may be compacted when building codes
+        codes = self.codes
+        if isinstance(condition, dict) and condition and all(
+            op in _RANGE_OPERATORS
+            and isinstance(bound, (int, float))
+            and not isinstance(bound, bool)
+            for op, bound in condition.items()
+        ):
+            # Numbers only compare to numbers, NaN comparisons are False
+            numeric = np.array(self._numeric, dtype=float)
+            matches = np.ones(len(numeric), dtype=bool)
+            for op, bound in condition.items():
+                matches &= _RANGE_OPERATORS[op](numeric, bound)
+            missing = False
+        else:
+            matches = [filter_applies({"v": condition}, {"v": v}) for v in self.categories]
+            missing = filter_applies({"v": condition}, {})
+
+        # Negative codes index the last two entries
+        table = np.append(np.array(matches, dtype=bool), [True, missing])
+        return table[codes]
+
+
+class MemoryCursor(object):
+    """
+    Cursor over the results of a query on a Store without a Mongo
+    collection, supporting sort, skip and limit like a pymongo Cursor.
+    Documents are only loaded into a list when the cursor is sorted
+    or counted.
+    """
+
+    def __init__(self, docs, properties=None, copy=True):
+        """
+        Args:
+            docs (iterable of dicts): matching documents
+            properties (list or dict): projection for the documents
+            copy (bool): whether to copy documents before returning them,
+                False for documents the store does not keep a reference to
+        """
+        self._docs = docs
+        self._properties = properties
+        self._copy = copy
+        self._skip = 0
+        self._limit = 0
+        self._iter = None
+
+    def sort(self, key_or_list, direction=None):
+        if isinstance(key_or_list, str):
+            key_or_list = [(key_or_list, direction or pymongo.ASCENDING)]
+        docs = list(self._docs)
+        # Stable sorts from the last key to the first give a multi-key sort
+        for field, direction in reversed(key_or_list):
+            docs.sort(
+                key=lambda d: bson_sort_key(
+                    _get_field(d, field), reverse=direction == pymongo.DESCENDING
+                ),
+                reverse=direction == pymongo.DESCENDING,
+            )
+        self._docs = docs
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def count(self):
+        self._docs = list(self._docs)
+        return len(self._docs)
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iter is None:
+            end = self._skip + self._limit if self._limit else None
+            self._iter = islice(self._docs, self._skip, end)
+        doc = next(self._iter)
+        if not self._copy and not self._properties:
+            return doc
+        return _project(doc, self._properties)
+
+
+# Placeholders for missing and unindexable values in a MemoryIndex
+_MISSING = object()
+_UNINDEXED = object()
+
+# Order of types when MongoDB compares values of different types
+_BSON_TYPE_ORDER = (
+    (type(None), 0),
+    (bool, 7),
+    ((int, float), 1),
+    (str, 2),
+    (dict, 3),
+    (list, 4),
+    (bytes, 5),
+    (ObjectId, 6),
+    (datetime, 8),
+)
+
+
+_MISSING_CODE = -1
+_UNINDEXED_CODE = -2
+
+_RANGE_OPERATORS = {
+    "$gt": operator.gt,
+    "$gte": operator.ge,
+    "$lt": operator.lt,
+    "$lte": operator.le,
+}
+
+
+def _index_value(doc, field):
+    """
+    Value of a field in doc for indexing, _MISSING if the field is
+    missing and _UNINDEXED if it is a list, dict or otherwise unhashable
+    or goes through a list
+    """
+    value = doc
+    for part in field.split("."):
+        if isinstance(value, dict):
+            if part not in value:
+                return _MISSING
+            value = value[part]
+        elif isinstance(value, list):
+            return _UNINDEXED
+        else:
+            return _MISSING
+    if isinstance(value, (list, dict)):
+        return _UNINDEXED
+    try:
+        hash(value)
+    except TypeError:
+        return _UNINDEXED
+    return value
+
+
+def _bson_type_rank(value):
+    """Rank of the type of a value when MongoDB compares values of different types"""
+    for types, rank in _BSON_TYPE_ORDER:
+        if isinstance(value, types):
+            return rank
+    return 9
+
+
+def _is_equality(condition):
+    """Whether a query condition only matches values equal to given ones"""
+    if isinstance(condition, dict):
+        return set(condition) in ({"$eq"}, {"$in"})
+    return not isinstance(condition, list) and not is_regex(condition)
+
+
+def _bucket(value):
+    """
+    Index bucket of a value, values only share a bucket if they are
+    equal and of the same BSON type, e.g. 1 and 1.0 but not True and 1
+    """
+    if value is _MISSING:
+        return _MISSING
+    return (_bson_type_rank(value), value)
+
+
+def bson_sort_key(value, reverse=False):
+    """
+    Sort key for values of any type that orders them like a MongoDB sort,
+    first by type and then by value. Arrays sort by their smallest element,
+    or their largest one for a descending sort, and empty arrays before null
+
+    Args:
+        value: value to sort
+        reverse (bool): whether the sort is descending
+    """
+    if isinstance(value, list):
+        if not value:
+            return (-1, 0)
+        keys = [bson_compare_key(v) for v in value]
+        return max(keys) if reverse else min(keys)
+    return bson_compare_key(value)
+
+
+def bson_compare_key(value):
+    """
+    Key for values of any type that compares them like MongoDB compares
+    BSON values, first by type and then by value. Subdocuments compare
+    pair by pair, by the type of the value, the field name and the value,
+    and arrays element by element
+    """
+    if value is _MISSING:
+        return (0, 0)
+    rank = _bson_type_rank(value)
+    if rank == 0:
+        return (rank, 0)
+    if rank == 3:
+        pairs = []
+        for k, v in value.items():
+            v = bson_compare_key(v)
+            pairs.append((v[0], k, v))
+        return (rank, tuple(pairs))
+    if rank == 4:
+        return (rank, tuple(bson_compare_key(v) for v in value))
+    if rank == 9:
+        return (rank, str(value))
+    return (rank, value)
+
+
+def _freeze(value):
+    """Hashable version of a document value"""
+    if isinstance(value, bool):
+        return ("__bool__", value)
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return ("__list__",) + tuple(_freeze(v) for v in value)
+    return value
+
+
+def _distinct_values(docs, key, values=None):
+    """
+    Distinct values of a key in docs in order of appearance, list values
+    count as their items, values gives known values to start from
+    """
+    values = list(values) if values else []
+    for doc in docs:
+        value = _get_field(doc, key)
+        if value is not _MISSING:
+            values.extend(value if isinstance(value, list) else [value])
+
+    distinct_values = []
+    seen = set()
+    for value in values:
+        frozen = _freeze(value)
+        if frozen not in seen:
+            seen.add(frozen)
+            distinct_values.append(deepcopy(value))
+    return distinct_values
+
+
+def _group_docs(docs, keys, properties=None):
+    """
+    Groups docs by the values of keys, in order of first appearance
+
+    Returns:
+        generator of {"_id": {key: value ...}, "docs": [projected docs]}
+    """
+    keys = keys if isinstance(keys, list) else [keys]
+
+    groups = {}
+    for doc in docs:
+        group_id = {}
+        for key in keys:
+            value = _get_field(doc, key)
+            if value is not _MISSING:
+                _set_field(group_id, key, deepcopy(value))
+        group = groups.setdefault(_freeze(group_id), {"_id": group_id, "docs": []})
+        group["docs"].append(_project(doc, properties))
+
+    for group in groups.values():
+        yield group
+
+
+def _get_field(doc, field):
+    """Value of a mongolike field in doc or _MISSING"""
+    value = doc
+    for part in field.split("."):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list):
+            # Positions and fields of list items, leave those to pydash
+            return get(doc, field) if has(doc, field) else _MISSING
+        else:
+            return _MISSING
+    return value
+
+
+def _set_field(doc, field, value):
+    """Sets a mongolike field in doc"""
+    parts = field.split(".")
+    target = doc
+    for part in parts[:-1]:
+        target = target.setdefault(part, {}) if isinstance(target, dict) else None
+    if isinstance(target, dict):
+        target[parts[-1]] = value
+    else:
+        set_(doc, field, value)
+
+
+def _project(doc, properties=None):
+    """
+    Copy of doc with only the properties in a mongo projection,
+    given as a list or a {"property": 1} type dict
+    """
+    if not properties:
+        return deepcopy(doc)
+    if isinstance(properties, list):
+        properties = {p: 1 for p in properties}
+
+    included = [p for p, v in properties.items() if v and p != "_id"]
+    if included:
+        projected = {}
+        if properties.get("_id", 1) and "_id" in doc:
+            projected["_id"] = doc["_id"]
+        for p in included:
+            value = _get_field(doc, p)
+            if value is not _MISSING:
+                _set_field(projected, p, deepcopy(value))
+        return projected
+
+    projected = deepcopy(doc)
+    for p, v in properties.items():
+        if not v:
+            unset(projected, p)
+    return projected
+
+
+def _covered(properties, fields):
+    """
+    Whether all the properties included by a mongo projection, given
+    as a list or a {"property": 1} type dict, are among fields or nested
+    in one of them. Projections excluding properties are never covered
+    """
+    if not properties:
+        return False
+    if isinstance(properties, dict):
+        if not all(v for p, v in properties.items() if p != "_id"):
+            return False
+        properties = [p for p, v in properties.items() if v]
+
+    for p in properties:
+        parts = p.split(".")
+        if not any(".".join(parts[:i]) in fields for i in range(1, len(parts) + 1)):
+            return False
+    return True
+
+
+class LogFileStore(Store):
+    """
+    A disk-backed Store without a database server. Documents are appended
+    as BSON records to a log file and indexed by a hash of their Store.key
+    value. Most of the index is a file of entries sorted by key hash, which
+    is memory mapped and binary searched like the log, entries of records
+    appended since it was written are kept in memory and in an append-only
+    index file. Connecting only loads the latter, and documents are read on
+    demand from the memory mapped log, allowing datasets larger than memory.
+
+    Updating a document appends a new record, compact() rewrites the log
+    with only the latest records. Updates compact the log once stale
+    records make up more than max_stale_ratio of it, and merge the
+    in-memory entries into the sorted index once there are many of them.
+    """
+
+    def __init__(self, path, max_stale_ratio=0.5, **kwargs):
+        """
+        Args:
+            path (str): path of the log file, the index is kept next to it
+                in path + ".sidx" (sorted) and path + ".idx" (appended)
+            max_stale_ratio (float): fraction of stale records in the log
+                above which updates compact it, None to only compact
+                when compact() is called
+        """
+        self.path = path
+        self.index_path = path + ".idx"
+        self.sorted_index_path = path + ".sidx"
+        self.max_stale_ratio = max_stale_ratio
+        self._log = None
+        self._log_map = None
+        self._sorted = None
+        self._num_sorted = 0
+        self._num_records = 0
+        self._num_live = 0
+        self._offsets = None
+        self.kwargs = kwargs
+        super(LogFileStore, self).__init__(**kwargs)
+
+    def connect(self, force_reset=False):
+        if self._offsets is not None and not force_reset:
+            return
+        self.close()
+        self._finish_compact()
+        if force_reset:
+            for path in (self.path, self.index_path, self.sorted_index_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        self._log = open(self.path, "a+b")
+        covered, self._num_records = self._load_sorted_index()
+        index = open(self.index_path, "a+b")
+        index.seek(0)
+        entries = index.read()
+
+        # Drop index entries past the end of the log and index the records
+        # after the last entry, either can be left by an interrupted update.
+        # Entries below the part of the log covered by the sorted index are
+        # left by an interrupted merge and already in the sorted index
+        log_size = os.fstat(self._log.fileno()).st_size
+        self._offsets = {}
+        end, valid = covered, 0
+        for key_hash, offset in struct.iter_unpack(
+            _LOG_ENTRY, entries[: len(entries) - len(entries) % _LOG_ENTRY_SIZE]
+        ):
+            length = self._record_length(offset, log_size)
+            if length is None:
+                break
+            if offset >= covered:
+                self._offsets[key_hash] = offset
+                self._num_records += 1
+            end = max(end, offset + length)
+            valid += 1
+        index.truncate(valid * _LOG_ENTRY_SIZE)
+
+        length = self._record_length(end, log_size)
+        while length is not None:
+            self._log.seek(end)
+            doc = BSON(self._log.read(length)).decode()
+            self._offsets[self._hash(doc[self.key])] = end
+            self._num_records += 1
+            index.write(struct.pack(_LOG_ENTRY, self._hash(doc[self.key]), end))
+            end += length
+            length = self._record_length(end, log_size)
+
+        index.close()
+        self._log.truncate(end)
+        self._num_live = self._num_sorted + sum(
+            1 for key_hash in self._offsets if self._sorted_offset(key_hash) is None
+        )
+
+    def _load_sorted_index(self):
+        """
+        Memory maps the sorted index
+
+        Returns:
+            (covered, num_records): size of the log it covers and
+                number of records in that part of the log
+        """
+        if not os.path.exists(self.sorted_index_path):
+            self._sorted, self._num_sorted = None, 0
+            return 0, 0
+        with open(self.sorted_index_path, "rb") as f:
+            self._sorted = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._num_sorted = (len(self._sorted) - _SORTED_HEADER_SIZE) // _LOG_ENTRY_SIZE
+        return struct.unpack_from(_SORTED_HEADER, self._sorted)
+
+    def close(self):
+        for f in (self._log_map, self._sorted, self._log):
+            if f is not None:
+                f.close()
+        self._log = self._log_map = self._sorted = self._offsets = None
+
+    @property
+    def collection(self):
+        # AttributeError so that code looking for a Mongo collection skips this store
+        raise AttributeError("LogFileStore is not backed by a collection")
+
+    def __hash__(self):
+        return hash((self.path, self.lu_field))
+
+    @staticmethod
+    def _hash(value):
+        """
+        Hash of a key value, distinguishing values of different types
+        except numbers, which hash equal if they compare equal
+        """
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        elif isinstance(value, int) and not isinstance(value, bool):
+            # e.g. bson.int64.Int64, which would be encoded as an int64
+            value = int(value)
+        return hashlib.blake2b(BSON.encode({"k": value}), digest_size=16).digest()
+
+    def _map(self):
+        """Memory map of the log, remapped after it grew"""
+        if self._log_map is None:
+            self._log.flush()
+            self._log_map = mmap.mmap(self._log.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._log_map
+
+    def _record_length(self, offset, log_size):
+        """Length of the complete record at offset or None"""
+        if offset + 4 > log_size:
+            return None
+        self._log.seek(offset)
+        length = struct.unpack("<i", self._log.read(4))[0]
+        return length if length >= 5 and offset + length <= log_size else None
+
+    def _read(self, offset):
+        """Decodes the record at offset"""
+        log = self._map()
+        length = struct.unpack_from("<i", log, offset)[0]
+        return BSON(log[offset : offset + length]).decode()
+
+    def _sorted_entry(self, i):
+        """(key hash, offset) of the i-th entry of the sorted index"""
+        return struct.unpack_from(_LOG_ENTRY, self._sorted, _SORTED_HEADER_SIZE + i * _LOG_ENTRY_SIZE)
+
+    def _sorted_offset(self, key_hash):
+        """Offset of a key hash in the sorted index or None"""
+        i = bisect_left(_SortedIndexHashes(self), key_hash)
+        if i < self._num_sorted:
+            entry_hash, offset = self._sorted_entry(i)
+            if entry_hash == key_hash:
+                return offset
+        return None
+
+    def _lookup(self, key_hash):
+        """Offset of the latest record with a key hash or None"""
+        offset = self._offsets.get(key_hash)
+        return offset if offset is not None else self._sorted_offset(key_hash)
+
+    def _entries(self):
+        """
+        Generator of (key hash, offset) of the latest record of
+        each document, in key hash order
+        """
+        sorted_entries = (
+            entry
+            for entry in map(self._sorted_entry, range(self._num_sorted))
+            if entry[0] not in self._offsets
+        )
+        return heapq.merge(sorted_entries, sorted(self._offsets.items()))
+
+    def _scan(self):
+        """Generator of the latest record of each document, in log order"""
+        offset = 0
+        while self._offsets is not None and offset < os.fstat(self._log.fileno()).st_size:
+            log = self._map()
+            length = struct.unpack_from("<i", log, offset)[0]
+            doc = BSON(log[offset : offset + length]).decode()
+            if self._lookup(self._hash(doc[self.key])) == offset:
+                yield doc
+            offset += length
+
+    def _candidate_offsets(self, criteria):
+        """
+        Offsets of the records that may match criteria, using the
+        index for criteria on Store.key, or None if the log must be
+        scanned
+        """
+        if self._offsets is None:
+            raise StoreError("Must connect LogFileStore before attemping to use it")
+        condition = criteria.get(self.key, {}) if criteria else {}
+        if isinstance(condition, dict) and set(condition) == {"$in"}:
+            values = condition["$in"]
+        elif not isinstance(condition, (dict, list)):
+            values = [condition]
+        else:
+            values = None
+        # Regular expressions match values rather than equal them
+        if values is None or any(isinstance(v, (dict, list)) or is_regex(v) for v in values):
+            return None
+        offsets = (self._lookup(self._hash(v)) for v in values)
+        return sorted(set(o for o in offsets if o is not None))
+
+    def _find(self, criteria=None):
+        """Generator of the documents matching criteria"""
+        offsets = self._candidate_offsets(criteria)
+        docs = self._scan() if offsets is None else (self._read(o) for o in offsets)
+        for doc in docs:
+            if not criteria or filter_applies(criteria, doc):
+                yield doc
+
+    def query(self, criteria=None, properties=None, **kwargs):
+        """
+        Queries the store for documents with property focus.
+
+        Args:
+            criteria (dict): filter for query, matches documents
+                against key-value pairs
+            properties (list or dict): list of properties to return
+                or dictionary with {"property": 1} type structure
+                from standard mongo Collection.find syntax
+            **kwargs (kwargs): sort, skip and limit as for Collection.find
+
+        Returns:
+            MemoryCursor over the matching documents
+        """
+        cursor = MemoryCursor(self._find(criteria), properties, copy=False)
+        if kwargs.get("sort"):
+            cursor.sort(kwargs["sort"])
+        return cursor.skip(kwargs.get("skip", 0)).limit(kwargs.get("limit", 0))
+
+    def query_one(self, criteria=None, properties=None, **kwargs):
+        """
+        Gets a single document from the store with property focus.
+        Returns None if nothing matches
+
+        Args:
+            criteria (dict): filter for query, matches documents
+                against key-value pairs
+            properties (list or dict): list of properties to return
+                or dictionary with {"property": 1} type structure
+                from standard mongo Collection.find syntax
+            **kwargs (kwargs): sort as for Collection.find_one
+        """
+        kwargs["limit"] = 1
+        return next(self.query(criteria=criteria, properties=properties, **kwargs), None)
+
+    def distinct(self, key, criteria=None, all_exist=False, **kwargs):
+        """
+        Gets all distinct values of a key or, for a list of keys,
+        all distinct sets of values
+
+        Args:
+            key (mongolike key or list of mongolike keys): key or keys
+                for which to find distinct values or sets of values.
+            criteria (filter criteria): criteria for filter
+            all_exist (bool): whether to ensure all keys in list exist
+                in each document, defaults to False
+        """
+        if isinstance(key, list):
+            criteria = criteria if criteria else {}
+            if all_exist:
+                criteria.update(
+                    {k: {"$exists": True} for k in key if k not in criteria}
+                )
+            return [d["_id"] for d in self.groupby(key, properties=key, criteria=criteria)]
+        return _distinct_values(self._find(criteria), key)
+
+    def groupby(self, keys, criteria=None, properties=None, **kwargs):
+        """
+        Simple grouping function that will group documents
+        by keys.
+
+        Args:
+            keys (list or string): fields to group documents
+            criteria (dict): filter for documents to group
+            properties (list): properties to return in grouped documents
+
+        Returns:
+            generator of grouped documents with the structure:
+            {'_id': {"KEY_1": value_1, "KEY_2": value_2 ...,
+             'docs': [list_of_documents corresponding to key values]}
+        """
+        return _group_docs(self._find(criteria), keys, properties)
+
+    def update(self, docs, update_lu=True, key=None, **kwargs):
+        """
+        Appends documents to the log, replacing any existing
+        document with the same Store.key
+
+        Args:
+            docs ([dict]): list of documents
+            update_lu (bool): update the last_updated field or not
+            key (str): must be Store.key if given, the log is
+                only indexed on Store.key
+        """
+        if self._offsets is None:
+            raise StoreError("Must connect LogFileStore before attemping to use it")
+        if key and key != self.key:
+            raise StoreError("LogFileStore can only update documents by its key {}".format(self.key))
+
+        docs = self._validate_docs([self.sanitize(d, allow_bson=True) for d in docs])
+        if not docs:
+            return
+
+        self._log.seek(0, os.SEEK_END)
+        entries = []
+        for d in docs:
+            if update_lu:
+                d[self.lu_field] = datetime.utcnow()
+            entries.append((self._hash(d[self.key]), self._log.tell()))
+            self._log.write(BSON.encode(d))
+        # Records are on disk before the index points to them
+        self._log.flush()
+
+        with open(self.index_path, "ab") as index:
+            for key_hash, offset in entries:
+                index.write(struct.pack(_LOG_ENTRY, key_hash, offset))
+        for key_hash, offset in entries:
+            if self._lookup(key_hash) is None:
+                self._num_live += 1
+            self._offsets[key_hash] = offset
+        self._num_records += len(entries)
+
+        if self._log_map is not None:
+            self._log_map.close()
+            self._log_map = None
+
+        stale = self._num_records - self._num_live
+        if (
+            self.max_stale_ratio is not None
+            and self._num_records >= _LOG_MIN_COMPACT_RECORDS
+            and stale > self.max_stale_ratio * self._num_records
+        ):
+            self.compact()
+        elif len(self._offsets) > max(_LOG_MIN_MERGE_ENTRIES, self._num_sorted // 8):
+            self._merge_index()
+
+    def ensure_index(self, key, unique=False, **kwargs):
+        """
+        The log is only indexed on Store.key, which is unique
+
+        Returns:
+            bool indicating if the index exists
+        """
+        return key == self.key
+
+    def compact(self):
+        """
+        Rewrites the log and index with only the latest record of each
+        document, replacing the old files atomically. Records are written
+        in key hash order, so that the new sorted index is written as the
+        log is copied
+        """
+        if self._offsets is None:
+            raise StoreError("Must connect LogFileStore before attemping to use it")
+
+        log_map = self._map() if self._num_live else None
+        num_records = 0
+        with open(self.path + ".compact", "wb") as log, open(
+            self.sorted_index_path + ".compact", "wb"
+        ) as index:
+            index.write(struct.pack(_SORTED_HEADER, 0, 0))
+            for key_hash, offset in self._entries():
+                length = struct.unpack_from("<i", log_map, offset)[0]
+                index.write(struct.pack(_LOG_ENTRY, key_hash, log.tell()))
+                log.write(log_map[offset : offset + length])
+                num_records += 1
+            index.seek(0)
+            index.write(struct.pack(_SORTED_HEADER, log.tell(), num_records))
+            for f in (log, index):
+                f.flush()
+                os.fsync(f.fileno())
+        open(self.index_path + ".compact", "wb").close()
+        _fsync_dir(self.path)
+
+        # The marker commits the new files, so that a swap interrupted
+        # between them is completed on connecting
+        self.close()
+        open(self.path + ".compacted", "wb").close()
+        _fsync_dir(self.path)
+        self._finish_compact()
+        self.connect()
+
+    def _finish_compact(self):
+        """
+        Swaps in the files written by compact if it committed them, and
+        otherwise removes them
+        """
+        committed = os.path.exists(self.path + ".compacted")
+        for path in (self.path, self.sorted_index_path, self.index_path):
+            if os.path.exists(path + ".compact"):
+                if committed:
+                    os.replace(path + ".compact", path)
                 else:
-                    search_doc = {self.key: d[self.key]}
-                if update_lu:
-                    d[self.lu_field] = datetime.utcnow()
-                self.collection.insert_one(d)
+                    os.remove(path + ".compact")
+        if committed:
+            _fsync_dir(self.path)
+            os.remove(self.path + ".compacted")
+
+    def _merge_index(self):
+        """
+        Merges the index entries kept in memory into the sorted index,
+        which then covers the whole log
+        """
+        # The log must be on disk before the sorted index, which isn't checked on connecting
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        log_size = os.fstat(self._log.fileno()).st_size
+        with open(self.sorted_index_path + ".merge", "wb") as index:
+            index.write(struct.pack(_SORTED_HEADER, log_size, self._num_records))
+            for entry in self._entries():
+                index.write(struct.pack(_LOG_ENTRY, *entry))
+            index.flush()
+            os.fsync(index.fileno())
+        if self._sorted is not None:
+            self._sorted.close()
+        os.replace(self.sorted_index_path + ".merge", self.sorted_index_path)
+        _fsync_dir(self.path)
+        # Entries left here by a crash are below the covered log size and ignored
+        open(self.index_path, "wb").close()
+        self._offsets = {}
+        self._load_sorted_index()
+
+
+class _SortedIndexHashes(object):
+    """Sequence of the key hashes in the sorted index of a LogFileStore, to bisect"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store._num_sorted
+
+    def __getitem__(self, i):
+        return self.store._sorted_entry(i)[0]
+
+
+def _fsync_dir(path):
+    """Flushes the directory entries of the directory of path, e.g. after a rename"""
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Index entries of a LogFileStore: 16 byte key hash and record offset
+_LOG_ENTRY = "<16sQ"
+_LOG_ENTRY_SIZE = struct.calcsize(_LOG_ENTRY)
+# Header of a sorted LogFileStore index: size of the log it covers and
+# number of records, including stale ones, in that part of the log
+_SORTED_HEADER = "<QQ"
+_SORTED_HEADER_SIZE = struct.calcsize(_SORTED_HEADER)
+# Logs with fewer records aren't compacted automatically
+_LOG_MIN_COMPACT_RECORDS = 1000
+# In-memory index entries merged into the sorted index, at least
+_LOG_MIN_MERGE_ENTRIES = 4096
 
 
 class JSONStore(MemoryStore):
@@ -544,31 +2119,250 @@ class JSONStore(MemoryStore):
     A Store for access to a single or multiple JSON files
     """
 
-    def __init__(self, paths, **kwargs):
+    def __init__(self, paths, lazy=False, batch_size=1000, num_workers=1,
+                 show_progress=False, write_back=None, flush_interval=0,
+                 max_segments=None, **kwargs):
         """
         Args:
             paths (str or list): paths for json files to
                 turn into a Store
+            lazy (bool): defer loading the files until the store is
+                first used. query_one without a sort then only loads files
+                until a match is found, which assumes each document is in
+                a single file
+            batch_size (int): number of documents parsed from a file
+                before inserting them into the store
+            num_workers (int): number of processes decompressing and
+                parsing files in parallel, files are still inserted
+                in the order of paths
+            show_progress (bool): show a progress bar of the loaded files
+            write_back (str): directory to persist updates in. Updated
+                documents are appended as gzipped JSON Lines segments,
+                which are loaded after paths on connect
+            flush_interval (float): minimum seconds between writing
+                segments on update, 0 writes one on every update
+            max_segments (int): number of segments after which they
+                are merged with all other documents into one snapshot,
+                by default only when calling compact() since a snapshot
+                rewrites every document
         """
         paths = paths if isinstance(paths, (list, tuple)) else [paths]
         self.paths = paths
+        self.lazy = lazy
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.show_progress = show_progress
+        self.write_back = write_back
+        self.flush_interval = flush_interval
+        self.max_segments = max_segments
+        self._unloaded = []
+        self._loading = False
+        self._dirty = set()
+        self._last_flush = time.time()
         self.kwargs = kwargs
         super(JSONStore, self).__init__("collection", **kwargs)
 
     def connect(self, force_reset=False):
+        if self._collection is None or force_reset:
+            self._unloaded = list(self.paths) + self._write_back_files()
+            self._dirty = set()
         super(JSONStore, self).connect(force_reset=force_reset)
-        for path in self.paths:
-            with zopen(path) as f:
-                data = f.read()
-                data = data.decode() if isinstance(data, bytes) else data
-                objects = json.loads(data)
-                objects = [objects] if not isinstance(objects, list) else objects
-                self.update(objects)
+        if not self.lazy:
+            self._load(len(self._unloaded))
+
+    @property
+    def collection(self):
+        if self._unloaded and not self._loading:
+            self._load(len(self._unloaded))
+        return super(JSONStore, self).collection
+
+    def _load(self, num_files):
+        """
+        Streams the next num_files files into the store, in batches
+        of batch_size documents
+        """
+        paths = self._unloaded[:num_files]
+        self._loading = True
+        try:
+            for path, objects in tqdm(
+                self._read_files(paths),
+                desc="Loading JSON files",
+                total=len(paths),
+                disable=not self.show_progress,
+            ):
+                # Write-back files keep the last_updated of their documents
+                update_lu = path in self.paths
+                for batch in iter(lambda: list(islice(objects, self.batch_size)), []):
+                    self.update(batch, update_lu=update_lu)
+                self._unloaded.remove(path)
+        finally:
+            self._loading = False
+
+    def _read_files(self, paths):
+        """
+        Generator of (path, iterator over its documents) in the order of
+        paths, parsing ahead in a process pool if num_workers > 1
+        """
+        if self.num_workers <= 1 or len(paths) <= 1:
+            for path in paths:
+                with zopen(path, "rt", encoding="utf-8") as f:
+                    yield path, _iter_json_docs(f, path)
+            return
+
+        paths = iter(paths)
+        with ProcessPoolExecutor(self.num_workers) as executor:
+            # Keep a bounded number of parsed files waiting to be inserted
+            pending = deque(
+                (path, executor.submit(_read_json_file, path))
+                for path in islice(paths, 2 * self.num_workers)
+            )
+            while pending:
+                path, future = pending.popleft()
+                for next_path in islice(paths, 1):
+                    pending.append((next_path, executor.submit(_read_json_file, next_path)))
+                yield path, iter(future.result())
+
+    def query_one(self, criteria=None, properties=None, **kwargs):
+        """
+        Function that gets a single document from the JSON files
+
+        Args:
+            criteria (dict): filter for query, matches documents
+                against key-value pairs
+            properties (list or dict): list of properties to return
+                or dictionary with {"property": 1} type structure
+                from standard mongo Collection.find syntax
+            **kwargs (kwargs): further kwargs to Collection.find_one
+        """
+        # Look through the files loaded so far before loading another one,
+        # unless a write-back segment could replace the document found
+        while self._unloaded and "sort" not in kwargs and set(self._unloaded) <= set(self.paths):
+            self._loading = True
+            try:
+                doc = super(JSONStore, self).query_one(criteria, properties, **kwargs)
+            finally:
+                self._loading = False
+            if doc is not None:
+                return doc
+            self._load(1)
+        return super(JSONStore, self).query_one(criteria, properties, **kwargs)
+
+    def update(self, docs, update_lu=True, key=None, **kwargs):
+        """
+        Function to update the in-memory collection, documents are marked
+        for writing to the next segment in write-back mode
+
+        Args:
+            docs ([dict]): list of documents
+            update_lu (bool): update the last_updated field or not
+            key (list or str): field or fields identifying a document,
+                defaults to Store.key
+        """
+        if not (self.write_back and not self._loading):
+            return super(JSONStore, self).update(docs, update_lu=update_lu, key=key, **kwargs)
+
+        docs = list(docs)
+        result = super(JSONStore, self).update(docs, update_lu=update_lu, key=key, **kwargs)
+        self._dirty.update(d[self.key] for d in docs)
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+        return result
+
+    def _write_back_files(self):
+        """
+        The latest snapshot and the segments written after it, in order
+        """
+        if not self.write_back or not os.path.isdir(self.write_back):
+            return []
+        files = sorted(
+            (int(f.split("-")[1].split(".")[0]), not f.startswith("snapshot"), f)
+            for f in os.listdir(self.write_back)
+            if f.startswith(("segment-", "snapshot-")) and f.endswith(".jsonl.gz")
+        )
+        snapshots = [i for i, (n, is_segment, f) in enumerate(files) if not is_segment]
+        files = files[snapshots[-1]:] if snapshots else files
+        return [os.path.join(self.write_back, f) for n, is_segment, f in files]
+
+    def _write_jsonl(self, docs, prefix, number):
+        """
+        Atomically writes docs to a gzipped JSON Lines file in write_back
+        """
+        path = self._write_back_path(prefix, number)
+        tmp_path = os.path.join(self.write_back, ".tmp-" + os.path.basename(path))
+        with zopen(tmp_path, "wt", encoding="utf-8") as f:
+            for doc in docs:
+                doc.pop("_id", None)
+                f.write(json_util.dumps(doc) + "\n")
+        os.replace(tmp_path, path)
+        return path
+
+    def flush(self):
+        """
+        Writes the documents updated since the last flush to a new
+        segment, and merges the segments into a snapshot once there
+        are more than max_segments of them
+        """
+        self._last_flush = time.time()
+        if not self.write_back or not self._dirty:
+            return
+        os.makedirs(self.write_back, exist_ok=True)
+
+        files = self._write_back_files()
+        number = int(os.path.basename(files[-1]).split("-")[1].split(".")[0]) + 1 if files else 0
+        keys = list(self._dirty)
+        self._write_jsonl(self.query({self.key: {"$in": keys}}), "segment", number)
+        self._dirty = set()
+
+        if self.max_segments and len(files) + 1 > self.max_segments:
+            self.compact()
+
+    def compact(self):
+        """
+        Merges the write-back segments with all other documents into
+        one snapshot
+        """
+        self.flush()
+        files = self._write_back_files()
+        if not files:
+            return
+        number = int(os.path.basename(files[-1]).split("-")[1].split(".")[0])
+        snapshot = self._write_jsonl(self.query(), "snapshot", number)
+        # The snapshot replaces every earlier file once written
+        for path in files:
+            if path != snapshot:
+                os.remove(path)
+
+    def _write_back_path(self, prefix, number):
+        return os.path.join(self.write_back, "{}-{:08d}.jsonl.gz".format(prefix, number))
+
+    def close(self):
+        if self.write_back:
+            self.flush()
+        super(JSONStore, self).close()
 
     def __hash__(self):
         return hash((*self.paths, self.lu_field))
 
 
+def _iter_json_docs(f, path):
+    """Documents in a JSON file, or in a JSON Lines write-back file"""
+    if ".jsonl" in path:
+        return (json_util.loads(line) for line in f if line.strip())
+    return iter_json(f)
+
+
+def _read_json_file(path):
+    """
+    Documents in a JSON file, run in JSONStore's process pool. The whole
+    file is parsed at once since the documents are sent back as a list
+    """
+    with zopen(path, "rt", encoding="utf-8") as f:
+        if ".jsonl" in path:
+            return list(_iter_json_docs(f, path))
+        objects = json.loads(f.read())
+    return objects if isinstance(objects, list) else [objects]
+
+
 class DatetimeStore(MemoryStore):
     """Utility store intended for use with `Store.lu_filter`."""
 
@@ -615,8 +2409,41 @@ class GridFSStore(Store):
         username="",
         password="",
         compression=False,
+        compression_level=None,
+        compression_dict=None,
+        serialization="json",
+        num_readers=1,
+        searchable_fields=None,
+        cache_path=None,
+        cache_size=2 ** 30,
         **kwargs
     ):
+        """
+        Args:
+            database (str): database name
+            collection_name (str): name of the GridFS bucket
+            host (str): hostname for the database
+            port (int): port for the database
+            username (str): username for the database
+            password (str): password for the database
+            compression (bool or str): codec to compress the stored data
+                with, True for zlib. See maggma.compression for the codecs,
+                data stored with any of them can be read
+            compression_level (int): compression level of the codec
+            compression_dict (bytes): trained dictionary for zstd
+            serialization (str): format of the stored data, "json", "bson"
+                or "msgpack". See maggma.serialization for the formats,
+                data stored in any of them can be read
+            num_readers (int): number of files read and decoded
+                concurrently by query, 1 reads them one at a time
+            searchable_fields (list): small fields also stored in the
+                file metadata, so queries projecting only these fields
+                are answered without reading the files
+            cache_path (str): directory of a local cache of the read
+                files, which can be shared between processes. See
+                maggma.cache.DiskCache
+            cache_size (int): size in bytes of the local cache
+        """
 
         self.database = database
         self.collection_name = collection_name
@@ -626,8 +2453,20 @@ class GridFSStore(Store):
         self.password = password
         self._collection = None
         self.compression = compression
+        self.compression_level = compression_level
+        self.compression_dict = compression_dict
+        self._codec_name, self._codec = get_codec(compression, compression_level, compression_dict)
+        self._codecs = {self._codec_name: self._codec} if self._codec_name else {}
+        self.serialization = serialization
+        self._serializer = get_serializer(serialization)
+        self.num_readers = num_readers
+        self.searchable_fields = searchable_fields or []
+        self.cache_path = cache_path
+        self.cache_size = cache_size
+        self._cache = DiskCache(cache_path, cache_size) if cache_path else None
         self.kwargs = kwargs
         self.meta_keys = set()
+        self._indexed_keys = set()
 
         if "key" not in kwargs:
             kwargs["key"] = "_id"
@@ -680,7 +2519,7 @@ class GridFSStore(Store):
         Args:
             criteria (dict): Query criteria
         """
-        for field in criteria:
+        for field in list(criteria):
             if field not in cls.files_collection_fields and not field.startswith(
                 "metadata."
             ):
@@ -689,45 +2528,84 @@ class GridFSStore(Store):
 
     def query(self, criteria=None, properties=None, **kwargs):
         """
-        Function that gets data from GridFS. This store ignores all
-        property projections as its designed for whole document access
+        Function that gets data from GridFS. Projections of the key, the
+        last updated field and the searchable fields are answered from the
+        metadata of files written with those searchable fields, other
+        projections are applied to the read documents
 
         Args:
             criteria (dict): filter for query, matches documents
                 against key-value pairs
-            properties (list or dict): This will be ignored by the GridFS
-                Store
+            properties (list or dict): properties to return in the
+                documents
+            num_readers (int): number of files to read and decode
+                concurrently, defaults to GridFSStore.num_readers
             **kwargs (kwargs): further kwargs to Collection.find
         """
+        num_readers = kwargs.pop("num_readers", self.num_readers)
         if isinstance(criteria, dict):
             self.transform_criteria(criteria)
-        for f in self.collection.find(filter=criteria, **kwargs):
+
+        covered = _covered(properties, {self.key, self.lu_field} | set(self.searchable_fields))
+
+        def read(f):
+            # Files written before a field was searchable aren't covered
+            metadata = f.metadata or {}
+            fields = {self.key, self.lu_field} | set(metadata.get("searchable_fields", []))
+            if covered and _covered(properties, fields):
+                return metadata
+            return self._read(f)
+
+        files = self.collection.find(criteria, **kwargs)
+
+        # Read ahead while earlier documents are consumed, keeping the order
+        for doc in threaded_imap(read, files, num_readers):
+            if properties and isinstance(doc, dict):
+                doc = _project(doc, properties)
+            yield doc
+
+    def _read(self, f):
+        """
+        Reads and decodes the data of a GridOut file, through the local
+        cache if there is one
+        """
+        metadata = f.metadata
+        if self._cache:
+            cache_key = (metadata.get(self.key, f._id), f.upload_date)
+            data = self._cache.get(*cache_key)
+            if data is None:
+                data = f.read()
+                self._cache.put(cache_key[0], cache_key[1], data)
+        else:
             data = f.read()
 
-            metadata = f.metadata
-            if metadata.get("compression", "") == "zlib":
-                data = zlib.decompress(data).decode("UTF-8")
+        if metadata.get("compression"):
+            data = decompress(data, metadata["compression"], self._codecs)
 
-            try:
-                data = json.loads(data)
-            except:
-                pass
-            yield data
+        serialization = metadata.get("serialization")
+        try:
+            data = get_serializer(serialization).loads(data)
+        except ValueError:
+            # Files put without a serialization may not be JSON and are
+            # returned as stored
+            if serialization:
+                raise
+        return data
 
     def query_one(self, criteria=None, properties=None, **kwargs):
         """
-        Function that gets a single document from GridFS. This store
-        ignores all property projections as its designed for whole
-        document access
+        Function that gets a single document from GridFS, projected as
+        in GridFSStore.query
 
         Args:
             criteria (dict): filter for query, matches documents
                 against key-value pairs
-            properties (list or dict): This will be ignored by the GridFS
-                Store
+            properties (list or dict): properties to return in the
+                document
             **kwargs (kwargs): further kwargs to Collection.find
         """
-        return next(self.query(criteria=criteria, **kwargs), None)
+        kwargs["num_readers"] = 1
+        return next(self.query(criteria=criteria, properties=properties, **kwargs), None)
 
     def distinct(self, key, criteria=None, all_exist=False, **kwargs):
         """
@@ -831,7 +2709,7 @@ class GridFSStore(Store):
             except:
                 return False
 
-    def update(self, docs, update_lu=True, key=None):
+    def update(self, docs, update_lu=True, key=None, batch_size=1000):
         """
         Function to update associated MongoStore collection.
 
@@ -839,6 +2717,8 @@ class GridFSStore(Store):
             docs ([dict]): list of documents
             update_lu (bool) : Updat the last_updated field or not
             key (list or str): list or str of important parameters
+            batch_size (int): number of files written before removing
+                the versions they replace in one go
         """
         if isinstance(key, str):
             key = [key]
@@ -846,36 +2726,108 @@ class GridFSStore(Store):
             key = [self.key]
 
         key = list(set(key) | self.meta_keys - set(self.files_collection_fields))
+        for k in key:
+            if k not in self._indexed_keys:
+                self.ensure_index(k)
+                self._indexed_keys.add(k)
+
+        docs = iter(docs)
+        for batch in iter(lambda: list(islice(docs, batch_size)), []):
+            # Latest file id for each search doc, later docs in the batch win
+            new_files = {}
+            for d in batch:
+
+                search_doc = {k: d[k] for k in key}
+                if update_lu:
+                    d[self.lu_field] = datetime.utcnow()
 
-        for d in docs:
-
-            search_doc = {k: d[k] for k in key}
-            if update_lu:
-                d[self.lu_field] = datetime.utcnow()
-
-            metadata = {self.lu_field: d[self.lu_field]}
-            metadata.update(search_doc)
+                metadata = {self.lu_field: d[self.lu_field]}
+                for field in self.searchable_fields:
+                    if has(d, field):
+                        set_(metadata, field, get(d, field))
+                metadata["searchable_fields"] = list(self.searchable_fields)
+                metadata.update(search_doc)
+
+                data = self._serializer.dumps(d, self.sanitize)
+                metadata["serialization"] = self.serialization
+                if self._codec_name:
+                    data = self._codec.compress(data)
+                    metadata["compression"] = self._codec_name
+
+                file_id = self.collection.put(data, metadata=metadata)
+                self.transform_criteria(search_doc)
+                new_files[_freeze(search_doc)] = (search_doc, file_id)
+
+            self._remove_old_files(
+                [search_doc for search_doc, _ in new_files.values()],
+                [file_id for _, file_id in new_files.values()],
+            )
 
-            data = json.dumps(jsanitize(d)).encode("UTF-8")
-            if self.compression:
-                data = zlib.compress(data)
-                metadata["compression"] = "zlib"
+    @property
+    def cache_stats(self):
+        """
+        Hits, misses and size of the local cache, None without one
+        """
+        return self._cache.stats if self._cache else None
 
-            self.collection.put(data, metadata=metadata)
-            self.transform_criteria(search_doc)
+    def _remove_old_files(self, search_docs, keep_ids):
+        """
+        Deletes the files matching any of search_docs, except for
+        keep_ids, along with their chunks
+        """
+        fields = set(field for search_doc in search_docs for field in search_doc)
+        if len(fields) == 1:
+            field = fields.pop()
+            match = {field: {"$in": [search_doc[field] for search_doc in search_docs]}}
+        else:
+            match = {"$or": search_docs}
 
-            # Cleans up old gridfs entries
-            for fdoc in (
-                self._files_collection.find(search_doc, ["_id"])
-                .sort("uploadDate", -1)
-                .skip(1)
-            ):
-                self.collection.delete(fdoc["_id"])
+        pipeline = [
+            {"$match": {"$and": [match, {"_id": {"$nin": keep_ids}}]}},
+            {"$group": {"_id": None, "ids": {"$push": "$_id"}}},
+        ]
+        old_ids = [i for d in self._files_collection.aggregate(pipeline) for i in d["ids"]]
+        if old_ids:
+            # Files first, so a failure never leaves a file without its chunks
+            self._files_collection.delete_many({"_id": {"$in": old_ids}})
+            self._chunks_collection.delete_many({"files_id": {"$in": old_ids}})
 
     def close(self):
         self.collection.database.client.close()
 
 
+def merge_bulk_write_results(results):
+    """
+    Combines the results of several bulk writes into one BulkWriteResult
+
+    Args:
+        results ([(int, BulkWriteResult or dict)]): results or bulk API
+            results of each bulk write, along with the offset of its first
+            request in the combined requests
+    """
+    combined = {
+        "writeErrors": [],
+        "writeConcernErrors": [],
+        "nInserted": 0,
+        "nUpserted": 0,
+        "nMatched": 0,
+        "nModified": 0,
+        "nRemoved": 0,
+        "upserted": [],
+    }
+    for offset, result in results:
+        api_result = getattr(result, "bulk_api_result", result)
+        for field in ("nInserted", "nUpserted", "nMatched", "nModified", "nRemoved"):
+            combined[field] += api_result.get(field, 0)
+        for field in ("upserted", "writeErrors"):
+            combined[field].extend(
+                dict(u, index=u["index"] + offset) for u in api_result.get(field, [])
+            )
+        combined["writeConcernErrors"].extend(api_result.get("writeConcernErrors", []))
+    combined["writeErrors"].sort(key=itemgetter("index"))
+    return BulkWriteResult(combined, True)
+
+
 class StoreError(Exception):
     """General Store-related error."""
 
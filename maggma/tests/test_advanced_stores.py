@@ -4,14 +4,20 @@ Tests for advanced stores
 """
 import time
 
+import hashlib
+import io
+import json
 import os
+import re
 import shutil
 import signal
 import subprocess
 import tempfile
+import threading
 import unittest
 
-from itertools import chain
+from datetime import datetime
+from itertools import chain, islice
 from mongogrant.client import seed
 from pymongo import MongoClient
 from pymongo.collection import Collection
@@ -19,9 +25,16 @@ from unittest.mock import patch, MagicMock
 import mongomock.collection
 from uuid import uuid4
 
-from maggma.stores import MemoryStore, MongoStore
+from maggma.stores import IndexedMemoryStore, MemoryStore, MongoStore
 from maggma.advanced_stores import *
+from maggma.advanced_stores import _interleave, _merge_sorted
+from maggma.builders import CopyBuilder
 import zlib
+from maggma.cache import DiskCache
+from maggma.compression import get_codec, lz4_import
+from maggma.serialization import get_serializer
+from maggma.partition import HashPartition
+import numpy as np
 
 module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
 
@@ -155,6 +168,93 @@ class TestVaultStore(unittest.TestCase):
             self._create_vault_store()
 
 
+class LocalS3Bucket:
+    """
+    Stand-in for a boto3 S3 Bucket resource keeping objects in a local
+    directory, supporting the calls made by AmazonS3Store
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = LocalS3Objects(self)
+
+    def _path(self, key):
+        return os.path.join(self.path, key)
+
+    def put_object(self, Key, Body, Metadata=None):
+        os.makedirs(os.path.dirname(self._path(Key)), exist_ok=True)
+        with open(self._path(Key), "wb") as f:
+            f.write(Body)
+        with open(self._path(Key) + ".metadata", "w") as f:
+            json.dump(Metadata or {}, f)
+
+    def upload_fileobj(self, Fileobj, Key, ExtraArgs=None, Config=None):
+        self.put_object(Key=Key, Body=Fileobj.read(), Metadata=(ExtraArgs or {}).get("Metadata"))
+
+    def Object(self, key):
+        return LocalS3Object(self, key)
+
+    def e_tag(self, key):
+        with open(self._path(key), "rb") as f:
+            return '"{}"'.format(hashlib.md5(f.read()).hexdigest())
+
+
+class LocalS3Object:
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+
+    @property
+    def metadata(self):
+        with open(self.bucket._path(self.key) + ".metadata") as f:
+            return json.load(f)
+
+    @property
+    def e_tag(self):
+        return self.bucket.e_tag(self.key)
+
+    def put(self, Body, Metadata=None):
+        self.bucket.put_object(Key=self.key, Body=Body, Metadata=Metadata)
+        return {"ETag": self.e_tag}
+
+    def get(self):
+        if not os.path.exists(self.bucket._path(self.key)):
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "NoSuchKey"}}, "GetObject"
+            )
+        with open(self.bucket._path(self.key), "rb") as f:
+            return {"Body": io.BytesIO(f.read()), "Metadata": self.metadata}
+
+
+class LocalS3Objects:
+    def __init__(self, bucket, prefix="", marker="", size=1000):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.marker = marker
+        self.size = size
+
+    def all(self):
+        keys = []
+        for root, _, files in os.walk(self.bucket.path):
+            for name in files:
+                if not name.endswith(".metadata"):
+                    keys.append(os.path.relpath(os.path.join(root, name), self.bucket.path))
+        for key in sorted(keys):
+            if key.startswith(self.prefix) and key > self.marker:
+                yield LocalS3Object(self.bucket, key)
+
+    def filter(self, Prefix="", Marker=""):
+        return LocalS3Objects(self.bucket, Prefix, Marker, self.size)
+
+    def page_size(self, count):
+        return LocalS3Objects(self.bucket, self.prefix, self.marker, count)
+
+    def pages(self):
+        objects = iter(self.all())
+        for page in iter(lambda: list(islice(objects, self.size)), []):
+            yield page
+
+
 class TestS3Store(unittest.TestCase):
     def setUp(self):
         self.index = MemoryStore("index'")
@@ -163,38 +263,207 @@ class TestS3Store(unittest.TestCase):
             mock_resource("s3").list_buckets.return_value = ["bucket1", "bucket2"]
             self.s3store = AmazonS3Store(self.index, "bucket1")
             self.s3store.connect()
+        self.put = self.s3store.s3_bucket.Object.return_value.put
+        self.put.return_value = {"ETag": '"etag"'}
+        self.tmp_dir = tempfile.mkdtemp()
 
     def test_qeuery_one(self):
         self.s3store.s3_bucket.Object.return_value = MagicMock()
-        self.s3store.s3_bucket.Object().get.return_value = '{"task_id": "mp-1", "data": "asd"}'
+        self.s3store.s3_bucket.Object().get.return_value = {"Body": io.BytesIO(b'{"task_id": "mp-1", "data": "asd"}')}
         self.index.update([{"task_id": "mp-1"}])
         self.assertEqual(self.s3store.query_one(criteria={"task_id": "mp-2"}), None)
         self.assertEqual(self.s3store.query_one(criteria={"task_id": "mp-1"})["data"], "asd")
 
-        self.s3store.s3_bucket.Object().get.return_value = zlib.compress('{"task_id": "mp-3", "data": "sdf"}'.encode())
+        self.s3store.s3_bucket.Object().get.return_value = {
+            "Body": io.BytesIO(zlib.compress('{"task_id": "mp-3", "data": "sdf"}'.encode()))
+        }
         self.index.update([{"task_id": "mp-3", "compression": "zlib"}])
         self.assertEqual(self.s3store.query_one(criteria={"task_id": "mp-3"})["data"], "sdf")
 
     def test_update(self):
 
         self.s3store.update([{"task_id": "mp-1", "data": "asd"}])
-        self.assertEqual(self.s3store.s3_bucket.put_object.call_count, 1)
-        called_kwargs = self.s3store.s3_bucket.put_object.call_args[1]
-        self.assertEqual(self.s3store.s3_bucket.put_object.call_count, 1)
-        self.assertEqual(called_kwargs["Key"], "mp-1")
+        self.assertEqual(self.put.call_count, 1)
+        called_kwargs = self.put.call_args[1]
+        self.assertEqual(self.s3store.s3_bucket.Object.call_args[0][0], "mp-1")
         self.assertTrue(len(called_kwargs["Body"]) > 0)
         self.assertEqual(called_kwargs["Metadata"]["task_id"], "mp-1")
+        self.assertEqual(self.index.query_one()["etag"], '"etag"')
 
     def test_update_compression(self):
         self.s3store.update([{"task_id": "mp-1", "data": "asd"}], compress=True)
-        self.assertEqual(self.s3store.s3_bucket.put_object.call_count, 1)
-        called_kwargs = self.s3store.s3_bucket.put_object.call_args[1]
-        self.assertEqual(self.s3store.s3_bucket.put_object.call_count, 1)
-        self.assertEqual(called_kwargs["Key"], "mp-1")
+        self.assertEqual(self.put.call_count, 1)
+        called_kwargs = self.put.call_args[1]
+        self.assertEqual(self.s3store.s3_bucket.Object.call_args[0][0], "mp-1")
         self.assertTrue(len(called_kwargs["Body"]) > 0)
         self.assertEqual(called_kwargs["Metadata"]["task_id"], "mp-1")
         self.assertEqual(called_kwargs["Metadata"]["compression"], "zlib")
 
+    def test_update_codec(self):
+        self.s3store.compression = "zlib"
+        self.s3store._codec_name, self.s3store._codec = get_codec("zlib", 9)
+        self.s3store.update([{"task_id": "mp-1", "data": "asd"}])
+        called_kwargs = self.put.call_args[1]
+        self.assertEqual(called_kwargs["Metadata"]["compression"], "zlib")
+
+        self.s3store.update([{"task_id": "mp-2", "data": "asd"}], compress=False)
+        called_kwargs = self.put.call_args[1]
+        self.assertNotIn("compression", called_kwargs["Metadata"])
+
+        with self.assertRaises(ValueError):
+            self.s3store.update([{"task_id": "mp-3", "data": "asd"}], compress="unknown")
+
+    @unittest.skipUnless(lz4_import, "lz4 not installed")
+    def test_query_one_codec(self):
+        data = '{"task_id": "mp-4", "data": "fgh"}'.encode()
+        self.s3store.s3_bucket.Object.return_value = MagicMock()
+        self.s3store.s3_bucket.Object().get.return_value = {"Body": io.BytesIO(get_codec("lz4")[1].compress(data))}
+        self.index.update([{"task_id": "mp-4", "compression": "lz4"}])
+        self.assertEqual(self.s3store.query_one(criteria={"task_id": "mp-4"})["data"], "fgh")
+
+    def test_serialization(self):
+        self.s3store.serialization = "bson"
+        self.s3store._serializer = get_serializer("bson")
+        self.s3store.update([{"task_id": "mp-5", "data": np.arange(3)}])
+        called_kwargs = self.put.call_args[1]
+        self.assertEqual(called_kwargs["Metadata"]["serialization"], "bson")
+
+        self.s3store.s3_bucket.Object.return_value = MagicMock()
+        self.s3store.s3_bucket.Object().get.return_value = {"Body": io.BytesIO(called_kwargs["Body"])}
+        doc = self.s3store.query_one(criteria={"task_id": "mp-5"})
+        self.assertEqual(doc["data"].tolist(), [0, 1, 2])
+
+
+    def test_local_bucket(self):
+        self.s3store.s3_bucket = LocalS3Bucket(self.tmp_dir)
+        self.s3store.num_workers = 4
+        self.s3store.multipart_threshold = 2000
+        docs = [{"task_id": "mp-{}".format(i), "data": "x" * 100 * i} for i in range(50)]
+        self.s3store.update(docs, key="data", batch_size=16)
+        self.assertEqual(self.index.collection.count_documents({}), 50)
+        self.assertEqual(self.s3store.s3_bucket.Object("mp-3").metadata["task_id"], "mp-3")
+
+        # Prefetched documents come in the order of the index
+        docs = list(self.s3store.query(sort=[("data", 1)]))
+        self.assertEqual([d["task_id"] for d in docs], ["mp-{}".format(i) for i in range(50)])
+        self.assertEqual(self.s3store.query_one({"task_id": "mp-49"})["data"], "x" * 4900)
+
+        # Missing objects are skipped
+        os.remove(os.path.join(self.tmp_dir, "mp-1"))
+        self.assertIsNone(self.s3store.query_one({"task_id": "mp-1"}))
+        self.assertEqual(len(list(self.s3store.query(num_workers=2))), 49)
+
+    def test_builder_target(self):
+        self.s3store.s3_bucket = LocalS3Bucket(self.tmp_dir)
+        source = MemoryStore("source")
+        source.connect()
+        source.update([{"task_id": "mp-{}".format(i), "data": i} for i in range(3)])
+        builder = CopyBuilder(source, self.s3store)
+        builder.run()
+        # Builders write with update_lu=False, the index keeps the source timestamps
+        self.assertEqual(self.index.query_one({"task_id": "mp-1"})["last_updated"],
+                         source.query_one({"task_id": "mp-1"})["last_updated"])
+        self.assertEqual(list(builder.get_items()), [])
+
+        source.update([{"task_id": "mp-1", "data": 10}])
+        self.assertEqual([d["task_id"] for d in builder.get_items()], ["mp-1"])
+        self.s3store.update([{"task_id": "mp-4", "data": 4}])
+        lu = self.index.query_one({"task_id": "mp-4"})["last_updated"]
+        self.assertLess(abs((datetime.utcnow() - lu).total_seconds()), 60)
+
+    def test_searchable_fields(self):
+        self.s3store.s3_bucket = LocalS3Bucket(self.tmp_dir)
+        self.s3store.searchable_fields = ["energy", "output.natoms"]
+        self.s3store.update([{"task_id": "mp-1", "energy": -1.5, "output": {"natoms": 2, "data": "x"}}])
+        self.assertEqual(self.index.query_one()["output"], {"natoms": 2})
+
+        # Answered from the index alone
+        shutil.rmtree(self.tmp_dir)
+        doc = self.s3store.query_one(properties=["task_id", "energy", "output.natoms"])
+        self.assertEqual(doc["energy"], -1.5)
+        self.assertEqual(doc["output"], {"natoms": 2})
+        self.assertNotIn("compression", doc)
+        self.assertIsNone(self.s3store.query_one(properties={"output.data": 1}))
+
+        # Other projections are applied to the downloaded documents
+        self.s3store.update([{"task_id": "mp-1", "energy": -1.5, "output": {"natoms": 2, "data": "x"}}])
+        doc = self.s3store.query_one(properties={"output.data": 1, "_id": 0})
+        self.assertEqual(doc, {"output": {"data": "x"}})
+
+        # Objects written before a field was searchable are downloaded
+        self.s3store.searchable_fields = ["energy", "output"]
+        doc = self.s3store.query_one(properties={"output.data": 1, "_id": 0})
+        self.assertEqual(doc, {"output": {"data": "x"}})
+
+    def test_cache(self):
+        self.s3store.s3_bucket = LocalS3Bucket(os.path.join(self.tmp_dir, "bucket"))
+        self.s3store._cache = DiskCache(os.path.join(self.tmp_dir, "cache"))
+        self.s3store.update([{"task_id": "mp-{}".format(i), "data": i} for i in range(5)])
+        self.assertEqual(len(list(self.s3store.query())), 5)
+        self.assertEqual(self.s3store.cache_stats["misses"], 5)
+
+        # Cached objects are read without downloading them
+        shutil.rmtree(os.path.join(self.tmp_dir, "bucket"))
+        self.assertEqual(self.s3store.query_one({"task_id": "mp-3"})["data"], 3)
+        self.assertEqual(self.s3store.cache_stats["hits"], 1)
+
+        # Updated documents are downloaded again
+        self.s3store.update([{"task_id": "mp-3", "data": 10}])
+        self.assertEqual(self.s3store.query_one({"task_id": "mp-3"})["data"], 10)
+        self.assertEqual(self.s3store.cache_stats["misses"], 6)
+
+        # Rewrites keeping the last updated field or changing the codec too
+        lu = self.index.query_one({"task_id": "mp-3"})["last_updated"]
+        self.s3store.update([{"task_id": "mp-3", "data": 11, "last_updated": lu}], update_lu=False)
+        self.assertEqual(self.s3store.query_one({"task_id": "mp-3"})["data"], 11)
+        self.s3store.update([{"task_id": "mp-3", "data": 11, "last_updated": lu}], update_lu=False,
+                            compress=True)
+        self.assertEqual(self.s3store.query_one({"task_id": "mp-3"})["data"], 11)
+        self.assertEqual(self.s3store.cache_stats["misses"], 8)
+
+        # Objects indexed without an ETag aren't cached
+        self.index.update([{"task_id": "mp-9"}])
+        self.assertIsNone(self.s3store.query_one({"task_id": "mp-9"}))
+        self.assertEqual(self.s3store.cache_stats["misses"], 8)
+
+    def test_rebuild_index_from_s3_data(self):
+        self.s3store.s3_bucket = LocalS3Bucket(self.tmp_dir)
+        self.s3store.searchable_fields = ["n", "output"]
+        docs = [
+            {"task_id": "{}-{}".format(p, i), "n": i, "output": {"ok": True}, "name": str(i)}
+            for p in ["mp", "mvc"] for i in range(10)
+        ]
+        self.s3store.update(docs, key="name")
+        index_docs = {d["task_id"]: d for d in self.index.query(properties={"_id": 0})}
+        metadata = self.s3store.s3_bucket.Object("mp-1").metadata
+        self.assertEqual(metadata["task_id"], "mp-1")
+        self.assertEqual(metadata["name"], '"1"')
+
+        # Interrupted after the first page of each prefix
+        self.index.collection.delete_many({})
+        checkpoint_path = os.path.join(self.tmp_dir, "checkpoint.json")
+        with open(checkpoint_path, "w") as f:
+            json.dump({"mp-": "mp-3", "mvc-": "mvc-3"}, f)
+        self.s3store.rebuild_index_from_s3_data(
+            prefixes=["mp-", "mvc-"], num_workers=3, page_size=4, checkpoint_path=checkpoint_path
+        )
+        self.assertEqual(
+            sorted(self.index.distinct("task_id")),
+            sorted(k for k in index_docs if k.split("-")[1] > "3"),
+        )
+        self.assertFalse(os.path.exists(checkpoint_path))
+
+        self.s3store.rebuild_index_from_s3_data(page_size=3)
+        rebuilt = {d["task_id"]: d for d in self.index.query(properties={"_id": 0})}
+        # Datetimes are kept with millisecond precision
+        for k, d in rebuilt.items():
+            lu = index_docs[k].pop("last_updated")
+            self.assertLess(abs(d.pop("last_updated") - lu).total_seconds(), 1e-3)
+        self.assertEqual(rebuilt, index_docs)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
 
 class TestAliasingStore(unittest.TestCase):
     def setUp(self):
@@ -433,6 +702,27 @@ class ConcatStoreTest(unittest.TestCase):
         self.assertEqual(len(list(self.store.groupby("index"))), 4)
         self.assertEqual(len(list(self.store.groupby("task_id"))), 40)
 
+        # Groups spread over the stores are merged
+        groups = list(self.store.groupby("prop", criteria={"task_id": {"$lt": 35}}))
+        self.assertEqual([g["_id"]["prop"] for g in groups], [str(i) for i in range(10)])
+        self.assertEqual(sorted(d["task_id"] for d in groups[2]["docs"]), [2, 12, 22, 32])
+
+        groups = list(self.store.groupby("prop", properties={"_id": 0, "index": 0}))
+        self.assertEqual(sorted(groups[0]["docs"][0]), ["last_updated", "prop", "task_id"])
+        groups = list(self.store.groupby("prop", properties="task_id"))
+        self.assertEqual(sorted(groups[0]["docs"][0]), ["_id", "task_id"])
+
+        # Along with stores not backed by a collection
+        store = IndexedMemoryStore(key="task_id")
+        store.connect()
+        store.update([{"task_id": 100 + i, "prop": str(i % 3), "index": 4} for i in range(5)])
+        self.store = ConcatStore(*(self.mem_stores + [store]))
+        groups = list(self.store.groupby(["prop", "index"], properties=["task_id", "prop", "index"]))
+        self.assertEqual(len(groups), 43)
+        groups = list(self.store.groupby("prop"))
+        self.assertEqual(len(groups), 10)
+        self.assertEqual(sorted(d["task_id"] for d in groups[1]["docs"]), [1, 11, 21, 31, 101, 104])
+
     def test_query(self):
 
         docs = list(self.store.query(properties=["task_id"]))
@@ -440,6 +730,149 @@ class ConcatStoreTest(unittest.TestCase):
         self.assertEqual(len(t_ids), len(set(t_ids)))
         self.assertEqual(len(t_ids), 40)
 
+        self.assertEqual(self.store.query_one({"task_id": 15})["index"], 10)
+        self.assertIsNone(self.store.query_one({"task_id": 50}))
+
+    def test_query_num_workers(self):
+        self.store.num_workers = 3
+        docs = list(self.store.query(criteria={"task_id": {"$gte": 5}}))
+        self.assertCountEqual([d["task_id"] for d in docs], range(5, 40))
+        self.assertEqual(self.store.distinct("index"), [0, 10, 20, 30])
+        self.assertEqual(self.store.last_updated, max(s.last_updated for s in self.mem_stores))
+
+        # Sorted across all the stores, with only the projected properties
+        docs = list(self.store.query(properties={"task_id": 1, "_id": 0}, sort=[("prop", -1), ("index", 1)], skip=2, limit=5))
+        self.assertEqual([d["task_id"] for d in docs], [29, 39, 8, 18, 28])
+        self.assertEqual(set(docs[0]), {"task_id"})
+        docs = list(self.store.query(sort=[("task_id", 1)], num_workers=1))
+        self.assertEqual([d["task_id"] for d in docs], list(range(40)))
+
+        # Errors in the stores are raised
+        self.mem_stores[2]._collection = None
+        with self.assertRaises(StoreError):
+            list(self.store.query())
+
+    def test_threads(self):
+        # Sorted iterables are merged by a bounded pool of threads
+        threads = set()
+
+        def numbers(start):
+            for i in range(start, 30, 5):
+                threads.add(threading.current_thread().name)
+                yield i
+
+        funcs = [lambda i=i: numbers(i) for i in range(5)]
+        self.assertEqual(list(_merge_sorted(funcs, None, 2, buffer_size=2)), list(range(30)))
+        self.assertLessEqual(len(threads), 2)
+
+        # Iterables not started when the consumer stops are never read
+        called = []
+
+        def started(i):
+            called.append(i)
+            return iter(range(5))
+
+        items = _interleave([lambda i=i: started(i) for i in range(3)], 1, buffer_size=1)
+        next(items)
+        items.close()
+        time.sleep(0.3)
+        self.assertEqual(called, [0])
+
+    def test_bson_order(self):
+        # Arrays sort by their smallest element, or largest one descending,
+        # and subdocuments field by field
+        self.mem_stores[0].update([{"task_id": 100, "arr": [2, 3], "sub": {"a": 10}}])
+        self.mem_stores[1].update([{"task_id": 101, "arr": [5, 0], "sub": {"a": 9}}])
+        self.mem_stores[2].update([{"task_id": 102, "arr": [], "sub": {"a": 9, "b": 1}}])
+        for num_workers in (1, 2):
+            def sort(spec):
+                docs = self.store.query({"task_id": {"$gte": 100}}, sort=spec, num_workers=num_workers)
+                return [d["task_id"] for d in docs]
+            self.assertEqual(sort([("arr", 1)]), [102, 101, 100])
+            self.assertEqual(sort([("arr", -1)]), [101, 100, 102])
+            self.assertEqual(sort([("sub", 1)]), [101, 102, 100])
+
+        # Groups with the same smallest element aren't merged or split
+        self.mem_stores[0].update([{"task_id": 103, "arr": [0, 5]}])
+        self.mem_stores[1].update([{"task_id": 104, "arr": [0, 7]}])
+        self.mem_stores[2].update([{"task_id": 105, "arr": [0, 5]}])
+        groups = self.store.groupby("arr", criteria={"task_id": {"$gte": 103}})
+        self.assertCountEqual(
+            [(g["_id"]["arr"], sorted(d["task_id"] for d in g["docs"])) for g in groups],
+            [([0, 5], [103, 105]), ([0, 7], [104])],
+        )
+
+    def test_update(self):
+        self.store.partition = HashPartition("task_id")
+        self.store.num_workers = 2
+        self.store.connect(force_reset=True)
+        self.store.update([{"task_id": i, "prop": str(i % 5)} for i in range(100)], batch_size=30)
+        for i, store in enumerate(self.mem_stores):
+            task_ids = store.distinct("task_id")
+            self.assertTrue(task_ids)
+            self.assertTrue(all(self.store.partition.shard({"task_id": t}, 4) == i for t in task_ids))
+        self.assertEqual(len(self.store.distinct("task_id")), 100)
+
+        # Only the stores that can hold the documents are queried
+        self.mem_stores[0]._collection = None
+        task_id = next(t for t in range(100) if self.store.partition.shard({"task_id": t}, 4) != 0)
+        self.assertEqual(self.store.query_one({"task_id": task_id})["prop"], str(task_id % 5))
+        self.assertEqual(len(list(self.store.groupby("prop", criteria={"task_id": task_id}))), 1)
+        with self.assertRaises(StoreError):
+            self.store.query_one({"task_id": {"$gt": task_id}})
+
+        # Queries on patterns of the partition key look through every store
+        self.store.connect(force_reset=True)
+        self.store.update([{"task_id": "mp-{}".format(i)} for i in range(30)] + [{"task_id": 2}])
+        self.assertEqual(len(list(self.store.query({"task_id": re.compile("^mp")}))), 30)
+        self.assertEqual(len(list(self.store.query({"task_id": {"$in": [re.compile("^mp"), 2]}}))), 31)
+
+        # Documents must be replaced by their partition key
+        with self.assertRaises(StoreError):
+            self.store.update([{"task_id": 1, "prop": "1"}], key="prop")
+        self.store.update([{"task_id": 1, "prop": "a"}], key=["prop", "task_id"])
+
+        self.store.partition = None
+        with self.assertRaises(NotImplementedError):
+            self.store.update([{"task_id": 1}])
+
+
+class ShardedStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.shards = [MemoryStore(str(i)) for i in range(3)]
+        self.store = ShardedStore(self.shards)
+        self.store.connect()
+        self.store.update([{"task_id": i, "prop": str(i % 4)} for i in range(60)])
+
+    def test_query(self):
+        self.assertTrue(all(shard.collection.count_documents({}) > 5 for shard in self.shards))
+        self.assertEqual(len(list(self.store.query())), 60)
+        self.assertCountEqual(self.store.distinct("task_id"), range(60))
+        self.assertEqual(len(list(self.store.groupby("prop"))), 4)
+
+        # Single documents are read from their shard only
+        shard = self.store.partition.shard({"task_id": 5}, 3)
+        for i, store in enumerate(self.shards):
+            if i != shard:
+                store._collection = None
+        self.assertEqual(self.store.query_one({"task_id": 5})["prop"], "1")
+
+    def test_add_shards(self):
+        new_shard = MemoryStore("3")
+        new_shard.connect()
+        lu = self.store.query_one({"task_id": 1})["last_updated"]
+        with patch.object(self.store, "update", wraps=self.store.update) as mock_update:
+            moved = self.store.add_shards([new_shard], batch_size=4)
+        self.assertTrue(mock_update.call_count > 1)
+        self.assertTrue(all(len(c[0][0]) <= 4 for c in mock_update.call_args_list))
+        self.assertEqual(moved, new_shard.collection.count_documents({}))
+        self.assertTrue(0 < moved < 30)
+        self.assertEqual(sum(shard.collection.count_documents({}) for shard in self.store.stores), 60)
+        for i, shard in enumerate(self.store.stores):
+            self.assertTrue(all(self.store.partition.shard({"task_id": k}, 4) == i for k in shard.distinct("task_id")))
+        self.assertEqual(self.store.query_one({"task_id": 1})["last_updated"], lu)
+        self.assertEqual(self.store.rebalance(), 0)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -4,9 +4,11 @@ import logging
 import unittest
 from datetime import datetime, timedelta
 from unittest import TestCase
+from unittest.mock import patch
 from uuid import uuid4
 
-from maggma.stores import MongoStore
+from maggma.stores import MongoStore, MemoryStore
+from maggma.advanced_stores import ShardedStore
 from maggma.builders import CopyBuilder
 
 
@@ -53,6 +55,71 @@ class TestCopyBuilder(TestCase):
         self.source.update(self.new_docs, update_lu=False)
         self.assertEqual(len(list(self.builder.get_items())), len(self.new_docs))
 
+    def test_get_items_server_side_diff(self):
+        self.builder = CopyBuilder(self.source, self.target, server_side_diff=True)
+        self.assertTrue(self.builder.streams_keys)
+        self.source.collection.insert_many(self.old_docs)
+        self.assertEqual(len(list(self.builder.get_items())), len(self.old_docs))
+        self.target.collection.insert_many(self.old_docs)
+        self.assertEqual(len(list(self.builder.get_items())), 0)
+        self.source.update(self.new_docs, update_lu=False)
+        self.assertEqual(len(list(self.builder.get_items())), len(self.new_docs))
+
+    def test_checkpoint(self):
+        checkpoint = MemoryStore("checkpoint")
+        self.builder = CopyBuilder(self.source, self.target, checkpoint=checkpoint)
+        self.source.collection.insert_many(self.old_docs)
+        self.builder.run()
+        self.assertEqual(self.builder.get_checkpoint()["watermark"], self.old_docs[0]["lu"])
+
+        # Only documents newer than the watermark are processed
+        self.target.collection.delete_many({"k": 15})
+        self.assertEqual(len(list(self.builder.get_items())), 0)
+        self.source.update(self.new_docs, update_lu=False)
+        self.assertEqual(len(list(self.builder.get_items())), len(self.new_docs))
+        self.builder.run()
+        self.assertEqual(self.builder.get_checkpoint()["watermark"], self.new_docs[0]["lu"])
+        self.assertEqual(self.target.query_one(criteria={"k": 0})["v"], "new")
+
+        # Documents written later with the watermark lu_field are built too
+        self.source.update([{"lu": self.new_docs[0]["lu"], "k": 20, "v": "new"}], update_lu=False)
+        self.assertEqual([d["k"] for d in self.builder.get_items()], [20])
+
+    def test_watch(self):
+        checkpoint = MemoryStore("checkpoint")
+        self.builder = CopyBuilder(
+            self.source, self.target, checkpoint=checkpoint, chunk_size=5
+        )
+        self.source.collection.insert_many(self.old_docs)
+        self.builder.watch(poll_interval=0.1, max_batches=4)
+        self.assertEqual(self.target.collection.count_documents({}), 20)
+        self.assertEqual(self.builder.get_checkpoint()["watermark"], self.old_docs[0]["lu"])
+
+        self.source.update(self.new_docs, update_lu=False)
+        self.builder.watch(poll_interval=0.1, max_batches=2)
+        self.assertEqual(self.target.query_one(criteria={"k": 0})["v"], "new")
+        self.assertEqual(self.target.query_one(criteria={"k": 10})["v"], "old")
+
+        # Documents written later with the watermark lu_field are built too
+        self.source.update([{"lu": self.new_docs[0]["lu"], "k": 20, "v": "new"}], update_lu=False)
+        self.builder.watch(poll_interval=0.1, max_batches=1)
+        self.assertEqual(self.target.query_one(criteria={"k": 20})["v"], "new")
+
+    def test_watch_watermark_keys(self):
+        checkpoint = MemoryStore("checkpoint")
+        self.builder = CopyBuilder(
+            self.source, self.target, checkpoint=checkpoint, chunk_size=5
+        )
+        self.source.collection.insert_many(self.old_docs)
+        self.builder.watch(poll_interval=0.1, max_batches=1)
+        self.assertEqual(len(self.builder.get_checkpoint()["watermark_keys"]), 5)
+
+        # Too many keys at the watermark aren't checkpointed
+        with patch("maggma.builders.MAX_WATERMARK_KEYS", 8):
+            self.builder.watch(poll_interval=0.1, max_batches=1)
+        self.assertEqual(self.builder.get_checkpoint()["watermark"], self.old_docs[0]["lu"])
+        self.assertIsNone(self.builder.get_checkpoint()["watermark_keys"])
+
     def test_process_item(self):
         self.source.collection.insert_many(self.old_docs)
         items = list(self.builder.get_items())
@@ -122,5 +189,37 @@ class TestCopyBuilder(TestCase):
         self.assertTrue(all(d["lu"] == toc) for d in docs[:5])
 
 
+class TestShardedCopyBuilder(TestCase):
+    def setUp(self):
+        kwargs = dict(key="k", lu_field="lu")
+        self.source = ShardedStore([MemoryStore("source{}".format(i), **kwargs) for i in range(3)], **kwargs)
+        self.target = ShardedStore([MemoryStore("target{}".format(i), **kwargs) for i in range(3)], **kwargs)
+        self.source.connect()
+        self.target.connect()
+        self.source.update([{"k": k, "v": "old"} for k in range(30)])
+        self.builder = CopyBuilder(self.source, self.target)
+
+    def test_shards(self):
+        self.assertEqual(len(self.builder.shard_pairs()), 3)
+        self.builder.run()
+        for source, target in zip(self.source.stores, self.target.stores):
+            self.assertCountEqual(source.distinct("k"), target.distinct("k"))
+
+        # Each shard builder only reads its shard
+        self.source.update([{"k": k, "v": "new"} for k in range(30)])
+        self.assertEqual([b.shard for b in self.builder.shard_builders()], [0, 1, 2])
+        builder = CopyBuilder(self.source, self.target, shard=1)
+        items = list(builder.get_items())
+        self.assertCountEqual([d["k"] for d in items], self.source.stores[1].distinct("k"))
+        self.assertEqual(builder.total, len(items))
+
+        # Only partitioned sources have shards
+        builder = CopyBuilder(self.source.stores[0], self.target, shard=2)
+        with self.assertRaises(ValueError):
+            builder.shard_pairs()
+        with self.assertRaises(ValueError):
+            CopyBuilder(self.source.stores[0], self.target).shard_builders()
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,73 @@
+# coding: utf-8
+"""
+Tests for the local disk cache
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from maggma.cache import DiskCache
+
+
+def fill(path, start):
+    cache = DiskCache(path, max_size=10000)
+    for i in range(start, start + 50):
+        cache.put("mp-{}".format(i), None, b"x" * 100)
+        cache.get("mp-{}".format(i - 1), None)
+    return cache.stats["hits"]
+
+
+class DiskCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_put(self):
+        cache = DiskCache(self.path)
+        lu = datetime(2018, 4, 12, 16)
+        self.assertIsNone(cache.get("mp-1", lu))
+        cache.put("mp-1", lu, b"abc")
+        self.assertEqual(cache.get("mp-1", lu), b"abc")
+        # A new version of the document is a different entry
+        self.assertIsNone(cache.get("mp-1", datetime(2018, 4, 12, 17)))
+        self.assertEqual(cache.stats, {"hits": 1, "misses": 2, "size": 3})
+
+        # Entries are shared with other instances
+        self.assertEqual(DiskCache(self.path).get("mp-1", lu), b"abc")
+        cache.clear()
+        self.assertIsNone(cache.get("mp-1", lu))
+        self.assertEqual(cache.stats["size"], 0)
+
+    def test_eviction(self):
+        cache = DiskCache(self.path, max_size=1000)
+        for i in range(10):
+            cache.put(i, None, b"x" * 100)
+            time.sleep(0.01)
+        # Recently read entries are kept
+        cache.get(0, None)
+        cache.put(10, None, b"x" * 100)
+        self.assertLessEqual(cache.stats["size"], 1000)
+        self.assertIsNotNone(cache.get(0, None))
+        self.assertIsNone(cache.get(1, None))
+        self.assertIsNotNone(cache.get(10, None))
+
+        cache.put(11, None, b"x" * 2000)
+        self.assertIsNone(cache.get(11, None))
+
+    def test_processes(self):
+        with ProcessPoolExecutor(4) as executor:
+            hits = list(executor.map(fill, [self.path] * 4, range(0, 200, 50)))
+        self.assertTrue(all(h > 0 for h in hits))
+        # Each process rescans the cache after putting a tenth of its size
+        self.assertLessEqual(DiskCache(self.path).stats["size"], 14000)
+        self.assertFalse([f for f in os.listdir(self.path) if f.startswith(".tmp-")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+# coding: utf-8
+"""
+Tests for the compression codecs
+"""
+import json
+import unittest
+import zlib
+
+from maggma.compression import (
+    Codec,
+    NoCodec,
+    get_codec,
+    decompress,
+    register_codec,
+    zstd_import,
+    lz4_import,
+    CODECS,
+)
+
+
+class CodecTests(unittest.TestCase):
+    def setUp(self):
+        self.data = json.dumps([{"task_id": "mp-{}".format(i), "data": [i] * 10} for i in range(100)]).encode()
+
+    def test_zlib(self):
+        name, codec = get_codec(True, level=9)
+        self.assertEqual(name, "zlib")
+        compressed = codec.compress(self.data)
+        self.assertLess(len(compressed), len(self.data))
+        # Data from the former hardcoded zlib compression is still readable
+        self.assertEqual(decompress(zlib.compress(self.data), "zlib"), self.data)
+        self.assertEqual(decompress(compressed, "zlib"), self.data)
+
+    def test_none(self):
+        for compression in [False, None, "none"]:
+            name, codec = get_codec(compression)
+            self.assertIsNone(name)
+            self.assertIsInstance(codec, NoCodec)
+        self.assertEqual(decompress(self.data, None), self.data)
+
+    @unittest.skipUnless(zstd_import, "zstandard not installed")
+    def test_zstd(self):
+        import zstandard
+
+        name, codec = get_codec("zstd", level=10)
+        self.assertEqual(decompress(codec.compress(self.data), name), self.data)
+
+        samples = [json.dumps({"task_id": "mp-{}".format(i), "energy": -i / 7}).encode() for i in range(1000)]
+        dictionary = zstandard.train_dictionary(1024, samples).as_bytes()
+        name, codec = get_codec("zstd", dictionary=dictionary)
+        compressed = codec.compress(samples[0])
+        # Reading needs the codec holding the dictionary
+        self.assertEqual(decompress(compressed, name, {name: codec}), samples[0])
+
+    @unittest.skipUnless(lz4_import, "lz4 not installed")
+    def test_lz4(self):
+        name, codec = get_codec("lz4")
+        self.assertEqual(decompress(codec.compress(self.data), name), self.data)
+
+    def test_register(self):
+        class ReverseCodec(Codec):
+            def compress(self, data):
+                return data[::-1]
+
+            def decompress(self, data):
+                return data[::-1]
+
+        with self.assertRaises(ValueError):
+            get_codec("reverse")
+
+        register_codec("reverse", ReverseCodec)
+        name, codec = get_codec("reverse")
+        self.assertEqual(decompress(codec.compress(self.data), name), self.data)
+        del CODECS["reverse"]
+
+
+if __name__ == "__main__":
+    unittest.main()
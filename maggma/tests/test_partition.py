@@ -0,0 +1,90 @@
+# coding: utf-8
+"""
+Tests for the partitions of partitioned stores
+"""
+import re
+import unittest
+
+from maggma.partition import (
+    ConsistentHashPartition,
+    FieldPartition,
+    HashPartition,
+    RangePartition,
+    stable_hash,
+)
+from maggma.stores import StoreError
+
+
+class PartitionTests(unittest.TestCase):
+    def test_hash(self):
+        partition = HashPartition("task_id")
+        shards = [partition.shard({"task_id": "mp-{}".format(i)}, 4) for i in range(1000)]
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+        self.assertTrue(all(shards.count(i) > 200 for i in range(4)))
+        self.assertEqual(stable_hash(1), stable_hash(1.0))
+
+        self.assertIsNone(partition.shards({"a": 1}, 4))
+        self.assertIsNone(partition.shards({"task_id": {"$ne": "mp-1"}}, 4))
+        self.assertEqual(partition.shards({"task_id": "mp-1"}, 4), [shards[1]])
+        self.assertEqual(partition.shards({"task_id": {"$eq": "mp-1"}}, 4), [shards[1]])
+        self.assertEqual(
+            partition.shards({"task_id": {"$in": ["mp-1", "mp-2"]}}, 4),
+            sorted({shards[1], shards[2]}),
+        )
+        with self.assertRaises(StoreError):
+            partition.shard({"a": 1}, 4)
+        with self.assertRaises(StoreError):
+            partition.shard({"task_id": ["mp-1", "mp-2"]}, 4)
+        with self.assertRaises(StoreError):
+            partition.shard({"task_id": {"id": "mp-1"}}, 4)
+
+        # Regular expressions match values in any shard
+        self.assertIsNone(partition.shards({"task_id": re.compile("^mp")}, 4))
+        self.assertIsNone(partition.shards({"task_id": {"$in": ["mp-1", re.compile("^mp")]}}, 4))
+
+    def test_consistent_hash(self):
+        partition = ConsistentHashPartition("task_id")
+        values = ["mp-{}".format(i) for i in range(1000)]
+        shards = [partition.shard_of(value, 4) for value in values]
+        self.assertTrue(all(shards.count(i) > 150 for i in range(4)))
+
+        # Adding a shard only moves documents to it
+        new_shards = [partition.shard_of(value, 5) for value in values]
+        moved = [(a, b) for a, b in zip(shards, new_shards) if a != b]
+        self.assertTrue(all(b == 4 for a, b in moved))
+        self.assertTrue(100 < len(moved) < 300)
+
+        partition = ConsistentHashPartition.from_dict(partition.as_dict())
+        self.assertEqual(partition.shards({"task_id": "mp-1"}, 4), [shards[1]])
+
+    def test_range(self):
+        partition = RangePartition("output.n", [10, 20])
+        self.assertEqual([partition.shard({"output": {"n": n}}, 3) for n in [0, 10, 19, 25]], [0, 1, 1, 2])
+        self.assertEqual(partition.shards({"output.n": {"$gte": 10, "$lt": 20}}, 3), [1])
+        self.assertEqual(partition.shards({"output.n": {"$lte": 10}}, 3), [0, 1])
+        self.assertEqual(partition.shards({"output.n": {"$in": [1, 30]}}, 3), [0, 2])
+        self.assertIsNone(partition.shards({"output.n": {"$exists": True}}, 3))
+        with self.assertRaises(StoreError):
+            partition.shard({"output": {"n": 1}}, 4)
+
+        # Values that can't be compared to the bounds can't be placed
+        self.assertIsNone(partition.shards({"output.n": "a"}, 3))
+        self.assertIsNone(partition.shards({"output.n": {"$in": [1, None]}}, 3))
+        self.assertIsNone(partition.shards({"output.n": {"$gt": "a"}}, 3))
+        with self.assertRaises(StoreError):
+            partition.shard({"output": {"n": "a"}}, 3)
+        with self.assertRaises(StoreError):
+            partition.shards({"output.n": 1}, 4)
+
+    def test_field(self):
+        partition = FieldPartition("type", {"GGA": 0, "GGA+U": 0, "SCAN": 1})
+        self.assertEqual(partition.shard({"type": "SCAN"}, 2), 1)
+        self.assertEqual(partition.shards({"type": {"$in": ["GGA", "HSE"]}}, 2), [0])
+        with self.assertRaises(StoreError):
+            partition.shard({"type": "HSE"}, 2)
+
+        self.assertEqual(FieldPartition.from_dict(partition.as_dict()).values, partition.values)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+# coding: utf-8
+"""
+Tests for the blob serialization formats
+"""
+import unittest
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from bson import ObjectId
+
+from maggma.serialization import _EXT_DATETIME, _from_ext, get_serializer, msgpack_import
+from maggma.utils import fast_jsanitize
+
+
+class SerializerTests(unittest.TestCase):
+    def setUp(self):
+        self.doc = {
+            "task_id": "mp-1",
+            "data": np.random.rand(4, 8),
+            "counts": np.arange(5, dtype=np.int32),
+            "labels": np.array(["a", "b"]),
+            "energy": np.float32(-1.5),
+            "last_updated": datetime(2018, 4, 12, 16, 30, 1, 5000),
+            "created": datetime(2018, 4, 12, 18, 30, tzinfo=timezone(timedelta(hours=2))),
+            "nested": [{"x": (1, 2)}],
+        }
+
+    def check_binary(self, serializer):
+        doc = dict(self.doc, _id=ObjectId())
+        data = serializer.dumps(doc, fast_jsanitize)
+        loaded = serializer.loads(data)
+        self.assertEqual(loaded["data"].dtype, np.float64)
+        np.testing.assert_array_equal(loaded["data"], doc["data"])
+        np.testing.assert_array_equal(loaded["counts"], doc["counts"])
+        self.assertEqual(loaded["labels"], ["a", "b"])
+        self.assertEqual(loaded["energy"], -1.5)
+        self.assertEqual(loaded["last_updated"], doc["last_updated"])
+        # Timezone aware datetimes are read back as naive UTC
+        self.assertEqual(loaded["created"], datetime(2018, 4, 12, 16, 30))
+        self.assertEqual(loaded["_id"], doc["_id"])
+        self.assertEqual(loaded["nested"], [{"x": [1, 2]}])
+        # Arrays are stored as buffers rather than lists of numbers
+        self.assertLess(len(data), len(get_serializer("json").dumps(self.doc, fast_jsanitize)))
+
+    def test_json(self):
+        serializer = get_serializer()
+        loaded = serializer.loads(serializer.dumps(self.doc, fast_jsanitize))
+        self.assertEqual(loaded["counts"], [0, 1, 2, 3, 4])
+        self.assertIsInstance(loaded["last_updated"], str)
+
+    def test_bson(self):
+        self.check_binary(get_serializer("bson"))
+
+    @unittest.skipUnless(msgpack_import, "msgpack not installed")
+    def test_msgpack(self):
+        self.check_binary(get_serializer("msgpack"))
+        self.assertEqual(_from_ext(_EXT_DATETIME, b"2018-04-12T18:30:01+02:00"), datetime(2018, 4, 12, 16, 30, 1))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            get_serializer("pickle")
+
+
+if __name__ == "__main__":
+    unittest.main()
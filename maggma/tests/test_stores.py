@@ -3,12 +3,18 @@
 Tests for the base Stores
 """
 import os
+import re
+import shutil
+import tempfile
 import unittest
+from unittest.mock import patch
 import numpy as np
 import mongomock.collection
 import pymongo.collection
+from bson.int64 import Int64
 import numpy.testing.utils as nptu
 from maggma.stores import *
+from maggma.validator import JSONSchemaValidator
 
 module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
 db_dir = os.path.abspath(os.path.join(module_dir, "..", "..", "test_files", "settings_files"))
@@ -68,6 +74,17 @@ class TestMongoStore(unittest.TestCase):
         self.mongostore.update([{"e": 11, "d": 8, "f": 9}], key=["d", "f"])
         self.assertEqual(self.mongostore.query_one(criteria={"d": 8, "f": 9}, properties=["e"])["e"], 11)
 
+    def test_update_batches(self):
+        docs = [{"task_id": i, "a": "x" * 100} for i in range(25)]
+        result = self.mongostore.update(docs, batch_size=10)
+        self.assertEqual(result.upserted_count, 25)
+        self.assertEqual(sorted(result.upserted_ids), list(range(25)))
+
+        docs = [{"task_id": i, "a": "y" * 100} for i in range(25)]
+        result = self.mongostore.update(docs, batch_bytes=1000, ordered=False, num_writers=4)
+        self.assertEqual(result.matched_count, 25)
+        self.assertEqual(self.mongostore.collection.count_documents({"a": "y" * 100}), 25)
+
     def test_groupby(self):
         self.mongostore.collection.drop()
         self.mongostore.update([{
@@ -193,6 +210,290 @@ class TestMemoryStore(unittest.TestCase):
         self.assertEqual(len(data), 3)
 
 
+    def test_update_validation(self):
+        schema = {"type": "object", "properties": {"a": {"type": "integer"}}}
+        self.memstore = MemoryStore(validator=JSONSchemaValidator(schema))
+        self.memstore.connect()
+        self.memstore.update([{"task_id": 1, "a": 1}, {"task_id": 2, "a": "b"}])
+        self.assertEqual(self.memstore.distinct("task_id"), [1])
+
+        self.memstore.validator = JSONSchemaValidator(schema, strict=True)
+        with self.assertRaises(ValueError):
+            self.memstore.update([{"task_id": 3, "a": "b"}])
+
+    def test_update_upsert(self):
+        self.memstore.connect()
+        self.memstore.update([{"task_id": 1, "a": 1}, {"task_id": 2, "a": 2}])
+        self.memstore.update([{"task_id": 1, "a": 3}])
+        self.assertEqual(self.memstore.collection.count(), 2)
+        self.assertEqual(self.memstore.query_one({"task_id": 1})["a"], 3)
+
+    def test_update_errors(self):
+        self.memstore.connect()
+        self.memstore.collection.create_index("u", unique=True)
+        docs = [{"task_id": i, "u": i if i not in (3, 13) else 0} for i in range(25)]
+        with self.assertRaises(pymongo.errors.BulkWriteError) as cm:
+            self.memstore.update(docs, batch_size=5)
+        self.assertEqual([e["index"] for e in cm.exception.details["writeErrors"]], [3])
+        self.assertEqual(self.memstore.collection.count_documents({}), 3)
+
+        # Unordered updates write every batch and raise all the errors
+        self.memstore.collection.delete_many({})
+        for num_writers in (1, 3):
+            with self.assertRaises(pymongo.errors.BulkWriteError) as cm:
+                self.memstore.update(docs, batch_size=5, ordered=False, num_writers=num_writers)
+            self.assertEqual([e["index"] for e in cm.exception.details["writeErrors"]], [3, 13])
+            self.assertEqual(self.memstore.collection.count_documents({}), 23)
+
+    def test_update_batch_bytes(self):
+        self.memstore.connect()
+        docs = [{"task_id": i, "data": "x" * (5000 if i == 5 else 10)} for i in range(20)]
+        batches = list(self.memstore._update_batches(docs, False, None, 1000, 4000))
+        self.assertEqual([offset for offset, _ in batches], [0, 5, 6])
+
+
+class TestIndexedMemoryStore(unittest.TestCase):
+    def setUp(self):
+        self.memstore = IndexedMemoryStore()
+        self.memstore.connect()
+        self.memstore.update([{"task_id": i, "a": i % 3, "b": {"c": i}, "l": [i, i + 1]}
+                              for i in range(10)])
+
+    def test_collection(self):
+        with self.assertRaises(AttributeError):
+            self.memstore.collection
+
+    def test_query(self):
+        self.assertEqual(len(list(self.memstore.query())), 10)
+        self.assertEqual(self.memstore.query_one({"task_id": 4})["b"]["c"], 4)
+        self.assertIsNone(self.memstore.query_one({"task_id": 11}))
+
+        docs = list(self.memstore.query({"b.c": {"$gt": 6}}, properties=["task_id"]))
+        self.assertEqual(docs, [{"task_id": 7}, {"task_id": 8}, {"task_id": 9}])
+
+        docs = self.memstore.query({"a": 1}).sort("task_id", pymongo.DESCENDING).limit(2)
+        self.assertEqual([d["task_id"] for d in docs], [7, 4])
+
+        # Results are copies of the stored documents
+        self.memstore.query_one({"task_id": 1})["a"] = 5
+        self.assertEqual(self.memstore.query_one({"task_id": 1})["a"], 1)
+
+        # Arrays sort by their smallest or largest element, subdocuments by field
+        self.memstore.update([{"task_id": 10, "l": [20, -1], "b": {"c": 10}}])
+        self.assertEqual([d["task_id"] for d in self.memstore.query().sort("l").limit(2)], [10, 0])
+        self.assertEqual([d["task_id"] for d in self.memstore.query().sort("l", -1).limit(2)], [10, 9])
+        self.assertEqual([d["task_id"] for d in self.memstore.query().sort("b", -1).limit(2)], [10, 9])
+
+        # Regular expressions are matched by a scan
+        self.memstore.update([{"task_id": "mp-{}".format(i)} for i in range(3)])
+        self.assertEqual(len(list(self.memstore.query({"task_id": re.compile("^mp")}))), 3)
+        self.assertEqual(len(list(self.memstore.query({"task_id": {"$in": [re.compile("^mp"), 1]}}))), 4)
+
+    def test_index(self):
+        self.assertTrue(self.memstore.ensure_index("a"))
+        index = self.memstore._indexes["a"]
+        self.assertEqual(index.find(1), {1, 4, 7})
+        self.assertEqual(index.find({"$in": [0, 2]}), {0, 2, 3, 5, 6, 8, 9})
+        self.assertEqual(index.find({"$gte": 1, "$lt": 2}), {1, 4, 7})
+        self.assertIsNone(index.find({"$exists": True}))
+
+        docs = self.memstore.query({"a": {"$gte": 1}, "task_id": {"$lt": 5}})
+        self.assertEqual([d["task_id"] for d in docs], [1, 2, 4])
+
+        self.assertFalse(self.memstore.ensure_index("a", unique=True))
+        self.assertTrue(self.memstore.ensure_index("task_id", unique=True))
+        self.memstore.update([{"task_id": 1, "a": 5}])
+        with self.assertRaises(DuplicateKeyError):
+            self.memstore.update([{"task_id": 1, "a": 6}], key="a")
+        self.assertEqual(self.memstore.query_one({"a": 5})["task_id"], 1)
+
+        # Values of different types don't share a bucket
+        self.memstore.update([{"task_id": 20, "a": True}, {"task_id": 21, "a": 1.0}])
+        self.assertEqual(len(index.find(True)), 1)
+        self.assertEqual(len(index.find(1)), 3)
+        self.assertEqual(self.memstore.distinct("a"), [0, 1, 2, 5, True])
+        self.memstore.ensure_index("u", unique=True)
+        self.memstore.update([{"task_id": 20, "u": True}, {"task_id": 21, "u": 1}])
+        self.assertEqual(len(list(self.memstore.query({"u": {"$exists": True}}))), 2)
+
+    def test_distinct(self):
+        self.assertEqual(self.memstore.distinct("a"), [0, 1, 2])
+        self.assertEqual(self.memstore.distinct("a", {"task_id": {"$gt": 7}}), [2, 0])
+        self.assertEqual(len(self.memstore.distinct("l")), 11)
+        self.assertEqual(self.memstore.distinct(["a"]), [{"a": 0}, {"a": 1}, {"a": 2}])
+
+    def test_groupby(self):
+        data = list(self.memstore.groupby("a", properties=["task_id"]))
+        self.assertEqual(len(data), 3)
+        self.assertEqual(data[1]["_id"], {"a": 1})
+        self.assertEqual(data[1]["docs"], [{"task_id": 1}, {"task_id": 4}, {"task_id": 7}])
+
+    def test_update(self):
+        self.memstore.update([{"task_id": 3, "a": 7}, {"task_id": 10, "a": 7}])
+        self.assertEqual(len(list(self.memstore.query())), 11)
+        self.assertEqual([d["task_id"] for d in self.memstore.query({"a": 7})], [3, 10])
+        self.assertNotIn("b", self.memstore.query_one({"task_id": 3}))
+        self.assertEqual(self.memstore.last_updated,
+                         self.memstore.query_one({"task_id": 10})["last_updated"])
+
+
+class TestColumnarMemoryStore(unittest.TestCase):
+    def setUp(self):
+        self.memstore = ColumnarMemoryStore(columns=["formula", "e", "b.c"])
+        self.memstore.connect()
+        formulas = ["Fe", "O2", "NaCl"]
+        self.memstore.update([{"task_id": i, "formula": formulas[i % 3], "e": i / 10, "b": {"c": i % 2}}
+                              for i in range(10)])
+        self.memstore.update([{"task_id": 10, "formula": ["Li", "Fe"], "e": "unknown"}])
+
+    def test_query(self):
+        docs = self.memstore.query({"e": {"$gte": 0.2, "$lt": 0.5}}, properties=["task_id"])
+        self.assertEqual([d["task_id"] for d in docs], [2, 3, 4])
+        docs = self.memstore.query({"formula": "Fe", "b.c": 0})
+        self.assertEqual([d["task_id"] for d in docs], [0, 6])
+        docs = self.memstore.query({"formula": {"$in": ["Li", "O2"]}, "task_id": {"$gt": 3}})
+        self.assertEqual([d["task_id"] for d in docs], [4, 7, 10])
+        self.assertEqual(self.memstore.count({"b.c": None}), 1)
+        self.assertEqual(self.memstore.count({"e": {"$type": "string"}}), 1)
+        self.assertEqual(self.memstore.count(), 11)
+
+    def test_distinct(self):
+        self.assertEqual(self.memstore.distinct("formula"), ["Fe", "O2", "NaCl", "Li"])
+        self.assertEqual(self.memstore.distinct("formula", {"e": {"$lt": 0.2}}), ["Fe", "O2"])
+        self.assertEqual(self.memstore.distinct("b.c"), [0, 1])
+
+    def test_groupby(self):
+        data = list(self.memstore.groupby(["formula", "b.c"], criteria={"task_id": {"$lt": 10}},
+                                          properties=["task_id"]))
+        self.assertEqual(len(data), 6)
+        self.assertEqual(data[0]["_id"], {"formula": "Fe", "b": {"c": 0}})
+        self.assertEqual(data[0]["docs"], [{"task_id": 0}, {"task_id": 6}])
+
+        # Unindexed values fall back to grouping the documents
+        data = list(self.memstore.groupby("formula"))
+        self.assertEqual(len(data), 4)
+        self.assertEqual(data[-1]["_id"], {"formula": ["Li", "Fe"]})
+
+        self.assertEqual(list(self.memstore.groupby("formula", criteria={"task_id": 11})), [])
+        empty = ColumnarMemoryStore(columns=["formula"])
+        empty.connect()
+        self.assertEqual(list(empty.groupby("formula")), [])
+
+    def test_update(self):
+        self.memstore.update([{"task_id": 1, "formula": "Fe", "e": 1.5}])
+        self.assertEqual(self.memstore.count({"formula": "Fe"}), 6)
+        self.assertEqual(self.memstore.distinct("task_id", {"e": {"$gt": 1}}), [1])
+
+        # Lookups on the key go through its hash index rather than a column
+        self.assertNotIn("task_id", self.memstore._columns)
+        self.assertEqual(self.memstore.count({"task_id": {"$in": [1, 2, 11]}, "e": {"$gt": 1}}), 1)
+
+        # Categories no row has anymore are dropped
+        self.memstore.update([{"task_id": i, "formula": "Fe", "e": 2.0} for i in range(10)])
+        self.assertEqual(self.memstore.count({"e": 2.0}), 10)
+        self.assertEqual(self.memstore._columns["e"].categories, ["unknown", 2.0])
+        self.assertEqual(self.memstore.distinct("formula"), ["Fe", "Li"])
+
+
+class TestLogFileStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "log.bson")
+        self.logstore = LogFileStore(self.path)
+        self.logstore.connect()
+        self.logstore.update([{"task_id": i, "a": i % 3} for i in range(10)])
+
+    def tearDown(self):
+        self.logstore.close()
+        shutil.rmtree(self.dir)
+
+    def test_query(self):
+        self.assertEqual(len(list(self.logstore.query())), 10)
+        self.assertEqual(self.logstore.query_one({"task_id": 4})["a"], 1)
+        docs = self.logstore.query({"task_id": {"$in": [1, 2, 11]}}, properties=["task_id"])
+        self.assertEqual(list(docs), [{"task_id": 1}, {"task_id": 2}])
+        docs = self.logstore.query({"a": 1}, sort=[("task_id", pymongo.DESCENDING)])
+        self.assertEqual([d["task_id"] for d in docs], [7, 4, 1])
+        self.assertEqual(self.logstore.distinct("a"), [0, 1, 2])
+        self.assertEqual(len(list(self.logstore.groupby("a"))), 3)
+
+        self.logstore.update([{"task_id": "mp-{}".format(i)} for i in range(3)])
+        self.assertEqual(len(list(self.logstore.query({"task_id": re.compile("^mp")}))), 3)
+        self.assertEqual(len(list(self.logstore.query({"task_id": {"$in": [re.compile("^mp"), 1]}}))), 4)
+
+    def test_update(self):
+        self.logstore.update([{"task_id": 3, "a": 5}])
+        self.assertEqual(len(list(self.logstore.query())), 10)
+        self.assertEqual(self.logstore.query_one({"task_id": 3})["a"], 5)
+        with self.assertRaises(StoreError):
+            self.logstore.update([{"task_id": 3, "a": 5}], key="a")
+
+        size = os.path.getsize(self.path)
+        self.logstore.compact()
+        self.assertLess(os.path.getsize(self.path), size)
+        self.assertEqual(self.logstore.query_one({"task_id": 3})["a"], 5)
+
+    def test_interrupted_compact(self):
+        self.logstore.update([{"task_id": 3, "a": 5}])
+        replace = os.replace
+
+        def crash_after_one(src, dst):
+            replace(src, dst)
+            raise OSError("crashed")
+
+        with patch("maggma.stores.os.replace", side_effect=crash_after_one):
+            with self.assertRaises(OSError):
+                self.logstore.compact()
+        self.logstore.connect()
+        self.assertEqual([d["a"] for d in self.logstore.query(sort=[("task_id", 1)])],
+                         [0, 1, 2, 5, 1, 2, 0, 1, 2, 0])
+        self.assertEqual(sorted(os.listdir(self.dir)), ["log.bson", "log.bson.idx", "log.bson.sidx"])
+
+    def test_sorted_index(self):
+        # Entries kept in memory are merged into the memory mapped sorted index
+        with patch("maggma.stores._LOG_MIN_MERGE_ENTRIES", 4):
+            self.logstore.update([{"task_id": i, "a": -1} for i in range(5, 15)])
+        self.assertEqual(self.logstore._num_sorted, 15)
+        self.assertEqual(self.logstore._offsets, {})
+        self.logstore.update([{"task_id": 15, "a": 0}])
+        self.logstore.close()
+        self.logstore.connect()
+        self.assertEqual(len(self.logstore._offsets), 1)
+        self.assertEqual([d["a"] for d in self.logstore.query({"task_id": {"$in": [4, 5, 15]}})],
+                         [1, -1, 0])
+        self.assertEqual([d["task_id"] for d in self.logstore.query()], list(range(16)))
+
+        # Numbers that compare equal are the same key
+        self.logstore.update([{"task_id": Int64(4), "a": 7}, {"task_id": 5.0, "a": 8}])
+        self.assertEqual(self.logstore.query_one({"task_id": 4})["a"], 7)
+        self.assertEqual(self.logstore.query_one({"task_id": Int64(5)})["a"], 8)
+        self.assertEqual(len(list(self.logstore.query())), 16)
+
+    def test_auto_compact(self):
+        with patch("maggma.stores._LOG_MIN_COMPACT_RECORDS", 10):
+            self.logstore.update([{"task_id": i, "a": 0} for i in range(5)])
+            self.logstore.update([{"task_id": i, "a": 1} for i in range(5)])
+            size = os.path.getsize(self.path)
+            self.logstore.update([{"task_id": i, "a": 2} for i in range(5)])
+        self.assertLess(os.path.getsize(self.path), size)
+        self.assertEqual(self.logstore._num_records, 10)
+        self.assertEqual([d["a"] for d in self.logstore.query(sort=[("task_id", 1)])],
+                         [2] * 5 + [2, 0, 1, 2, 0])
+
+    def test_reconnect(self):
+        self.logstore.close()
+        # Simulate an update interrupted before indexing its records
+        with open(self.path, "ab") as f:
+            f.write(BSON.encode({"task_id": 10, "a": 1}))
+            f.write(b"\x30\x00")
+        self.logstore.connect()
+        self.assertEqual(len(list(self.logstore.query())), 11)
+        self.assertEqual(self.logstore.query_one({"task_id": 10})["a"], 1)
+
+        self.logstore.connect(force_reset=True)
+        self.assertEqual(len(list(self.logstore.query())), 0)
+
+
 class TestJsonStore(unittest.TestCase):
     def test(self):
         files = []
@@ -207,6 +508,68 @@ class TestJsonStore(unittest.TestCase):
         jsonstore.connect()
         self.assertEqual(len(list(jsonstore.query())), 20)
 
+    def test_num_workers(self):
+        files = [os.path.join(test_dir, f) for f in ["a.json", "b.json", "c.json.gz"]]
+        jsonstore = JSONStore(files, num_workers=2)
+        jsonstore.connect()
+        self.assertEqual(len(list(jsonstore.query())), 20)
+        self.assertEqual(jsonstore._unloaded, [])
+
+    def test_write_back(self):
+        files = [os.path.join(test_dir, f) for f in ["a.json", "b.json"]]
+        write_back = tempfile.mkdtemp()
+        jsonstore = JSONStore(files, write_back=write_back, max_segments=2)
+        jsonstore.connect()
+        self.assertEqual(os.listdir(write_back), [])
+
+        jsonstore.update([{"task_id": 0, "a": 1}])
+        jsonstore.update([{"task_id": 20, "a": 2}])
+        self.assertEqual(sorted(os.listdir(write_back)),
+                         ["segment-00000000.jsonl.gz", "segment-00000001.jsonl.gz"])
+        last_updated = jsonstore.query_one({"task_id": 20})["last_updated"]
+
+        # Segments are merged into a snapshot
+        jsonstore.update([{"task_id": 1, "a": 3}])
+        self.assertEqual(os.listdir(write_back), ["snapshot-00000002.jsonl.gz"])
+        jsonstore.update([{"task_id": 2, "a": 4}])
+
+        jsonstore = JSONStore(files, write_back=write_back, lazy=True)
+        jsonstore.connect()
+        self.assertEqual(jsonstore.query_one({"task_id": 0})["a"], 1)
+        self.assertEqual(jsonstore.query_one({"task_id": 2})["a"], 4)
+        self.assertEqual(jsonstore.query_one({"task_id": 20})["last_updated"], last_updated)
+        self.assertEqual(len(list(jsonstore.query())), 21)
+
+        # Updates are kept in memory until close with a flush interval
+        jsonstore.flush_interval = 3600
+        jsonstore.update([{"task_id": 3, "a": 5}])
+        self.assertEqual(len(os.listdir(write_back)), 2)
+        jsonstore.close()
+        self.assertEqual(len(os.listdir(write_back)), 3)
+
+        # By default segments are only merged by compact
+        jsonstore.connect(force_reset=True)
+        jsonstore.flush_interval = 0
+        for i in range(25):
+            jsonstore.update([{"task_id": 4, "a": i}])
+        self.assertEqual(len(os.listdir(write_back)), 28)
+        jsonstore.compact()
+        self.assertEqual(os.listdir(write_back), ["snapshot-00000029.jsonl.gz"])
+        self.assertEqual(jsonstore.query_one({"task_id": 4})["a"], 24)
+        shutil.rmtree(write_back)
+
+    def test_lazy(self):
+        files = [os.path.join(test_dir, f) for f in ["a.json", "b.json"]]
+        jsonstore = JSONStore(files, lazy=True, batch_size=3)
+        jsonstore.connect()
+        self.assertEqual(jsonstore._unloaded, files)
+
+        # Only the first file is needed to find a document in it
+        self.assertIsNotNone(jsonstore.query_one({"task_id": 0}))
+        self.assertEqual(jsonstore._unloaded, files[1:])
+        self.assertEqual(len(jsonstore.distinct("task_id")), 20)
+        self.assertEqual(jsonstore._unloaded, [])
+
 
 class TestGridFSStore(unittest.TestCase):
     def setUp(self):
@@ -233,6 +596,35 @@ class TestGridFSStore(unittest.TestCase):
         self.assertTrue(self.gStore._files_collection.find_one({"metadata.compression": "zlib"}))
         nptu.assert_almost_equal(self.gStore.query_one({"task_id": "mp-1"})["data"], data1, 7)
 
+    def test_update_codec(self):
+        data1 = np.random.rand(256)
+        self.gStore = GridFSStore("maggma_test", "test", key="task_id", compression="zlib",
+                                  compression_level=1)
+        self.gStore.connect()
+        self.gStore.update([{"task_id": "mp-1", "data": data1}])
+        self.assertTrue(self.gStore._files_collection.find_one({"metadata.compression": "zlib"}))
+
+        # Files stay readable after changing the codec of the store
+        self.gStore = GridFSStore("maggma_test", "test", key="task_id", compression="none")
+        self.gStore.connect()
+        self.gStore.update([{"task_id": "mp-2", "data": data1}])
+        self.assertFalse(self.gStore._files_collection.find_one(
+            {"metadata.task_id": "mp-2", "metadata.compression": {"$exists": True}}))
+        nptu.assert_almost_equal(self.gStore.query_one({"task_id": "mp-1"})["data"], data1, 7)
+
+        with self.assertRaises(ValueError):
+            GridFSStore("maggma_test", "test", compression="unknown")
+
+    def test_update_serialization(self):
+        data1 = np.random.rand(256)
+        self.gStore = GridFSStore("maggma_test", "test", key="task_id", serialization="bson")
+        self.gStore.connect()
+        self.gStore.update([{"task_id": "mp-1", "data": data1}])
+        self.assertTrue(self.gStore._files_collection.find_one({"metadata.serialization": "bson"}))
+        doc = self.gStore.query_one({"task_id": "mp-1"})
+        self.assertIsInstance(doc["data"], np.ndarray)
+        nptu.assert_almost_equal(doc["data"], data1, 7)
+
     def test_query(self):
         data1 = np.random.rand(256)
         data2 = np.random.rand(256)
@@ -249,6 +641,60 @@ class TestGridFSStore(unittest.TestCase):
 
         self.assertEqual(self.gStore.query_one(criteria={"task_id": "mp-3"}), None)
 
+    def test_update_batch(self):
+        self.gStore.update([{"task_id": "mp-{}".format(i), "v": i} for i in range(5)])
+        self.gStore.update([{"task_id": "mp-1", "v": 10}, {"task_id": "mp-1", "v": 11},
+                            {"task_id": "mp-5", "v": 5}], batch_size=2)
+        # An older upload date does not remove the new version
+        self.gStore.update([{"task_id": "mp-2", "v": 12, "uploadDate": datetime(2000, 1, 1)}],
+                           update_lu=False)
+
+        self.assertEqual(self.gStore._files_collection.count(), 6)
+        self.assertEqual(self.gStore._chunks_collection.count(), 6)
+        self.assertEqual(self.gStore.query_one({"task_id": "mp-1"})["v"], 11)
+        self.assertEqual(self.gStore.query_one({"task_id": "mp-2"})["v"], 12)
+        self.assertTrue(confirm_field_index(self.gStore._files_collection, "metadata.task_id"))
+
+    def test_searchable_fields(self):
+        self.gStore.searchable_fields = ["energy"]
+        self.gStore.update([{"task_id": "mp-1", "energy": -1.5, "data": [1, 2]}])
+        self.assertEqual(
+            self.gStore._files_collection.find_one()["metadata"]["energy"], -1.5
+        )
+
+        # Answered from the metadata alone
+        self.gStore._chunks_collection.delete_many({})
+        doc = self.gStore.query_one({"task_id": "mp-1"}, properties=["task_id", "energy"])
+        self.assertEqual(doc, {"task_id": "mp-1", "energy": -1.5})
+
+        # Files written before a field was searchable are read
+        self.gStore.update([{"task_id": "mp-2", "energy": -2.0, "data": [3]}])
+        self.gStore.searchable_fields = ["energy", "data"]
+        doc = self.gStore.query_one({"task_id": "mp-2"}, properties=["task_id", "data"])
+        self.assertEqual(doc, {"task_id": "mp-2", "data": [3]})
+
+    def test_cache(self):
+        cache_path = tempfile.mkdtemp()
+        self.gStore = GridFSStore("maggma_test", "test", key="task_id", cache_path=cache_path)
+        self.gStore.connect()
+        self.gStore.update([{"task_id": "mp-1", "data": [1, 2]}])
+        self.assertEqual(self.gStore.query_one({"task_id": "mp-1"})["data"], [1, 2])
+        self.gStore._chunks_collection.delete_many({})
+        self.assertEqual(self.gStore.query_one({"task_id": "mp-1"})["data"], [1, 2])
+        self.assertEqual(self.gStore.cache_stats["hits"], 1)
+        shutil.rmtree(cache_path)
+
+    def test_query_num_readers(self):
+        data = [np.random.rand(256) for i in range(10)]
+        self.gStore.update([{"task_id": "mp-{}".format(i), "data": d} for i, d in enumerate(data)])
+
+        docs = list(self.gStore.query(sort=[("metadata.task_id", 1)], num_readers=3))
+        self.assertEqual(len(docs), 10)
+        nptu.assert_almost_equal(docs[2]["data"], data[2], 7)
+
+        self.gStore.num_readers = 4
+        self.assertEqual(len(list(self.gStore.query({"task_id": {"$in": ["mp-1", "mp-2"]}}))), 2)
+
     @unittest.skip
     def test_distinct(self):
         # TODO
@@ -2,9 +2,24 @@
 """
 Tests utilities
 """
+import io
+import json
 import unittest
+from datetime import datetime, timedelta
 
-from maggma.utils import recursive_update, Timeout
+import numpy as np
+from bson import ObjectId
+from monty.json import jsanitize
+
+from maggma.stores import MemoryStore
+from maggma.utils import (
+    fast_jsanitize,
+    iter_json,
+    recursive_update,
+    Timeout,
+    source_keys_updated,
+    server_side_keys_updated,
+)
 from time import sleep
 
 class UtilsTests(unittest.TestCase):
@@ -24,6 +39,29 @@ class UtilsTests(unittest.TestCase):
         recursive_update(d, {"a": {"b": [7]}})
         self.assertEqual(d["a"]["b"], [7])
 
+    def test_fast_jsanitize(self):
+        doc = {
+            "a": [1, 2.0, (3, "x")],
+            "b": {1: np.arange(3), "c": {"d": np.array([[1.0, 2.0], [3.0, 4.0]])}},
+            "e": np.int64(3),
+            "f": datetime(2018, 4, 12, 16),
+            "g": ObjectId(),
+            "h": None,
+        }
+        for allow_bson in [True, False]:
+            self.assertEqual(
+                fast_jsanitize(doc, allow_bson=allow_bson),
+                jsanitize(doc, allow_bson=allow_bson),
+            )
+
+        # Safe subtrees are not copied, but the top-level doc is
+        doc = {"a": [1, {"b": "c"}], "d": {"e": 1.0}, "f": (2,)}
+        sanitized = fast_jsanitize(doc)
+        self.assertIsNot(sanitized, doc)
+        self.assertIs(sanitized["a"], doc["a"])
+        self.assertIs(sanitized["d"], doc["d"])
+        self.assertEqual(sanitized["f"], [2])
+
     def test_timeout(self):
 
         def takes_too_long():
@@ -31,3 +69,71 @@ class UtilsTests(unittest.TestCase):
                 sleep(2)
 
         self.assertRaises(TimeoutError, takes_too_long)
+
+    def test_source_keys_updated(self):
+        tic = datetime(2018, 4, 12, 16)
+        toc = tic + timedelta(seconds=1)
+        source = MemoryStore("source", key="k", lu_field="lu")
+        target = MemoryStore("target", key="k", lu_field="lu")
+        source.connect()
+        target.connect()
+        source.collection.insert_many([{"k": k, "lu": toc} for k in range(10)])
+        target.collection.insert_many(
+            [{"k": k, "lu": tic if k < 3 else toc} for k in range(8)]
+        )
+        updated = [0, 1, 2, 8, 9]
+
+        # In-memory diff and sorted-merge diff for separate databases
+        self.assertCountEqual(source_keys_updated(source, target), updated)
+        self.assertCountEqual(
+            source_keys_updated(source, target, server_side=True), updated
+        )
+        self.assertCountEqual(
+            source_keys_updated(source, target, query={"k": {"$gt": 1}}, server_side=True),
+            [2, 8, 9],
+        )
+
+        # $lookup aggregation once both collections share a database
+        target._collection = source.collection.database["target"]
+        target.collection.insert_many(
+            [{"k": k, "lu": tic if k < 3 else toc} for k in range(8)]
+        )
+        self.assertCountEqual(
+            source_keys_updated(source, target, server_side=True), updated
+        )
+        self.assertCountEqual(
+            source_keys_updated(source, target, query={"k": {"$gt": 1}}, server_side=True),
+            [2, 8, 9],
+        )
+
+    def test_server_side_keys_updated(self):
+        tic = datetime(2018, 4, 12, 16)
+        toc = tic + timedelta(seconds=1)
+        source = MemoryStore("source", key="k", lu_field="lu")
+        target = MemoryStore("target", key="k", lu_field="lu")
+        source.connect()
+        target.connect()
+        # Non-unique source keys are only yielded once
+        source.collection.insert_many([{"k": k % 5, "lu": toc} for k in range(10)])
+        target.collection.insert_many([{"k": k, "lu": tic} for k in range(2)])
+        target.collection.insert_many([{"k": k, "lu": toc} for k in range(1, 4)])
+
+        keys = server_side_keys_updated(source, target)
+        self.assertEqual(next(keys), 0)
+        self.assertEqual(list(keys), [4])
+
+    def test_iter_json(self):
+        data = [{"a": i, "b": "é" * i, "c": [1.5, None]} for i in range(10)] + [12345]
+        for f in [io.StringIO(json.dumps(data)), io.BytesIO(json.dumps(data, indent=1).encode())]:
+            self.assertEqual(list(iter_json(f, chunk_size=3)), data)
+
+        self.assertEqual(list(iter_json(io.StringIO('{"a": [1, 2]}'))), [{"a": [1, 2]}])
+        self.assertEqual(list(iter_json(io.StringIO(" [ ] "), chunk_size=1)), [])
+        for chunk_size in range(1, 6):
+            self.assertEqual(list(iter_json(io.StringIO("[1 , 2.5e3]"), chunk_size=chunk_size)), [1, 2500.0])
+        big = [{"a": "x" * 10000}, list(range(1000))]
+        self.assertEqual(list(iter_json(io.StringIO(json.dumps(big)), chunk_size=16)), big)
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_json(io.StringIO("[1, 2"), chunk_size=2))
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_json(io.StringIO("[1 2]"), chunk_size=2))
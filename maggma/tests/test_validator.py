@@ -5,6 +5,7 @@ Tests the validators
 import unittest
 from maggma.validator import JSONSchemaValidator, msonable_schema
 from monty.json import MSONable
+from jsonschema import ValidationError
 
 class ValidatorTests(unittest.TestCase):
     """
@@ -74,3 +75,29 @@ class ValidatorTests(unittest.TestCase):
 
         self.assertListEqual(validator.validation_errors(invalid_doc_wrong_type),
                              ["successful: 'true' is not of type 'boolean'"])
+
+        self.assertListEqual(
+            validator.validate_many([valid_doc, invalid_doc_wrong_type]),
+            [[], ["successful: 'true' is not of type 'boolean'"]])
+
+        strict_validator = JSONSchemaValidator(schema=test_schema, strict=True)
+        self.assertTrue(strict_validator.is_valid(valid_doc))
+        with self.assertRaises(ValidationError):
+            strict_validator.is_valid(invalid_doc_missing_key)
+
+    def test_schema_property(self):
+        """
+        Test a JSONSchemaValidator subclass defining its schema property.
+        """
+
+        class TaskValidator(JSONSchemaValidator):
+            def __init__(self):
+                super().__init__(schema=None)
+
+            @property
+            def schema(self):
+                return {"type": "object", "required": ["task_id"]}
+
+        validator = TaskValidator()
+        self.assertTrue(validator.is_valid({"task_id": "mp-test"}))
+        self.assertFalse(validator.is_valid({}))
@@ -2,19 +2,36 @@
 """
 Utilities to help with maggma functions
 """
+import codecs
 import itertools
+import json
+import re
 import signal
 import logging
 
 
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from datetime import datetime, timedelta
+from operator import itemgetter
 from sys import getsizeof, stderr
 
+import mongomock.collection
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from monty.json import jsanitize
+from pymongo.collection import Collection
+
 from pydash.utilities import to_path
 from pydash.objects import set_, get, has
 from pydash.objects import unset as _unset
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # import tqdm Jupyter widget if running inside Jupyter
 try:
     # noinspection PyUnresolvedReferences
@@ -133,6 +150,32 @@ def grouper(iterable, n, fillvalue=None):
     return iterator
 
 
+def threaded_imap(func, iterable, num_workers=1):
+    """
+    Lazily maps func over iterable with a pool of threads, reading ahead
+    a bounded number of items while earlier results are consumed. The
+    results are yielded in the order of iterable.
+
+    Args:
+        func (callable): function to apply to each item
+        iterable (iterable): items to map over
+        num_workers (int): number of threads, 1 or less maps serially
+    """
+    items = iter(iterable)
+    if num_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        pending = deque(executor.submit(func, item) for item in itertools.islice(items, 2 * num_workers))
+        while pending:
+            future = pending.popleft()
+            for item in itertools.islice(items, 1):
+                pending.append(executor.submit(func, item))
+            yield future.result()
+
+
 def get_mpi():
     """
     Helper that returns the mpi communicator, rank and size.
@@ -235,13 +278,111 @@ def total_size(o, handlers=None, verbose=False):
     return sizeof(o)
 
 
-def source_keys_updated(source, target, query=None):
+def fast_jsanitize(obj, allow_bson=False):
+    """
+    Drop-in replacement for monty.json.jsanitize(obj, allow_bson=allow_bson)
+    for documents written by Stores.
+
+    Subtrees that are already BSON (or JSON) safe are returned as is rather
+    than copied, and how to convert each type is looked up once and cached.
+    Only the top-level dict or list is always copied, so the result can be
+    modified without touching obj. Types not handled here are passed on to
+    jsanitize.
+
+    Args:
+        obj: document to sanitize
+        allow_bson (bool): whether to keep datetime, bytes and ObjectId
+    """
+    sanitized = _sanitize(obj, allow_bson)
+    if sanitized is obj and isinstance(obj, (dict, list)):
+        return copy(obj)
+    return sanitized
+
+
+def _sanitize(obj, allow_bson):
+    try:
+        encoder = _ENCODERS[type(obj), allow_bson]
+    except KeyError:
+        encoder = _ENCODERS[type(obj), allow_bson] = _get_encoder(type(obj), allow_bson)
+    return encoder(obj, allow_bson)
+
+
+def _get_encoder(cls, allow_bson):
+    """Finds the function to sanitize objects of type cls"""
+    if issubclass(cls, dict):
+        return _sanitize_dict
+    if issubclass(cls, (list, tuple)):
+        return _sanitize_list
+    if np is not None and issubclass(cls, np.ndarray):
+        return _sanitize_array
+    if np is not None and issubclass(cls, np.generic):
+        return lambda obj, allow_bson: _sanitize(obj.item(), allow_bson)
+    if issubclass(cls, (str, int, float, type(None))):
+        return _keep
+    if allow_bson and issubclass(cls, (datetime, bytes, ObjectId)):
+        return _keep
+    return lambda obj, allow_bson: jsanitize(obj, allow_bson=allow_bson)
+
+
+def _keep(obj, allow_bson):
+    return obj
+
+
+def _sanitize_dict(d, allow_bson):
+    sanitized = None
+    for i, (k, v) in enumerate(d.items()):
+        sv = _sanitize(v, allow_bson)
+        if sanitized is None and (sv is not v or not isinstance(k, str)):
+            # Copy on the first change, all previous items were safe
+            sanitized = dict(itertools.islice(d.items(), i))
+        if sanitized is not None:
+            sanitized[k.__str__()] = sv
+    if sanitized is None:
+        return d if type(d) is dict else dict(d)
+    return sanitized
+
+
+def _sanitize_list(l, allow_bson):
+    sanitized = None
+    for i, v in enumerate(l):
+        sv = _sanitize(v, allow_bson)
+        if sanitized is None and sv is not v:
+            sanitized = list(l[:i])
+        if sanitized is not None:
+            sanitized.append(sv)
+    if sanitized is None:
+        return l if type(l) is list else list(l)
+    return sanitized
+
+
+def _sanitize_array(a, allow_bson):
+    # tolist already gives python scalars for numeric arrays
+    if a.dtype.kind in "biuf":
+        return a.tolist()
+    return _sanitize_list(a.tolist(), allow_bson)
+
+
+_ENCODERS = {}
+
+
+def source_keys_updated(source, target, query=None, server_side=False):
     """
     Utility for incremental building. Gets a list of source.key values.
 
     Get key values for source documents that have been updated with respect to
     corresponding target documents.
+
+    Args:
+        source (Store): store to look for updated documents
+        target (Store): store with documents built from source
+        query (dict): mongo query to limit scope of source
+        server_side (bool): for Mongo-backed stores, compute the keys without
+            pulling every target key into memory. If both stores share a
+            database this is a single aggregation using $lookup, otherwise
+            two key-sorted cursors are merged.
     """
+    if server_side and is_mongo_backed(source) and is_mongo_backed(target):
+        return list(server_side_keys_updated(source, target, query=query))
 
     keys_updated = set()  # Handle non-unique keys, e.g. for GroupBuilder.
 
@@ -263,6 +404,211 @@ def source_keys_updated(source, target, query=None):
     return list(keys_updated)
 
 
+def server_side_keys_updated(source, target, query=None):
+    """
+    Generator version of source_keys_updated for Mongo-backed stores.
+    Keys are yielded as they are found so that processing can start before
+    the diff is finished. Uses a $lookup aggregation if both stores share a
+    database and a merge of key-sorted cursors otherwise.
+
+    Args:
+        source (Store): store to look for updated documents
+        target (Store): store with documents built from source
+        query (dict): mongo query to limit scope of source
+    """
+    if source.lu_type == target.lu_type and share_database(source, target):
+        return lookup_keys_updated(source, target, query=query)
+    return merge_keys_updated(source, target, query=query)
+
+
+def is_mongo_backed(store):
+    """Whether a store is backed by a single (pymongo or mongomock) collection."""
+    try:
+        collection = store.collection
+    except (AttributeError, NotImplementedError):
+        return False
+    return isinstance(collection, (Collection, mongomock.collection.Collection))
+
+
+def is_regex(value):
+    """Whether a query condition value is a regular expression."""
+    return isinstance(value, (Regex, type(re.compile(""))))
+
+
+def share_database(source, target):
+    """
+    Whether two Mongo-backed stores live in the same database, i.e.
+    whether one can $lookup into the other.
+
+    mongomock clients compare equal but do not share data, so for those
+    the client has to be the same object.
+    """
+    db1, db2 = source.collection.database, target.collection.database
+    if db1 != db2:
+        return False
+    return isinstance(source.collection, Collection) or db1.client is db2.client
+
+
+def lookup_keys_updated(source, target, query=None):
+    """
+    Yields the source.key values of updated documents from a single
+    aggregation on the source collection. Requires source and target
+    to share a database and to store lu_field with the same lu_type.
+
+    Args:
+        source (Store): store to look for updated documents
+        target (Store): store with documents built from source
+        query (dict): mongo query to limit scope of source
+    """
+    pipeline = []
+    if query:
+        pipeline.append({"$match": query})
+    pipeline.extend(
+        [
+            {"$project": {source.key: 1, source.lu_field: 1, "_id": 0}},
+            {
+                "$lookup": {
+                    "from": target.collection.name,
+                    "localField": source.key,
+                    "foreignField": target.key,
+                    "as": "_target",
+                }
+            },
+            # Missing target docs give a null $max, which any date is newer than
+            {
+                "$project": {
+                    source.key: 1,
+                    "_updated": {
+                        "$gt": [
+                            "${}".format(source.lu_field),
+                            {"$max": "$_target.{}".format(target.lu_field)},
+                        ]
+                    },
+                }
+            },
+            {"$match": {"_updated": True}},
+            {"$group": {"_id": "${}".format(source.key)}},
+        ]
+    )
+    for d in source.collection.aggregate(pipeline, allowDiskUse=True):
+        yield d["_id"]
+
+
+def merge_keys_updated(source, target, query=None):
+    """
+    Yields the source.key values of updated documents by walking key-sorted
+    cursors of source and target in lockstep, so that only one document
+    of each store is held in memory at a time. The projections exclude _id,
+    so with a compound (key, lu_field) index on each store both cursors are
+    covered by the index.
+
+    Keys are compared in python, so they should all be of one type to sort
+    consistently with the database.
+
+    Args:
+        source (Store): store to look for updated documents
+        target (Store): store with documents built from source
+        query (dict): mongo query to limit scope of source
+    """
+    props = {target.key: 1, target.lu_field: 1, "_id": 0}
+    target_docs = target.query(properties=props).sort(target.key, 1)
+    # Collapse non-unique target keys to their most recent lu_field
+    target_dates = (
+        (key, max(target.lu_func[0](d[target.lu_field]) for d in docs))
+        for key, docs in itertools.groupby(target_docs, key=itemgetter(target.key))
+    )
+
+    props = {source.key: 1, source.lu_field: 1, "_id": 0}
+    source_docs = source.query(criteria=query, properties=props).sort(source.key, 1)
+
+    tdoc = next(target_dates, None)
+    for key, docs in itertools.groupby(source_docs, key=itemgetter(source.key)):
+        lu = max(source.lu_func[0](d[source.lu_field]) for d in docs)
+        while tdoc is not None and tdoc[0] < key:
+            tdoc = next(target_dates, None)
+        if tdoc is None or tdoc[0] != key or lu > tdoc[1]:
+            yield key
+
+
+def iter_json(f, chunk_size=2 ** 20):
+    """
+    Incrementally parses a JSON file, yielding the elements of a top-level
+    array one at a time, or the top-level value if it is not an array.
+    Only a chunk and the element being parsed are held in memory.
+
+    Args:
+        f: file-like object opened for reading, in text or binary mode
+        chunk_size (int): number of characters or bytes to read at a time
+    """
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder("utf-8")()
+
+    def read(size):
+        chunk = f.read(size)
+        return (decode.decode(chunk, final=not chunk) if isinstance(chunk, bytes) else chunk), not chunk
+
+    buffer, eof = read(chunk_size)
+    pos = _skip_json_whitespace(buffer, 0)
+    while pos == len(buffer) and not eof:
+        chunk, eof = read(chunk_size)
+        buffer += chunk
+        pos = _skip_json_whitespace(buffer, pos)
+
+    if buffer[pos : pos + 1] != "[":
+        chunks = [buffer]
+        while not eof:
+            chunk, eof = read(chunk_size)
+            chunks.append(chunk)
+        yield json.loads("".join(chunks))
+        return
+
+    pos += 1
+    expect_element = True
+    # Elements larger than the buffer are parsed again after each read, so
+    # reads double in size until they are complete to parse them O(log n) times
+    read_size = chunk_size
+    while True:
+        pos = _skip_json_whitespace(buffer, pos)
+        if pos < len(buffer):
+            if buffer[pos] == "]":
+                return
+            if not expect_element:
+                if buffer[pos] != ",":
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+                pos += 1
+                expect_element = True
+                continue
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+                # A number at the end of the buffer may continue in the next
+                # chunk, so elements are only complete once followed by , or ]
+                after = _skip_json_whitespace(buffer, end)
+                if eof or (after < len(buffer) and buffer[after] in ",]"):
+                    yield obj
+                    pos = end
+                    expect_element = False
+                    read_size = chunk_size
+                    continue
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            read_size *= 2
+        elif eof:
+            raise json.JSONDecodeError("Unterminated array", buffer, pos)
+
+        # The parsed elements are only dropped from the buffer when refilling it
+        chunk, eof = read(read_size)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def _skip_json_whitespace(s, pos):
+    return _JSON_WHITESPACE.match(s, pos).end()
+
+
 class Timeout:
     # implementation courtesy of https://stackoverflow.com/a/22348885/637562
 
@@ -6,7 +6,6 @@ that Store.
 """
 
 from abc import ABC, abstractmethod
-from jsonschema import validate, ValidationError
 from jsonschema.validators import validator_for
 import pydash
 
@@ -34,6 +33,13 @@ class Validator(ABC):
         """
         return NotImplementedError
 
+    def validate_many(self, docs):
+        """
+        Returns ([[str]]): the validation errors for each document,
+        an empty list for valid documents
+        """
+        return [self.validation_errors(doc) for doc in docs]
+
 
 class JSONSchemaValidator(Validator):
     """
@@ -58,6 +64,7 @@ class JSONSchemaValidator(Validator):
         """
         self._schema = schema
         self._strict = strict
+        self._compiled = None
 
     @property
     def strict(self):
@@ -84,6 +91,17 @@ class JSONSchemaValidator(Validator):
         """
         return self._schema
 
+    @property
+    def _validator(self):
+        """
+        The jsonschema validator of self.schema, compiled on first use
+        rather than for every document
+        """
+        if getattr(self, "_compiled", None) is None:
+            schema = self.schema
+            self._compiled = validator_for(schema)(schema)
+        return self._compiled
+
     def is_valid(self, doc):
         """
         Returns True or False if validator initialized with
@@ -93,27 +111,22 @@ class JSONSchemaValidator(Validator):
         :param doc (dict): a single document
         :return: True, False or ValidationError
         """
-        try:
-            validate(doc, schema=self.schema)
+        if self.strict:
+            self._validator.validate(doc)
             return True
-        except ValidationError:
-            if self.strict:
-                raise
-            else:
-                return False
+        return self._validator.is_valid(doc)
 
     def validation_errors(self, doc):
+        """
+        Returns the list of validation error messages for a single
+        document in one pass, empty if the document is valid
 
-        if self.is_valid(doc):
-            return []
-
-        validator = validator_for(self.schema)(self.schema)
-        errors = ["{}: {}".format(".".join(error.absolute_path),
-                                  error.message)
-                  for error in validator.iter_errors(doc)]
-
-        return errors
-
+        :param doc (dict): a single document
+        :return: list of strings
+        """
+        return ["{}: {}".format(".".join(map(str, error.absolute_path)),
+                                error.message)
+                for error in self._validator.iter_errors(doc)]
 
 
 def msonable_schema(cls):
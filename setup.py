@@ -26,7 +26,9 @@ if __name__ == "__main__":
             "smoqe>=0.1.3", "PyYAML>=3.12", "pydash>=4.1.0", "tqdm>=4.19.6",
             "mongogrant>=0.2.2", "hvac>=0.3.0", "boto3>=1.6.9",
         ],
-        extras_require={"mpi": ["mpi4py>=2.0.0"]},
+        extras_require={"mpi": ["mpi4py>=2.0.0"],
+                        "compression": ["zstandard>=0.10.0", "lz4>=2.1.0"],
+                        "serialization": ["msgpack>=0.6.0"]},
         classifiers=["Programming Language :: Python :: 3",
                      "Programming Language :: Python :: 3.6",
                      "Development Status :: 2 - Pre-Alpha",